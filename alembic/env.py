@@ -1,3 +1,5 @@
+import re
+
 from sqlalchemy import create_engine
 
 from alembic import context
@@ -13,6 +15,15 @@ config = context.config
 # from myapp import mymodel
 # target_metadata = mymodel.Base.metadata
 target_metadata = Base.metadata
+partition_name_regex = re.compile(r"^messages_(legacy|default|p\d{14}|(p\d{14}_)?h\d+)$")
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    # the partitions of the messages table are managed by the worker
+    if type_ == "table" and reflected and compare_to is None and partition_name_regex.match(name):
+        return False
+    return True
+
 
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
@@ -38,6 +49,7 @@ def run_migrations_offline() -> None:
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
         compare_type=True,
+        include_object=include_object,
     )
 
     with context.begin_transaction():
@@ -53,7 +65,12 @@ def run_migrations_online() -> None:
     """
     connectable = create_engine(settings.database_url)
     with connectable.connect() as connection:
-        context.configure(connection=connection, target_metadata=target_metadata, compare_type=True)
+        context.configure(
+            connection=connection,
+            target_metadata=target_metadata,
+            compare_type=True,
+            include_object=include_object,
+        )
 
         with context.begin_transaction():
             context.run_migrations()
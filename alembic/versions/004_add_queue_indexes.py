@@ -0,0 +1,41 @@
+"""Add queue indexes on messages
+
+Revision ID: 9b2f6c1d7e4a
+Revises: 53a93f17a53d
+Create Date: 2026-10-18 10:12:31.482913
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "9b2f6c1d7e4a"
+down_revision = "53a93f17a53d"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # concurrently does not block writes on the messages table but can't run inside a transaction
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_messages_queue_id_scheduled_at",
+            "messages",
+            ["queue_id", "scheduled_at"],
+            unique=False,
+            postgresql_concurrently=True,
+        )
+        op.create_index(
+            "ix_messages_queue_id_expired_at",
+            "messages",
+            ["queue_id", "expired_at"],
+            unique=False,
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index("ix_messages_queue_id_expired_at", table_name="messages", postgresql_concurrently=True)
+        op.drop_index(
+            "ix_messages_queue_id_scheduled_at", table_name="messages", postgresql_concurrently=True
+        )
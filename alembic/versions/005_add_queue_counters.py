@@ -0,0 +1,36 @@
+"""Add queue counters
+
+Revision ID: 2d8e4a7c5f13
+Revises: 9b2f6c1d7e4a
+Create Date: 2026-10-18 14:03:52.118406
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "2d8e4a7c5f13"
+down_revision = "9b2f6c1d7e4a"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # the counters are created by the queue_counters_reconcile task, or on the first stats call
+    op.create_table(
+        "queue_counters",
+        sa.Column("queue_id", sa.String(length=128), nullable=False),
+        sa.Column("num_ready", sa.BigInteger(), nullable=False),
+        sa.Column("num_in_flight", sa.BigInteger(), nullable=False),
+        sa.Column("num_delayed", sa.BigInteger(), nullable=False),
+        sa.Column("oldest_message_created_at", sa.DateTime(), nullable=True),
+        sa.Column("reconciled_at", sa.DateTime(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(["queue_id"], ["queues.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("queue_id"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("queue_counters")
@@ -0,0 +1,32 @@
+"""Partition messages by expired_at
+
+Revision ID: 7c1f9e2b8a64
+Revises: 2d8e4a7c5f13
+Create Date: 2026-10-18 16:41:07.529314
+
+"""
+from alembic import op
+from fastqueue.config import settings
+from fastqueue.partitions import is_partitioned, partition_messages, unpartition_messages
+
+# revision identifiers, used by Alembic.
+revision = "7c1f9e2b8a64"
+down_revision = "2d8e4a7c5f13"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # partitioning is optional and only applied here on new installs, an existing install is partitioned
+    # or unpartitioned with the db-partition command, which doesn't depend on the revision
+    if not settings.enable_messages_partitioning:
+        return
+    connection = op.get_bind()
+    if not is_partitioned(connection):
+        partition_messages(connection)
+
+
+def downgrade() -> None:
+    connection = op.get_bind()
+    if is_partitioned(connection):
+        unpartition_messages(connection)
@@ -0,0 +1,33 @@
+"""Hash partition messages by queue_id
+
+Revision ID: 4b770dec5c82
+Revises: 7c1f9e2b8a64
+Create Date: 2026-10-18 18:02:44.918205
+
+"""
+from alembic import op
+from fastqueue.config import settings
+from fastqueue.partitions import get_partition_strategy, hash_partition_messages, unpartition_messages
+
+# revision identifiers, used by Alembic.
+revision = "4b770dec5c82"
+down_revision = "7c1f9e2b8a64"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # with fastqueue_enable_messages_partitioning the range partitions are already split by queue_id when
+    # they are created; to enable it or change the number of partitions on an existing install use the
+    # db-partition command
+    if settings.messages_hash_partitions <= 0 or settings.enable_messages_partitioning:
+        return
+    connection = op.get_bind()
+    if get_partition_strategy(connection) is None:
+        hash_partition_messages(connection)
+
+
+def downgrade() -> None:
+    connection = op.get_bind()
+    if get_partition_strategy(connection) == "h":
+        unpartition_messages(connection)
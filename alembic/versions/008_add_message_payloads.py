@@ -0,0 +1,56 @@
+"""Add message payloads
+
+Revision ID: 5ff3490b4dde
+Revises: 4b770dec5c82
+Create Date: 2026-10-18 19:12:30.640271
+
+"""
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from alembic import op
+from fastqueue.partitions import is_partitioned
+
+# revision identifiers, used by Alembic.
+revision = "5ff3490b4dde"
+down_revision = "4b770dec5c82"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "message_payloads",
+        sa.Column("id", postgresql.UUID(), nullable=False),
+        sa.Column("data", postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+        sa.Column("attributes", postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.add_column("messages", sa.Column("payload_id", postgresql.UUID(), nullable=True))
+    op.alter_column("messages", "data", existing_type=postgresql.JSONB(astext_type=sa.Text()), nullable=True)
+    op.create_foreign_key(None, "messages", "message_payloads", ["payload_id"], ["id"])
+
+    # partitioned tables can't be indexed concurrently, the new column is empty in any case
+    partitioned = is_partitioned(op.get_bind())
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_messages_payload_id",
+            "messages",
+            ["payload_id"],
+            unique=False,
+            postgresql_where=sa.text("payload_id IS NOT NULL"),
+            postgresql_concurrently=not partitioned,
+        )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_messages_payload_id", table_name="messages")
+    op.execute(
+        "UPDATE messages SET data = message_payloads.data, attributes = message_payloads.attributes "
+        "FROM message_payloads WHERE message_payloads.id = messages.payload_id"
+    )
+    op.alter_column("messages", "data", existing_type=postgresql.JSONB(astext_type=sa.Text()), nullable=False)
+    # the foreign key is dropped with the column, its name depends on how the table was partitioned
+    op.drop_column("messages", "payload_id")
+    op.drop_table("message_payloads")
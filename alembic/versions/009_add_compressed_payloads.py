@@ -0,0 +1,47 @@
+"""Add compressed message payloads
+
+Revision ID: c0ba4faa9172
+Revises: 5ff3490b4dde
+Create Date: 2026-10-18 20:05:51.302176
+
+"""
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from alembic import op
+from fastqueue.compression import decompress_data
+
+# revision identifiers, used by Alembic.
+revision = "c0ba4faa9172"
+down_revision = "5ff3490b4dde"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column("message_payloads", sa.Column("compressed_data", sa.LargeBinary(), nullable=True))
+    op.alter_column(
+        "message_payloads", "data", existing_type=postgresql.JSONB(astext_type=sa.Text()), nullable=True
+    )
+
+
+def downgrade() -> None:
+    # postgresql can't decompress the data, so it is done here
+    payloads = sa.table(
+        "message_payloads",
+        sa.column("id", postgresql.UUID()),
+        sa.column("data", postgresql.JSONB()),
+        sa.column("compressed_data", sa.LargeBinary()),
+    )
+    connection = op.get_bind()
+    rows = connection.execute(
+        sa.select(payloads.c.id, payloads.c.compressed_data).where(payloads.c.compressed_data.is_not(None))
+    )
+    for id, compressed_data in rows.all():
+        connection.execute(
+            payloads.update().where(payloads.c.id == id).values(data=decompress_data(compressed_data))
+        )
+    op.alter_column(
+        "message_payloads", "data", existing_type=postgresql.JSONB(astext_type=sa.Text()), nullable=False
+    )
+    op.drop_column("message_payloads", "compressed_data")
@@ -0,0 +1,32 @@
+"""Add queue retry policy
+
+Revision ID: 3e1f6b2a9d47
+Revises: c0ba4faa9172
+Create Date: 2026-10-18 22:41:07.518203
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "3e1f6b2a9d47"
+down_revision = "c0ba4faa9172"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column("queues", sa.Column("retry_policy", sa.String(length=16), nullable=True))
+    op.add_column("queues", sa.Column("retry_min_backoff_seconds", sa.Integer(), nullable=True))
+    op.add_column("queues", sa.Column("retry_max_backoff_seconds", sa.Integer(), nullable=True))
+    op.add_column(
+        "queues", sa.Column("retry_jitter", sa.Boolean(), server_default=sa.false(), nullable=False)
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("queues", "retry_jitter")
+    op.drop_column("queues", "retry_max_backoff_seconds")
+    op.drop_column("queues", "retry_min_backoff_seconds")
+    op.drop_column("queues", "retry_policy")
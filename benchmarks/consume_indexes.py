@@ -0,0 +1,97 @@
+# Consume latency with and without the queue indexes on the messages table.
+#
+# It recreates the schema on fastqueue_database_url, so always point it to a scratch database:
+#
+#   fastqueue_database_url=postgresql+psycopg2://... python -m benchmarks.consume_indexes --messages 5000000
+import argparse
+import random
+import statistics
+from time import perf_counter
+
+from sqlalchemy import text
+
+from fastqueue.database import Base, engine, SessionLocal
+from fastqueue.services import MessageService
+
+queue_indexes = {
+    "ix_messages_queue_id_scheduled_at": "(queue_id, scheduled_at)",
+    "ix_messages_queue_id_expired_at": "(queue_id, expired_at)",
+}
+
+
+def populate(num_queues: int, num_messages: int) -> None:
+    # messages of each queue are stored together, like the bursts of a real workload
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                "INSERT INTO topics (id, created_at) VALUES ('benchmark', now());"
+                "INSERT INTO queues (id, topic_id, ack_deadline_seconds, message_retention_seconds, "
+                "created_at, updated_at) "
+                "SELECT 'queue_' || i, 'benchmark', 30, 1209600, now(), now() "
+                "FROM generate_series(0, :num_queues - 1) AS i"
+            ),
+            {"num_queues": num_queues},
+        )
+        connection.execute(
+            text(
+                "INSERT INTO messages (id, queue_id, data, delivery_attempts, expired_at, scheduled_at, "
+                "created_at, updated_at) "
+                "SELECT gen_random_uuid(), 'queue_' || (i::bigint * :num_queues / (:num_messages + 1)), "
+                '\'{"message": "Hello"}\', 0, '
+                "now() + interval '14 days', now() - interval '1 second' * (i % 3600), now(), now() "
+                "FROM generate_series(1, :num_messages) AS i"
+            ),
+            {"num_queues": num_queues, "num_messages": num_messages},
+        )
+
+
+def set_queue_indexes(enabled: bool) -> None:
+    with engine.begin() as connection:
+        for name, columns in queue_indexes.items():
+            if enabled:
+                connection.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON messages {columns}"))
+            else:
+                connection.execute(text(f"DROP INDEX IF EXISTS {name}"))
+        connection.execute(text("ANALYZE messages"))
+
+
+def run(num_queues: int, num_requests: int, limit: int) -> list[float]:
+    latencies = []
+    with SessionLocal() as session:
+        service = MessageService(session=session)
+        for _ in range(num_requests):
+            queue_id = f"queue_{random.randrange(num_queues)}"
+            start = perf_counter()
+            service.list_for_consume(queue_id=queue_id, limit=limit)
+            latencies.append(perf_counter() - start)
+    return latencies
+
+
+def report(name: str, latencies: list[float]) -> None:
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(
+        f"{name:<16} requests={len(latencies)} p50={quantiles[49] * 1000:.2f}ms "
+        f"p99={quantiles[98] * 1000:.2f}ms max={max(latencies) * 1000:.2f}ms"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Consume latency with and without queue indexes.")
+    parser.add_argument("--queues", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args()
+
+    print(f"populating {args.messages} messages over {args.queues} queues")
+    populate(num_queues=args.queues, num_messages=args.messages)
+
+    for name, enabled in (("brin indexes", False), ("queue indexes", True)):
+        set_queue_indexes(enabled)
+        report(name, run(num_queues=args.queues, num_requests=args.requests, limit=args.limit))
+
+
+if __name__ == "__main__":
+    main()
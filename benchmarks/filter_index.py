@@ -0,0 +1,95 @@
+# Cost of matching a message against the filtered subscriptions of a topic, checking every queue one by one
+# versus the compiled MessageFilterIndex. It doesn't connect to the database:
+#
+#   fastqueue_database_url=postgresql+psycopg2://... python -m benchmarks.filter_index --queues 10000
+import argparse
+import random
+import statistics
+from time import perf_counter
+from types import SimpleNamespace
+
+from fastqueue.filters import MessageFilterIndex
+
+
+def make_queues(num_queues: int, num_keys: int, num_values: int) -> list[SimpleNamespace]:
+    queues = []
+    for i in range(num_queues):
+        keys = random.sample(range(num_keys), k=random.randint(1, 3))
+        message_filters = {
+            f"attr{key}": [f"value{value}" for value in random.sample(range(num_values), k=2)] for key in keys
+        }
+        queues.append(SimpleNamespace(id=f"queue_{i:06}", message_filters=message_filters))
+    return queues
+
+
+def make_attributes(num_messages: int, num_keys: int, num_values: int) -> list[dict[str, str]]:
+    return [
+        {f"attr{key}": f"value{random.randrange(num_values)}" for key in random.sample(range(num_keys), k=3)}
+        for _ in range(num_messages)
+    ]
+
+
+def should_message_be_created_on_queue(queue_filters: dict | None, message_attributes: dict | None) -> bool:
+    # the matching that the services did before MessageFilterIndex, one queue at a time
+    if queue_filters is not None:
+        if message_attributes is None:
+            return False
+
+        keys = set(queue_filters.keys()).intersection(set(message_attributes.keys()))
+        if len(keys) != len(queue_filters.keys()):
+            return False
+
+        for key in keys:
+            if message_attributes[key] not in queue_filters[key]:
+                return False
+
+    return True
+
+
+def linear_match(queues: list[SimpleNamespace], attributes: dict[str, str]) -> list[SimpleNamespace]:
+    return [
+        queue for queue in queues if should_message_be_created_on_queue(queue.message_filters, attributes)
+    ]
+
+
+def measure(match, messages: list[dict[str, str]]) -> tuple[list[float], int]:
+    latencies = []
+    matches = 0
+    for attributes in messages:
+        start = perf_counter()
+        matches += len(match(attributes))
+        latencies.append(perf_counter() - start)
+    return latencies, matches
+
+
+def report(name: str, latencies: list[float], matches: int) -> None:
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(
+        f"{name:<8} messages={len(latencies)} matches={matches} p50={quantiles[49] * 1_000_000:.1f}us "
+        f"p99={quantiles[98] * 1_000_000:.1f}us"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Subscription matching cost per published message.")
+    parser.add_argument("--queues", type=int, default=10_000)
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--keys", type=int, default=20)
+    parser.add_argument("--values", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    queues = make_queues(args.queues, args.keys, args.values)
+    messages = make_attributes(args.messages, args.keys, args.values)
+
+    start = perf_counter()
+    filter_index = MessageFilterIndex(queues)
+    print(f"compiled {args.queues} subscriptions in {(perf_counter() - start) * 1000:.1f}ms")
+
+    report("linear", *measure(lambda attributes: linear_match(queues, attributes), messages))
+    report("index", *measure(filter_index.match, messages))
+
+
+if __name__ == "__main__":
+    main()
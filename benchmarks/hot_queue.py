@@ -0,0 +1,120 @@
+# Consume latency of cold queues while one hot queue is churning, with one messages table and with the
+# messages table hash partitioned by queue.
+#
+# It recreates the schema on fastqueue_database_url, so always point it to a scratch database:
+#
+#   fastqueue_database_url=postgresql+psycopg2://... python -m benchmarks.hot_queue --partitions 16
+import argparse
+import random
+import statistics
+import threading
+from time import perf_counter
+
+from sqlalchemy import text
+
+from fastqueue.cache import routing_cache
+from fastqueue.config import settings
+from fastqueue.database import Base, engine, SessionLocal
+from fastqueue.partitions import hash_partition_messages
+from fastqueue.schemas import CreateMessageBatchSchema, CreateMessageSchema, MessageIdsSchema
+from fastqueue.services import MessageService
+
+
+def populate(num_queues: int, num_messages: int, partitions: int) -> None:
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    routing_cache.clear()
+    with engine.begin() as connection:
+        if partitions > 0:
+            settings.messages_hash_partitions = partitions
+            hash_partition_messages(connection)
+        connection.execute(
+            text(
+                "INSERT INTO topics (id, created_at) VALUES ('cold', now()), ('hot', now());"
+                "INSERT INTO queues (id, topic_id, ack_deadline_seconds, message_retention_seconds, "
+                "created_at, updated_at) "
+                "SELECT 'queue_' || i, 'cold', 30, 1209600, now(), now() "
+                "FROM generate_series(0, :num_queues - 1) AS i;"
+                "INSERT INTO queues (id, topic_id, ack_deadline_seconds, message_retention_seconds, "
+                "created_at, updated_at) VALUES ('hot', 'hot', 30, 1209600, now(), now())"
+            ),
+            {"num_queues": num_queues},
+        )
+        connection.execute(
+            text(
+                "INSERT INTO messages (id, queue_id, data, delivery_attempts, expired_at, scheduled_at, "
+                "created_at, updated_at) "
+                "SELECT gen_random_uuid(), 'queue_' || (i % :num_queues), "
+                '\'{"message": "Hello"}\', 0, '
+                "now() + interval '14 days', now() - interval '1 second', now(), now() "
+                "FROM generate_series(1, :num_messages) AS i"
+            ),
+            {"num_queues": num_queues, "num_messages": num_messages},
+        )
+        connection.execute(text("ANALYZE messages"))
+
+
+def churn(stop: threading.Event, batch_size: int) -> None:
+    # publishes, consumes and acks batches on the hot queue as fast as it can
+    data = CreateMessageBatchSchema(data=[CreateMessageSchema(data={"message": "Hello"})] * batch_size)
+    with SessionLocal() as session:
+        service = MessageService(session=session)
+        while not stop.is_set():
+            service.create_batch(topic_id="hot", data=data)
+            consumed = service.list_for_consume(queue_id="hot", limit=batch_size)
+            service.ack_batch(data=MessageIdsSchema(ids=[message.id for message in consumed.data]))
+
+
+def run(num_queues: int, num_requests: int, limit: int) -> list[float]:
+    latencies = []
+    with SessionLocal() as session:
+        service = MessageService(session=session)
+        for _ in range(num_requests):
+            queue_id = f"queue_{random.randrange(num_queues)}"
+            start = perf_counter()
+            service.list_for_consume(queue_id=queue_id, limit=limit)
+            latencies.append(perf_counter() - start)
+    return latencies
+
+
+def report(name: str, latencies: list[float]) -> None:
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(
+        f"{name:<28} requests={len(latencies)} p50={quantiles[49] * 1000:.2f}ms "
+        f"p99={quantiles[98] * 1000:.2f}ms max={max(latencies) * 1000:.2f}ms"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Cold queues consume latency next to a hot queue.")
+    parser.add_argument("--queues", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--partitions", type=int, default=16)
+    parser.add_argument("--hot-workers", type=int, default=4)
+    parser.add_argument("--hot-batch-size", type=int, default=100)
+    args = parser.parse_args()
+
+    for name, partitions in (("one table", 0), (f"{args.partitions} hash partitions", args.partitions)):
+        print(f"populating {args.messages} messages over {args.queues} queues ({name})")
+        populate(num_queues=args.queues, num_messages=args.messages, partitions=partitions)
+        report(f"{name}, idle", run(num_queues=args.queues, num_requests=args.requests, limit=args.limit))
+
+        stop = threading.Event()
+        workers = [
+            threading.Thread(target=churn, args=(stop, args.hot_batch_size)) for _ in range(args.hot_workers)
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            latencies = run(num_queues=args.queues, num_requests=args.requests, limit=args.limit)
+        finally:
+            stop.set()
+            for worker in workers:
+                worker.join()
+        report(f"{name}, hot queue", latencies)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# Serialization cost of 1,000 consumed messages, through the response_model path of fastapi and through the
+# orjson path of the message endpoints. It doesn't connect to the database:
+#
+#   python -m benchmarks.serialization --messages 1000 --repeat 50
+import argparse
+import asyncio
+import statistics
+import uuid
+from datetime import datetime, timedelta
+from time import perf_counter
+from types import SimpleNamespace
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from fastqueue.api import MessagesResponse
+from fastqueue.schemas import ListMessageSchema, MessageSchema
+from fastqueue.services import get_message_schema
+
+
+def build_rows(num_messages: int) -> list[SimpleNamespace]:
+    now = datetime.utcnow()
+    return [
+        SimpleNamespace(
+            id=uuid.uuid4(),
+            queue_id="all-events",
+            data={"event_name": f"event{i}", "success": True, "items": [{"id": i, "price": 9.99}] * 5},
+            attributes={"event_name": f"event{i}"},
+            delivery_attempts=1,
+            expired_at=now + timedelta(days=14),
+            scheduled_at=now + timedelta(seconds=30),
+            created_at=now,
+            updated_at=now,
+            compressed_data=None,
+        )
+        for i in range(num_messages)
+    ]
+
+
+response_field = create_response_field(name="Response", type_=ListMessageSchema)
+
+
+def response_model_path(rows: list[SimpleNamespace]) -> bytes:
+    # what the endpoints did before: from_orm, response_model validation, jsonable_encoder and json.dumps
+    result = ListMessageSchema(data=[MessageSchema.from_orm(row) for row in rows])
+    content = asyncio.run(serialize_response(field=response_field, response_content=result))
+    return JSONResponse(content).body
+
+
+def orjson_path(rows: list[SimpleNamespace]) -> bytes:
+    result = ListMessageSchema.construct(data=[get_message_schema(row) for row in rows])
+    return MessagesResponse(result).body
+
+
+def measure(function, rows: list[SimpleNamespace], repeat: int) -> list[float]:
+    timings = []
+    for _ in range(repeat):
+        start = perf_counter()
+        function(rows)
+        timings.append(perf_counter() - start)
+    return timings
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serialization cost of consumed messages.")
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    rows = build_rows(args.messages)
+    for name, function in (("response_model", response_model_path), ("orjson", orjson_path)):
+        timings = measure(function, rows, args.repeat)
+        per_thousand = statistics.median(timings) * 1000 / args.messages
+        print(f"{name:<16} messages={args.messages} median per 1000 messages={per_thousand * 1000:.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+# Throughput and latency of publish, consume, ack and cleanup, through the services and through the HTTP API,
+# for every combination of message size, fan-out and consumer concurrency. The results are saved as JSON so
+# two runs (for example two releases) can be compared with --baseline.
+#
+# It recreates the schema on fastqueue_database_url, so always point it to a scratch database:
+#
+#   fastqueue_database_url=postgresql+psycopg2://... python -m benchmarks.throughput \
+#       --message-sizes 100 10000 --fanouts 1 10 --concurrency 1 8 --output results.json
+#
+# The HTTP API runs in this process with httpx, unless --server-url points to a running server using the
+# same database.
+import argparse
+import asyncio
+import itertools
+import json
+import statistics
+import subprocess
+import threading
+from collections.abc import Callable
+from datetime import datetime
+from time import perf_counter
+from typing import Any
+
+import httpx
+from sqlalchemy import text
+
+from fastqueue.api import app
+from fastqueue.cache import routing_cache, stats_cache
+from fastqueue.database import async_engine, Base, engine, SessionLocal
+from fastqueue.schemas import CreateMessageSchema
+from fastqueue.services import MessageService, QueueService
+
+
+def populate(num_topics: int, fanout: int) -> list[tuple[str, list[str]]]:
+    # every topic has fanout queues, the messages are published round robin to the topics
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    routing_cache.clear()
+    stats_cache.clear()
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                "INSERT INTO topics (id, created_at) "
+                "SELECT 'topic_' || t, now() FROM generate_series(0, :num_topics - 1) AS t;"
+                "INSERT INTO queues (id, topic_id, ack_deadline_seconds, message_retention_seconds, "
+                "created_at, updated_at) "
+                "SELECT 'queue_' || t || '_' || q, 'topic_' || t, 60, 1209600, now(), now() "
+                "FROM generate_series(0, :num_topics - 1) AS t, generate_series(0, :fanout - 1) AS q"
+            ),
+            {"num_topics": num_topics, "fanout": fanout},
+        )
+    return [(f"topic_{t}", [f"queue_{t}_{q}" for q in range(fanout)]) for t in range(num_topics)]
+
+
+def make_data(message_size: int) -> dict:
+    return {"message": "x" * max(message_size - len('{"message": ""}'), 0)}
+
+
+def summarize(operation: str, latencies: list[float], num_messages: int | None, elapsed: float) -> dict:
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        "operation": operation,
+        "requests": len(latencies),
+        "messages": num_messages,
+        "seconds": round(elapsed, 4),
+        "messages_per_second": round(num_messages / elapsed, 1) if num_messages is not None else None,
+        "p50_ms": round(quantiles[49] * 1000, 3),
+        "p99_ms": round(quantiles[98] * 1000, 3),
+    }
+
+
+def run_threads(concurrency: int, target: Callable[[int], None]) -> float:
+    threads = [threading.Thread(target=target, args=(i,)) for i in range(concurrency)]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return perf_counter() - start
+
+
+def bench_service(
+    topics: list[tuple[str, list[str]]], data: dict, num_messages: int, concurrency: int, limit: int
+) -> list[dict]:
+    queue_ids = [queue_id for _, queues in topics for queue_id in queues]
+    latencies: dict[str, list[float]] = {"publish": [], "consume": [], "ack": [], "cleanup": []}
+    consumed = [0] * concurrency
+    message = CreateMessageSchema(data=data)
+
+    def publish(worker: int) -> None:
+        with SessionLocal() as session:
+            service = MessageService(session=session)
+            for i in range(worker, num_messages, concurrency):
+                start = perf_counter()
+                service.create(topic_id=topics[i % len(topics)][0], data=message)
+                latencies["publish"].append(perf_counter() - start)
+
+    def consume(worker: int) -> None:
+        # each worker drains its share of the queues, acking every message one by one
+        with SessionLocal() as session:
+            service = MessageService(session=session)
+            for queue_id in queue_ids[worker::concurrency]:
+                while True:
+                    start = perf_counter()
+                    result = service.list_for_consume(queue_id=queue_id, limit=limit)
+                    latencies["consume"].append(perf_counter() - start)
+                    if not result.data:
+                        break
+                    consumed[worker] += len(result.data)
+                    for item in result.data:
+                        start = perf_counter()
+                        service.ack(id=item.id)
+                        latencies["ack"].append(perf_counter() - start)
+
+    def cleanup(worker: int) -> None:
+        with SessionLocal() as session:
+            service = QueueService(session=session)
+            for queue_id in queue_ids[worker::concurrency]:
+                start = perf_counter()
+                service.cleanup(id=queue_id)
+                latencies["cleanup"].append(perf_counter() - start)
+
+    publish_seconds = run_threads(concurrency, publish)
+    consume_seconds = run_threads(concurrency, consume)
+    cleanup_seconds = run_threads(concurrency, cleanup)
+    return [
+        summarize("publish", latencies["publish"], num_messages, publish_seconds),
+        summarize("consume", latencies["consume"], sum(consumed), consume_seconds),
+        summarize("ack", latencies["ack"], len(latencies["ack"]), consume_seconds),
+        # the messages are already acked, it measures the cost of a cleanup pass over a busy table
+        summarize("cleanup", latencies["cleanup"], None, cleanup_seconds),
+    ]
+
+
+async def bench_http(
+    topics: list[tuple[str, list[str]]],
+    data: dict,
+    num_messages: int,
+    concurrency: int,
+    limit: int,
+    server_url: str | None,
+) -> list[dict]:
+    # the api has no cleanup endpoint, the cleanup is only measured through the services
+    queue_ids = [queue_id for _, queues in topics for queue_id in queues]
+    latencies: dict[str, list[float]] = {"publish": [], "consume": [], "ack": []}
+    consumed = [0] * concurrency
+    if server_url is None:
+        client = httpx.AsyncClient(app=app, base_url="http://fastqueue")
+    else:
+        client = httpx.AsyncClient(base_url=server_url)
+
+    async def request(operation: str, method: str, url: str, **kwargs: Any) -> Any:
+        start = perf_counter()
+        response = await client.request(method, url, **kwargs)
+        latencies[operation].append(perf_counter() - start)
+        response.raise_for_status()
+        return response
+
+    async def publish(worker: int) -> None:
+        for i in range(worker, num_messages, concurrency):
+            await request(
+                "publish", "POST", f"/topics/{topics[i % len(topics)][0]}/messages", json={"data": data}
+            )
+
+    async def consume(worker: int) -> None:
+        for queue_id in queue_ids[worker::concurrency]:
+            while True:
+                response = await request(
+                    "consume", "GET", f"/queues/{queue_id}/messages", params={"limit": limit}
+                )
+                messages = response.json()["data"]
+                if not messages:
+                    break
+                consumed[worker] += len(messages)
+                for item in messages:
+                    await request("ack", "PUT", f"/messages/{item['id']}/ack")
+
+    async def run_tasks(target: Callable[[int], Any]) -> float:
+        start = perf_counter()
+        await asyncio.gather(*(target(i) for i in range(concurrency)))
+        return perf_counter() - start
+
+    async with client:
+        # the first connection of the in process server is opened before the concurrent requests, sqlalchemy
+        # initializes the dialect on it while holding a lock
+        (await client.get("/health")).raise_for_status()
+        publish_seconds = await run_tasks(publish)
+        consume_seconds = await run_tasks(consume)
+    # the connections of the in process server are bound to this event loop
+    await async_engine.dispose()
+    return [
+        summarize("publish", latencies["publish"], num_messages, publish_seconds),
+        summarize("consume", latencies["consume"], sum(consumed), consume_seconds),
+        summarize("ack", latencies["ack"], len(latencies["ack"]), consume_seconds),
+    ]
+
+
+def get_revision() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(result: dict) -> tuple:
+    return tuple(result[name] for name in ("interface", "message_size", "fanout", "concurrency", "operation"))
+
+
+def compare(results: list[dict], baseline_path: str) -> None:
+    with open(baseline_path) as f:
+        baseline = {result_key(result): result for result in json.load(f)["results"]}
+    print(f"\ncompared with {baseline_path} (positive is slower)")
+    for result in results:
+        previous = baseline.get(result_key(result))
+        if previous is None:
+            continue
+        changes = []
+        for name in ("p50_ms", "p99_ms"):
+            if previous[name]:
+                changes.append(f"{name}={(result[name] / previous[name] - 1) * 100:+.1f}%")
+        if previous["messages_per_second"] and result["messages_per_second"]:
+            change = (previous["messages_per_second"] / result["messages_per_second"] - 1) * 100
+            changes.append(f"messages_per_second={change:+.1f}%")
+        print(f"{' '.join(str(value) for value in result_key(result)):<40} {' '.join(changes)}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Publish, consume, ack and cleanup throughput and latency.")
+    parser.add_argument("--interfaces", nargs="+", choices=["service", "http"], default=["service", "http"])
+    parser.add_argument("--message-sizes", nargs="+", type=int, default=[100, 10000])
+    parser.add_argument("--fanouts", nargs="+", type=int, default=[1, 10])
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8])
+    parser.add_argument("--topics", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=1000, help="messages published per run")
+    parser.add_argument("--limit", type=int, default=10, help="messages per consume request")
+    parser.add_argument("--server-url", default=None)
+    parser.add_argument("--output", default=None, help="path of the JSON results")
+    parser.add_argument("--baseline", default=None, help="JSON results of a previous run to compare with")
+    args = parser.parse_args()
+
+    results = []
+    for interface, message_size, fanout, concurrency in itertools.product(
+        args.interfaces, args.message_sizes, args.fanouts, args.concurrency
+    ):
+        topics = populate(num_topics=args.topics, fanout=fanout)
+        data = make_data(message_size)
+        if interface == "service":
+            rows = bench_service(topics, data, args.messages, concurrency, args.limit)
+        else:
+            rows = asyncio.run(
+                bench_http(topics, data, args.messages, concurrency, args.limit, args.server_url)
+            )
+        scenario = {
+            "interface": interface,
+            "message_size": message_size,
+            "fanout": fanout,
+            "topics": args.topics,
+            "queues": args.topics * fanout,
+            "concurrency": concurrency,
+        }
+        for row in rows:
+            results.append({**scenario, **row})
+            print(
+                f"{interface:<8} size={message_size:<6} fanout={fanout:<3} concurrency={concurrency:<3} "
+                f"{row['operation']:<8} messages/s={row['messages_per_second']} "
+                f"p50={row['p50_ms']}ms p99={row['p99_ms']}ms"
+            )
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(
+                {"revision": get_revision(), "created_at": datetime.utcnow().isoformat(), "results": results},
+                f,
+                indent=2,
+            )
+    if args.baseline is not None:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,49 @@
+import asyncio
+from typing import Any
+from uuid import UUID
+
+import orjson
 import uvicorn
-from fastapi import Depends, FastAPI, Request, status
+from fastapi import Depends, FastAPI, Query, Request, status, WebSocket, WebSocketDisconnect
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from prometheus_fastapi_instrumentator import Instrumentator
-from sqlalchemy.orm import Session
+from pydantic import BaseModel, parse_obj_as
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from fastqueue.config import settings
-from fastqueue.database import SessionLocal
+from fastqueue.database import async_engine, AsyncSessionLocal
 from fastqueue.exceptions import AlreadyExistsError, NotFoundError
+from fastqueue.metrics import track_request_queries
+from fastqueue.notifications import listener
 from fastqueue.schemas import (
+    AckDeadlineSchema,
+    CreateMessageBatchSchema,
     CreateMessageSchema,
     CreateQueueSchema,
     CreateTopicSchema,
     HealthSchema,
+    IngestResultSchema,
+    ListMessageBatchSchema,
     ListMessageSchema,
     ListQueueSchema,
+    ListQueueStatsSchema,
     ListTopicSchema,
+    MessageIdsResultSchema,
+    MessageIdsSchema,
+    ModifyAckDeadlineSchema,
+    NackMessageIdsSchema,
     NotFoundSchema,
     QueueSchema,
     QueueStatsSchema,
     RedriveQueueSchema,
+    StreamMessageIdsResultSchema,
+    StreamMessagesSchema,
+    StreamRequestSchema,
     TopicSchema,
     UpdateQueueSchema,
 )
-from fastqueue.services import HealthService, MessageService, QueueService, TopicService
+from fastqueue.services import AsyncHealthService, AsyncMessageService, AsyncQueueService, AsyncTopicService
 
 tags_metadata = [
     {
@@ -47,35 +67,67 @@ app = FastAPI(
 )
 
 
-def get_session():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+def serialize_default(obj: Any) -> Any:
+    # called by orjson for the types it doesn't know, asyncpg returns its own uuid subclass
+    if isinstance(obj, BaseModel):
+        return obj.__dict__
+    if isinstance(obj, UUID):
+        return str(obj)
+    raise TypeError
+
+
+class MessagesResponse(Response):
+    # the message schemas are built from validated requests or database rows, so they are rendered straight
+    # to json, without the response_model validation and jsonable_encoder passes
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=serialize_default)
+
+
+async def get_session():
+    async with AsyncSessionLocal() as session:
+        yield session
+
+
+@app.middleware("http")
+async def track_queries(request: Request, call_next):
+    def get_route():
+        route = request.scope.get("route")
+        return f"{request.method} {route.path}" if route is not None else "unmatched"
+
+    with track_request_queries(get_route):
+        return await call_next(request)
 
 
 @app.on_event("startup")
 async def startup():
+    # start waits for the listener connection, it runs in a thread to not block the event loop
+    await asyncio.to_thread(listener.start)
     if not settings.enable_prometheus_metrics:
         return
     Instrumentator().instrument(app).expose(app)
 
 
+@app.on_event("shutdown")
+async def shutdown():
+    await async_engine.dispose()
+
+
 @app.exception_handler(AlreadyExistsError)
-def already_exists_exception_handler(request: Request, exc: AlreadyExistsError):
+async def already_exists_exception_handler(request: Request, exc: AlreadyExistsError):
     return JSONResponse(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, content={"detail": exc.args[0]})
 
 
 @app.exception_handler(NotFoundError)
-def not_found_exception_handler(request: Request, exc: NotFoundError):
+async def not_found_exception_handler(request: Request, exc: NotFoundError):
     response = jsonable_encoder(NotFoundSchema(detail=exc.args[0]))
     return JSONResponse(status_code=status.HTTP_404_NOT_FOUND, content=response)
 
 
 @app.post("/topics", response_model=TopicSchema, status_code=status.HTTP_201_CREATED, tags=["topics"])
-def create_topic(data: CreateTopicSchema, session: Session = Depends(get_session)):
-    return TopicService(session=session).create(data=data)
+async def create_topic(data: CreateTopicSchema, session: AsyncSession = Depends(get_session)):
+    return await AsyncTopicService(session=session).create(data=data)
 
 
 @app.get(
@@ -85,8 +137,8 @@ def create_topic(data: CreateTopicSchema, session: Session = Depends(get_session
     tags=["topics"],
     responses={404: {"model": NotFoundSchema}},
 )
-def get_topic(topic_id: str, session: Session = Depends(get_session)):
-    return TopicService(session=session).get(id=topic_id)
+async def get_topic(topic_id: str, session: AsyncSession = Depends(get_session)):
+    return await AsyncTopicService(session=session).get(id=topic_id)
 
 
 @app.delete(
@@ -95,18 +147,37 @@ def get_topic(topic_id: str, session: Session = Depends(get_session)):
     tags=["topics"],
     responses={404: {"model": NotFoundSchema}},
 )
-def delete_topic(topic_id: str, session: Session = Depends(get_session)):
-    return TopicService(session=session).delete(id=topic_id)
+async def delete_topic(topic_id: str, session: AsyncSession = Depends(get_session)):
+    return await AsyncTopicService(session=session).delete(id=topic_id)
 
 
 @app.get("/topics", response_model=ListTopicSchema, status_code=status.HTTP_200_OK, tags=["topics"])
-def list_topics(offset: int = 0, limit: int = 10, session: Session = Depends(get_session)):
-    return TopicService(session=session).list(filters=None, offset=offset, limit=limit)
+async def list_topics(
+    offset: int = Query(0, ge=0),
+    limit: int = Query(10, ge=1),
+    after: str | None = None,
+    prefix: str | None = None,
+    session: AsyncSession = Depends(get_session),
+):
+    return await AsyncTopicService(session=session).list(
+        filters=None, offset=offset, limit=limit, after=after, prefix=prefix
+    )
 
 
 @app.post("/queues", response_model=QueueSchema, status_code=status.HTTP_201_CREATED, tags=["queues"])
-def create_queue(data: CreateQueueSchema, session: Session = Depends(get_session)):
-    return QueueService(session=session).create(data=data)
+async def create_queue(data: CreateQueueSchema, session: AsyncSession = Depends(get_session)):
+    return await AsyncQueueService(session=session).create(data=data)
+
+
+@app.get(
+    "/queues/stats", response_model=ListQueueStatsSchema, status_code=status.HTTP_200_OK, tags=["queues"]
+)
+async def list_queue_stats(
+    queue_id: list[str] | None = Query(None),
+    topic_id: str | None = None,
+    session: AsyncSession = Depends(get_session),
+):
+    return await AsyncQueueService(session=session).list_stats(queue_ids=queue_id, topic_id=topic_id)
 
 
 @app.get(
@@ -116,8 +187,8 @@ def create_queue(data: CreateQueueSchema, session: Session = Depends(get_session
     tags=["queues"],
     responses={404: {"model": NotFoundSchema}},
 )
-def get_queue(queue_id: str, session: Session = Depends(get_session)):
-    return QueueService(session=session).get(id=queue_id)
+async def get_queue(queue_id: str, session: AsyncSession = Depends(get_session)):
+    return await AsyncQueueService(session=session).get(id=queue_id)
 
 
 @app.put(
@@ -127,8 +198,8 @@ def get_queue(queue_id: str, session: Session = Depends(get_session)):
     tags=["queues"],
     responses={404: {"model": NotFoundSchema}},
 )
-def update_queue(queue_id: str, data: UpdateQueueSchema, session: Session = Depends(get_session)):
-    return QueueService(session=session).update(id=queue_id, data=data)
+async def update_queue(queue_id: str, data: UpdateQueueSchema, session: AsyncSession = Depends(get_session)):
+    return await AsyncQueueService(session=session).update(id=queue_id, data=data)
 
 
 @app.get(
@@ -138,8 +209,8 @@ def update_queue(queue_id: str, data: UpdateQueueSchema, session: Session = Depe
     tags=["queues"],
     responses={404: {"model": NotFoundSchema}},
 )
-def get_queue_stats(queue_id: str, session: Session = Depends(get_session)):
-    return QueueService(session=session).stats(id=queue_id)
+async def get_queue_stats(queue_id: str, session: AsyncSession = Depends(get_session)):
+    return await AsyncQueueService(session=session).stats(id=queue_id)
 
 
 @app.put(
@@ -148,8 +219,8 @@ def get_queue_stats(queue_id: str, session: Session = Depends(get_session)):
     tags=["queues"],
     responses={404: {"model": NotFoundSchema}},
 )
-def purge_queue_messages(queue_id: str, session: Session = Depends(get_session)):
-    return QueueService(session=session).purge(id=queue_id)
+async def purge_queue_messages(queue_id: str, session: AsyncSession = Depends(get_session)):
+    return await AsyncQueueService(session=session).purge(id=queue_id)
 
 
 @app.put(
@@ -158,8 +229,10 @@ def purge_queue_messages(queue_id: str, session: Session = Depends(get_session))
     tags=["queues"],
     responses={404: {"model": NotFoundSchema}},
 )
-def redrive_queue_messages(queue_id: str, data: RedriveQueueSchema, session: Session = Depends(get_session)):
-    return QueueService(session=session).redrive(id=queue_id, data=data)
+async def redrive_queue_messages(
+    queue_id: str, data: RedriveQueueSchema, session: AsyncSession = Depends(get_session)
+):
+    return await AsyncQueueService(session=session).redrive(id=queue_id, data=data)
 
 
 @app.delete(
@@ -168,13 +241,21 @@ def redrive_queue_messages(queue_id: str, data: RedriveQueueSchema, session: Ses
     tags=["queues"],
     responses={404: {"model": NotFoundSchema}},
 )
-def delete_queue(queue_id: str, session: Session = Depends(get_session)):
-    return QueueService(session=session).delete(id=queue_id)
+async def delete_queue(queue_id: str, session: AsyncSession = Depends(get_session)):
+    return await AsyncQueueService(session=session).delete(id=queue_id)
 
 
 @app.get("/queues", response_model=ListQueueSchema, status_code=status.HTTP_200_OK, tags=["queues"])
-def list_queues(offset: int = 0, limit: int = 10, session: Session = Depends(get_session)):
-    return QueueService(session=session).list(filters=None, offset=offset, limit=limit)
+async def list_queues(
+    offset: int = Query(0, ge=0),
+    limit: int = Query(10, ge=1),
+    after: str | None = None,
+    prefix: str | None = None,
+    session: AsyncSession = Depends(get_session),
+):
+    return await AsyncQueueService(session=session).list(
+        filters=None, offset=offset, limit=limit, after=after, prefix=prefix
+    )
 
 
 @app.post(
@@ -184,8 +265,47 @@ def list_queues(offset: int = 0, limit: int = 10, session: Session = Depends(get
     tags=["messages"],
     responses={404: {"model": NotFoundSchema}},
 )
-def create_message(topic_id: str, data: CreateMessageSchema, session: Session = Depends(get_session)):
-    return MessageService(session=session).create(topic_id=topic_id, data=data)
+async def create_message(
+    topic_id: str, data: CreateMessageSchema, session: AsyncSession = Depends(get_session)
+):
+    response = await AsyncMessageService(session=session).create(topic_id=topic_id, data=data)
+    return MessagesResponse(response, status_code=status.HTTP_201_CREATED)
+
+
+@app.post(
+    "/topics/{topic_id}/messages/batch",
+    response_model=ListMessageBatchSchema,
+    status_code=status.HTTP_201_CREATED,
+    tags=["messages"],
+    responses={404: {"model": NotFoundSchema}},
+)
+async def create_message_batch(
+    topic_id: str, data: CreateMessageBatchSchema, session: AsyncSession = Depends(get_session)
+):
+    response = await AsyncMessageService(session=session).create_batch(topic_id=topic_id, data=data)
+    return MessagesResponse(response, status_code=status.HTTP_201_CREATED)
+
+
+@app.post(
+    "/topics/{topic_id}/messages/ingest",
+    response_model=IngestResultSchema,
+    status_code=status.HTTP_200_OK,
+    tags=["messages"],
+    responses={404: {"model": NotFoundSchema}},
+    openapi_extra={
+        "requestBody": {
+            "content": {"application/x-ndjson": {"schema": {"type": "string"}}},
+            "required": True,
+        }
+    },
+)
+async def ingest_messages(topic_id: str, request: Request, session: AsyncSession = Depends(get_session)):
+    result = await AsyncMessageService(session=session).ingest(topic_id=topic_id, chunks=request.stream())
+    if result.error is not None:
+        return JSONResponse(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, content=jsonable_encoder(result)
+        )
+    return result
 
 
 @app.get(
@@ -195,18 +315,84 @@ def create_message(topic_id: str, data: CreateMessageSchema, session: Session =
     tags=["messages"],
     responses={404: {"model": NotFoundSchema}},
 )
-def list_messages_for_consume(queue_id: str, limit: int = 10, session: Session = Depends(get_session)):
-    return MessageService(session=session).list_for_consume(queue_id=queue_id, limit=limit)
+async def list_messages_for_consume(
+    queue_id: str,
+    limit: int = 10,
+    wait_seconds: int = Query(0, ge=0, le=settings.max_wait_seconds),
+    session: AsyncSession = Depends(get_session),
+):
+    response = await AsyncMessageService(session=session).list_for_consume(
+        queue_id=queue_id, limit=limit, wait_seconds=wait_seconds
+    )
+    return MessagesResponse(response, status_code=status.HTTP_200_OK)
+
+
+@app.websocket("/queues/{queue_id}/messages/stream")
+async def stream_messages_for_consume(websocket: WebSocket, queue_id: str):
+    async def receive():
+        return parse_obj_as(StreamRequestSchema, await websocket.receive_json())
+
+    async def send(data: StreamMessagesSchema | StreamMessageIdsResultSchema):
+        await websocket.send_text(orjson.dumps(data, default=serialize_default).decode())
+
+    await websocket.accept()
+    async with AsyncSessionLocal() as session:
+        try:
+            await AsyncMessageService(session=session).stream(queue_id=queue_id, receive=receive, send=send)
+        except WebSocketDisconnect:
+            pass
+        except NotFoundError as exc:
+            await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=exc.args[0])
+        except ValueError:
+            # invalid json or request schema
+            await websocket.close(code=status.WS_1003_UNSUPPORTED_DATA, reason="Invalid stream request")
+
+
+@app.put(
+    "/messages/ack", response_model=MessageIdsResultSchema, status_code=status.HTTP_200_OK, tags=["messages"]
+)
+async def ack_message_batch(data: MessageIdsSchema, session: AsyncSession = Depends(get_session)):
+    return await AsyncMessageService(session=session).ack_batch(data=data)
+
+
+@app.put(
+    "/messages/nack", response_model=MessageIdsResultSchema, status_code=status.HTTP_200_OK, tags=["messages"]
+)
+async def nack_message_batch(data: NackMessageIdsSchema, session: AsyncSession = Depends(get_session)):
+    return await AsyncMessageService(session=session).nack_batch(data=data, delay_seconds=data.delay_seconds)
+
+
+@app.put(
+    "/messages/ack-deadline",
+    response_model=MessageIdsResultSchema,
+    status_code=status.HTTP_200_OK,
+    tags=["messages"],
+)
+async def modify_message_batch_ack_deadline(
+    data: ModifyAckDeadlineSchema, session: AsyncSession = Depends(get_session)
+):
+    return await AsyncMessageService(session=session).modify_ack_deadline_batch(data=data)
 
 
 @app.put("/messages/{message_id}/ack", status_code=status.HTTP_204_NO_CONTENT, tags=["messages"])
-def ack_message(message_id: str, session: Session = Depends(get_session)):
-    return MessageService(session=session).ack(id=message_id)
+async def ack_message(message_id: str, session: AsyncSession = Depends(get_session)):
+    return await AsyncMessageService(session=session).ack(id=message_id)
 
 
 @app.put("/messages/{message_id}/nack", status_code=status.HTTP_204_NO_CONTENT, tags=["messages"])
-def nack_message(message_id: str, session: Session = Depends(get_session)):
-    return MessageService(session=session).nack(id=message_id)
+async def nack_message(
+    message_id: str,
+    delay_seconds: int | None = Query(None, ge=0, le=settings.max_delivery_delay_seconds),
+    session: AsyncSession = Depends(get_session),
+):
+    return await AsyncMessageService(session=session).nack(id=message_id, delay_seconds=delay_seconds)
+
+
+@app.put("/messages/{message_id}/ack-deadline", status_code=status.HTTP_204_NO_CONTENT, tags=["messages"])
+async def modify_message_ack_deadline(
+    message_id: str, data: AckDeadlineSchema, session: AsyncSession = Depends(get_session)
+):
+    return await AsyncMessageService(session=session).modify_ack_deadline(id=message_id, data=data)
 
 
 @app.get(
@@ -216,8 +402,8 @@ def nack_message(message_id: str, session: Session = Depends(get_session)):
     tags=["healthcheck"],
     responses={500: {"model": HealthSchema}},
 )
-def health(session: Session = Depends(get_session)):
-    response = HealthService(session=session).check()
+async def health(session: AsyncSession = Depends(get_session)):
+    response = await AsyncHealthService(session=session).check()
     status_code = status.HTTP_200_OK if response.success else status.HTTP_500_INTERNAL_SERVER_ERROR
     return JSONResponse(status_code=status_code, content=jsonable_encoder(response))
 
@@ -0,0 +1,100 @@
+import threading
+from collections import OrderedDict
+from collections.abc import Hashable, Iterable
+from time import monotonic
+from typing import Any
+
+from fastqueue.config import settings
+from fastqueue.notifications import listener
+
+cache_channel = "fastqueue_cache"
+
+
+class TTLCache:
+    def __init__(self, ttl_seconds: float, max_size: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+        # bumped by delete and clear, so a value loaded before an invalidation is not stored after it
+        self._generation = 0
+        self._key_generations: dict[Hashable, int] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl_seconds > 0 and self.max_size > 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires_at, value = item
+            if expires_at <= monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def generation(self, key: Hashable) -> tuple[int, int]:
+        with self._lock:
+            return self._generation, self._key_generations.get(key, 0)
+
+    def set(self, key: Hashable, value: Any, generation: tuple[int, int] | None = None) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            current_generation = (self._generation, self._key_generations.get(key, 0))
+            if generation is not None and generation != current_generation:
+                return
+            self._data[key] = (monotonic() + self.ttl_seconds, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        self.delete_many([key])
+
+    def delete_many(self, keys: Iterable[Hashable]) -> None:
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+                self._key_generations[key] = self._key_generations.get(key, 0) + 1
+            # the key generations are bounded by the cache size, past it a new generation invalidates all
+            # the loads in progress instead
+            if len(self._key_generations) > self.max_size:
+                self._generation += 1
+                self._key_generations.clear()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._generation += 1
+            self._key_generations.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+def topic_key(topic_id: str) -> str:
+    return f"topic:{topic_id}"
+
+
+def queue_key(queue_id: str) -> str:
+    return f"queue:{queue_id}"
+
+
+def invalidate_routing_cache(key: str | None) -> None:
+    # None means that notifications may have been lost
+    if key is None:
+        routing_cache.clear()
+    else:
+        routing_cache.delete(key)
+
+
+routing_cache = TTLCache(
+    ttl_seconds=settings.routing_cache_ttl_seconds, max_size=settings.routing_cache_max_size
+)
+listener.add_handler(cache_channel, invalidate_routing_cache)
+# the stats are not invalidated, they are only kept for a short time
+stats_cache = TTLCache(ttl_seconds=settings.queue_stats_cache_ttl_seconds, max_size=1000)
@@ -0,0 +1,28 @@
+import json
+import zlib
+
+from fastqueue.config import settings
+from fastqueue.metrics import message_compression_ratio, message_data_bytes
+
+
+def compress_data(data: dict) -> bytes | None:
+    # returns None when the data is kept as plain jsonb: compression is disabled, the data is smaller than
+    # the threshold or it doesn't get smaller
+    if not settings.enable_message_compression:
+        return None
+
+    raw = json.dumps(data, separators=(",", ":")).encode()
+    if len(raw) < settings.message_compression_min_size_bytes:
+        return None
+
+    compressed = zlib.compress(raw, settings.message_compression_level)
+    message_data_bytes.labels(state="raw").inc(len(raw))
+    message_data_bytes.labels(state="compressed").inc(min(len(compressed), len(raw)))
+    message_compression_ratio.observe(len(compressed) / len(raw))
+    if len(compressed) >= len(raw):
+        return None
+    return compressed
+
+
+def decompress_data(compressed: bytes) -> dict:
+    return json.loads(zlib.decompress(compressed))
@@ -18,7 +18,15 @@ class Settings(BaseSettings):
 
     # postgresql settings
     database_url: str
+    database_async_url: str | None = None
     database_echo: bool = False
+    database_pool_size: int = 5
+    database_max_overflow: int = 10
+    database_pool_timeout_seconds: float = 30
+    database_pool_recycle_seconds: int = -1
+    database_pool_pre_ping: bool = False
+    database_pgbouncer_mode: bool = False
+    database_slow_query_seconds: float = 0
 
     # queue settings
     min_ack_deadline_seconds: int = 1
@@ -28,11 +36,33 @@ class Settings(BaseSettings):
     min_message_max_deliveries: int = 1
     max_message_max_deliveries: int = 1000
     queue_cleanup_interval_seconds: int = 60
+    queue_cleanup_chunk_size: int = 1000
+    queue_cleanup_concurrency: int = 4
+    enable_messages_partitioning: bool = False
+    messages_partition_interval_seconds: int = 86400
+    messages_hash_partitions: int = 0
     min_delivery_delay_seconds: int = 1
     max_delivery_delay_seconds: int = 900
+    min_retry_backoff_seconds: int = 1
+    max_retry_backoff_seconds: int = 3600
+    max_batch_size: int = 1000
+    max_wait_seconds: int = 20
+    ingest_batch_size: int = 1000
+    max_ingest_line_bytes: int = 1048576
+    max_ingest_errors: int = 100
+    routing_cache_ttl_seconds: float = 30
+    routing_cache_max_size: int = 10000
+    enable_queue_counters: bool = False
+    queue_counters_reconcile_interval_seconds: int = 60
+    queue_stats_cache_ttl_seconds: float = 5
+    enable_message_compression: bool = False
+    message_compression_min_size_bytes: int = 4096
+    message_compression_level: int = 6
 
     # prometheus metrics
     enable_prometheus_metrics: bool = False
+    metrics_max_queue_labels: int = 1000
+    worker_metrics_port: int = 8001
 
     class Config:
         env_file = ".env"
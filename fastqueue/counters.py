@@ -0,0 +1,228 @@
+from collections.abc import Iterable
+from datetime import datetime
+from typing import Any
+
+from sqlalchemy import and_, bindparam, case, DateTime, func, Integer, literal, or_, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from fastqueue.config import settings
+from fastqueue.models import Message, Queue, QueueCounter
+
+counter_columns = ("num_ready", "num_in_flight", "num_delayed")
+
+
+def get_ready_filter(now: datetime) -> Any:
+    # the same conditions as get_filters_for_consume, with the queue columns joined
+    return and_(
+        Message.scheduled_at <= now,
+        or_(
+            Queue.dead_queue_id.is_(None),
+            Queue.message_max_deliveries.is_(None),
+            Message.delivery_attempts < Queue.message_max_deliveries,
+        ),
+    )
+
+
+def get_message_state(scheduled_at: datetime, delivery_attempts: int, now: datetime) -> str:
+    if scheduled_at <= now:
+        return "num_ready"
+    if delivery_attempts > 0:
+        return "num_in_flight"
+    return "num_delayed"
+
+
+def get_counted_state(
+    scheduled_at: datetime, delivery_attempts: int, updated_at: datetime, reconciled_at: datetime | None
+) -> str:
+    # the counters hold a message in the state that it had when it was written, or when its queue was
+    # reconciled after that, so a message whose delay or ack deadline ended since is still counted there
+    counted_at = updated_at if reconciled_at is None else max(updated_at, reconciled_at)
+    return get_message_state(scheduled_at, delivery_attempts, counted_at)
+
+
+class QueueCounterDeltas:
+    # collects the counter changes of a transaction, which are applied with one executemany before the
+    # commit; the counters follow the state that the messages had when they were written, so messages that
+    # change state by time (delays and ack deadlines) are fixed by the reconciliation task
+    def __init__(self):
+        self._deltas: dict[str, dict[str, Any]] = {}
+
+    def __bool__(self) -> bool:
+        return bool(self._deltas)
+
+    def add(
+        self,
+        queue_id: str,
+        column: str,
+        value: int = 1,
+        created_at: datetime | None = None,
+    ) -> None:
+        delta = self._deltas.setdefault(
+            queue_id,
+            {"num_ready": 0, "num_in_flight": 0, "num_delayed": 0, "added_at": None, "removed_at": None},
+        )
+        delta[column] += value
+        if column != "num_ready" or created_at is None:
+            return
+        key = "added_at" if value > 0 else "removed_at"
+        if delta[key] is None or created_at < delta[key]:
+            delta[key] = created_at
+
+    def move(
+        self,
+        queue_id: str,
+        source: str,
+        destination: str,
+        value: int = 1,
+        created_at: datetime | None = None,
+    ) -> None:
+        self.add(queue_id, source, -value, created_at=created_at)
+        self.add(queue_id, destination, value, created_at=created_at)
+
+    def remove(self, queue_id: str, counts: Any) -> None:
+        for column in counter_columns:
+            created_at = counts.min_ready_created_at if column == "num_ready" else None
+            if getattr(counts, column):
+                self.add(queue_id, column, -getattr(counts, column), created_at=created_at)
+
+    def apply(self, session: Session, now: datetime) -> None:
+        if not settings.enable_queue_counters or not self._deltas:
+            return
+
+        table = QueueCounter.__table__
+        oldest = table.c.oldest_message_created_at
+        added_at = bindparam("b_added_at", type_=DateTime)
+        removed_at = bindparam("b_removed_at", type_=DateTime)
+        num_ready = bindparam("b_num_ready", type_=Integer)
+        statement = (
+            update(table)
+            .where(table.c.queue_id == bindparam("b_queue_id"))
+            .values(
+                num_ready=table.c.num_ready + num_ready,
+                num_in_flight=table.c.num_in_flight + bindparam("b_num_in_flight", type_=Integer),
+                num_delayed=table.c.num_delayed + bindparam("b_num_delayed", type_=Integer),
+                # null with ready messages means unknown, and it is loaded again by the next stats call
+                oldest_message_created_at=case(
+                    (and_(removed_at.is_not(None), oldest >= removed_at), None),
+                    (table.c.num_ready <= 0, added_at),
+                    (oldest.is_(None), None),
+                    else_=func.least(oldest, added_at),
+                ),
+                updated_at=bindparam("b_now", type_=DateTime),
+            )
+        )
+        # a stable order avoids deadlocks between transactions that update the same counters
+        params = [
+            {
+                "b_queue_id": queue_id,
+                "b_num_ready": delta["num_ready"],
+                "b_num_in_flight": delta["num_in_flight"],
+                "b_num_delayed": delta["num_delayed"],
+                "b_added_at": delta["added_at"],
+                "b_removed_at": delta["removed_at"],
+                "b_now": now,
+            }
+            for queue_id, delta in sorted(self._deltas.items())
+        ]
+        session.execute(statement, params)
+        self._deltas.clear()
+
+
+def count_messages_by_state(session: Session, messages: Any, queue: Any) -> Any:
+    # messages is a cte with the scheduled_at, delivery_attempts, created_at and updated_at of deleted or
+    # moved messages as they were before the change, counted in the state of get_counted_state
+    reconciled_at = select(QueueCounter.reconciled_at).where(QueueCounter.queue_id == queue.id)
+    counted_at = func.greatest(messages.c.updated_at, reconciled_at.scalar_subquery())
+    ready_filter = messages.c.scheduled_at <= counted_at
+    if queue.dead_queue_id is not None and queue.message_max_deliveries is not None:
+        ready_filter = and_(ready_filter, messages.c.delivery_attempts < queue.message_max_deliveries)
+    pending_filter = messages.c.scheduled_at > counted_at
+    statement = select(
+        func.count().label("count"),
+        func.count().filter(ready_filter).label("num_ready"),
+        func.count().filter(and_(pending_filter, messages.c.delivery_attempts > 0)).label("num_in_flight"),
+        func.count().filter(and_(pending_filter, messages.c.delivery_attempts == 0)).label("num_delayed"),
+        func.min(messages.c.created_at).filter(ready_filter).label("min_ready_created_at"),
+        func.min(messages.c.created_at).label("min_created_at"),
+    ).select_from(messages)
+    return session.execute(statement).one()
+
+
+def load_reconciled_at(session: Session, queue_ids: Iterable[str]) -> dict[str, datetime]:
+    if not settings.enable_queue_counters:
+        return {}
+    rows = session.execute(
+        select(QueueCounter.queue_id, QueueCounter.reconciled_at).where(QueueCounter.queue_id.in_(queue_ids))
+    )
+    return dict(rows.all())
+
+
+def create_queue_counter(session: Session, queue_id: str, now: datetime) -> None:
+    if not settings.enable_queue_counters:
+        return
+    session.add(QueueCounter(queue_id=queue_id, reconciled_at=now, updated_at=now))
+
+
+def reset_queue_counter(session: Session, queue_id: str, now: datetime) -> None:
+    if not settings.enable_queue_counters:
+        return
+    session.execute(
+        update(QueueCounter)
+        .where(QueueCounter.queue_id == queue_id)
+        .values(
+            num_ready=0,
+            num_in_flight=0,
+            num_delayed=0,
+            oldest_message_created_at=None,
+            reconciled_at=now,
+            updated_at=now,
+        )
+    )
+
+
+def reconcile_queue_counters(session: Session, queue_ids: list[str] | None = None) -> None:
+    # recounts the messages of the queues with one aggregate query and upserts the counters; expired
+    # messages are counted until the cleanup task deletes them, like in the incremental updates
+    now = datetime.utcnow()
+    ready_filter = get_ready_filter(now)
+    pending_filter = Message.scheduled_at > now
+    query = (
+        select(
+            Queue.id,
+            func.count(Message.id).filter(ready_filter),
+            func.count(Message.id).filter(and_(pending_filter, Message.delivery_attempts > 0)),
+            func.count(Message.id).filter(and_(pending_filter, Message.delivery_attempts == 0)),
+            func.min(Message.created_at).filter(ready_filter),
+            literal(now, DateTime),
+            literal(now, DateTime),
+        )
+        .select_from(Queue)
+        .outerjoin(Message, Message.queue_id == Queue.id)
+        .group_by(Queue.id)
+    )
+    if queue_ids is not None:
+        query = query.where(Queue.id.in_(queue_ids))
+
+    columns = [*counter_columns, "oldest_message_created_at", "reconciled_at", "updated_at"]
+    statement = insert(QueueCounter).from_select(["queue_id", *columns], query)
+    statement = statement.on_conflict_do_update(
+        index_elements=[QueueCounter.queue_id],
+        set_={column: getattr(statement.excluded, column) for column in columns},
+    )
+    session.execute(statement)
+
+
+def load_oldest_message_created_at(session: Session, queue: Any, now: datetime) -> datetime | None:
+    oldest_message_created_at = session.execute(
+        select(func.min(Message.created_at))
+        .select_from(Message)
+        .join(Queue, Queue.id == Message.queue_id)
+        .where(Message.queue_id == queue.id, get_ready_filter(now))
+    ).scalar()
+    session.execute(
+        update(QueueCounter)
+        .where(QueueCounter.queue_id == queue.id, QueueCounter.oldest_message_created_at.is_(None))
+        .values(oldest_message_created_at=oldest_message_created_at)
+    )
+    return oldest_message_created_at
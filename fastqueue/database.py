@@ -1,17 +1,63 @@
 from pathlib import Path
+from typing import Any
+from uuid import uuid4
 
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, Pool, QueuePool
 
 from alembic import command
 from alembic.config import Config
 from fastqueue.config import settings
 from fastqueue.logger import get_logger
+from fastqueue.metrics import get_instrumented_pool_class, instrument_engine_pool, instrument_engine_queries
+
+
+def get_async_database_url(database_url: str, database_async_url: str | None) -> str:
+    if database_async_url:
+        return database_async_url
+    return make_url(database_url).set(drivername="postgresql+asyncpg").render_as_string(hide_password=False)
+
+
+def get_engine_options(name: str, pool_class: type[Pool]) -> dict[str, Any]:
+    return dict(
+        echo=settings.database_echo,
+        poolclass=get_instrumented_pool_class(pool_class, name),
+        pool_size=settings.database_pool_size,
+        max_overflow=settings.database_max_overflow,
+        pool_timeout=settings.database_pool_timeout_seconds,
+        pool_recycle=settings.database_pool_recycle_seconds,
+        pool_pre_ping=settings.database_pool_pre_ping,
+    )
+
+
+def get_async_engine_options() -> dict[str, Any]:
+    options = get_engine_options("async", AsyncAdaptedQueuePool)
+    if settings.database_pgbouncer_mode:
+        # pgbouncer transaction pooling can hand each transaction a different server connection, so
+        # asyncpg must not keep prepared statements across transactions
+        options["connect_args"] = {
+            "statement_cache_size": 0,
+            "prepared_statement_cache_size": 0,
+            "prepared_statement_name_func": lambda: f"__asyncpg_{uuid4()}__",
+        }
+    return options
+
 
 logger = get_logger(__name__)
-engine = create_engine(settings.database_url, echo=settings.database_echo)
+engine = create_engine(settings.database_url, **get_engine_options("sync", QueuePool))
+instrument_engine_pool(engine, "sync")
+instrument_engine_queries(engine)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+async_engine = create_async_engine(
+    get_async_database_url(settings.database_url, settings.database_async_url), **get_async_engine_options()
+)
+instrument_engine_pool(async_engine.sync_engine, "async")
+instrument_engine_queries(async_engine.sync_engine)
+AsyncSessionLocal = async_sessionmaker(autoflush=False, bind=async_engine)
 Base = declarative_base()
 
 
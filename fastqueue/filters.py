@@ -0,0 +1,39 @@
+from typing import Any
+
+
+class MessageFilterIndex:
+    # inverted index of the message_filters of the queues subscribed to a topic (attribute -> value ->
+    # queues), a queue matches when all of its filter keys are matched by the message attributes
+    def __init__(self, queues: list[Any]):
+        self.queues = queues
+        self._unfiltered: list[int] = []
+        self._empty_filters: list[int] = []
+        self._required_matches: dict[int, int] = {}
+        self._index: dict[str, dict[Any, list[int]]] = {}
+
+        for position, queue in enumerate(queues):
+            if queue.message_filters is None:
+                self._unfiltered.append(position)
+                continue
+            if not queue.message_filters:
+                self._empty_filters.append(position)
+                continue
+            self._required_matches[position] = len(queue.message_filters)
+            for key, values in queue.message_filters.items():
+                values_index = self._index.setdefault(key, {})
+                for value in set(values):
+                    values_index.setdefault(value, []).append(position)
+
+    def match(self, attributes: dict | None) -> list[Any]:
+        positions = list(self._unfiltered)
+        if attributes is not None:
+            positions.extend(self._empty_filters)
+            matches: dict[int, int] = {}
+            for key, value in attributes.items():
+                for position in self._index.get(key, {}).get(value, ()):
+                    matches[position] = matches.get(position, 0) + 1
+            positions.extend(
+                position for position, count in matches.items() if count == self._required_matches[position]
+            )
+            positions.sort()
+        return [self.queues[position] for position in positions]
@@ -2,6 +2,7 @@ import typer
 
 from fastqueue.api import run_server
 from fastqueue.database import run_migrations
+from fastqueue.partitions import run_partitioning
 from fastqueue.workers import run_worker
 
 cli = typer.Typer()
@@ -17,6 +18,11 @@ def run_migrations_command() -> None:
     return run_migrations()
 
 
+@cli.command("db-partition")
+def run_partitioning_command() -> None:
+    return run_partitioning()
+
+
 @cli.command("worker")
 def run_worker_command() -> None:
     return run_worker()
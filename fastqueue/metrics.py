@@ -0,0 +1,277 @@
+import threading
+from collections import Counter as CounterDict
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from time import perf_counter
+from typing import Any
+
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+
+from fastqueue.config import settings
+from fastqueue.logger import get_logger
+
+logger = get_logger(__name__)
+
+pool_checkout_seconds = Histogram(
+    "fastqueue_db_pool_checkout_seconds",
+    "Time waited to check out a connection from the database pool.",
+    ["engine"],
+)
+pool_size = Gauge("fastqueue_db_pool_size", "Configured size of the database pool.", ["engine"])
+pool_checked_out = Gauge(
+    "fastqueue_db_pool_checked_out", "Connections currently checked out from the database pool.", ["engine"]
+)
+pool_overflow = Gauge(
+    "fastqueue_db_pool_overflow", "Connections currently open beyond the database pool size.", ["engine"]
+)
+
+message_compression_ratio = Histogram(
+    "fastqueue_message_compression_ratio",
+    "Compressed size divided by the original size of the message data.",
+    buckets=(0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0),
+)
+message_data_bytes = Counter(
+    "fastqueue_message_data_bytes",
+    "Size of the message data that went through compression, before and after it.",
+    ["state"],
+)
+
+
+messages_published = Counter(
+    "fastqueue_messages_published", "Messages published to each queue.", ["topic_id", "queue_id"]
+)
+messages_delivered = Counter("fastqueue_messages_delivered", "Messages delivered to consumers.", ["queue_id"])
+messages_redelivered = Counter(
+    "fastqueue_messages_redelivered",
+    "Messages delivered again after a nack or an expired ack deadline.",
+    ["queue_id"],
+)
+messages_acked = Counter("fastqueue_messages_acked", "Messages acked by consumers.", ["queue_id"])
+messages_nacked = Counter("fastqueue_messages_nacked", "Messages nacked by consumers.", ["queue_id"])
+messages_dead_lettered = Counter(
+    "fastqueue_messages_dead_lettered",
+    "Messages moved to the dead queue after reaching the maximum deliveries.",
+    ["queue_id"],
+)
+message_ack_latency_seconds = Histogram(
+    "fastqueue_message_ack_latency_seconds",
+    "Time from the publication of a message to its ack.",
+    ["queue_id"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600, 14400, 86400),
+)
+
+
+class LabelValues:
+    # the first max_values values keep their own label, the next ones share the "other" label, so the number
+    # of series doesn't grow with the number of queues
+    def __init__(self, max_values: int):
+        self.max_values = max_values
+        self._values: set[str] = set()
+        self._lock = threading.Lock()
+
+    def get(self, value: str) -> str:
+        if value in self._values:
+            return value
+        with self._lock:
+            if len(self._values) < self.max_values:
+                self._values.add(value)
+                return value
+        return "other"
+
+
+topic_label_values = LabelValues(settings.metrics_max_queue_labels)
+queue_label_values = LabelValues(settings.metrics_max_queue_labels)
+
+
+def record_published(topic_id: str, queue_ids: Iterable[str]) -> None:
+    topic_label = topic_label_values.get(topic_id)
+    for queue_id, count in CounterDict(queue_ids).items():
+        messages_published.labels(topic_id=topic_label, queue_id=queue_label_values.get(queue_id)).inc(count)
+
+
+def record_delivered(rows: Iterable[Any]) -> None:
+    # rows of messages after the delivery, with queue_id and delivery_attempts
+    delivered: CounterDict = CounterDict()
+    redelivered: CounterDict = CounterDict()
+    for row in rows:
+        delivered[row.queue_id] += 1
+        if row.delivery_attempts > 1:
+            redelivered[row.queue_id] += 1
+    for queue_id, count in delivered.items():
+        messages_delivered.labels(queue_id=queue_label_values.get(queue_id)).inc(count)
+    for queue_id, count in redelivered.items():
+        messages_redelivered.labels(queue_id=queue_label_values.get(queue_id)).inc(count)
+
+
+def record_acked(rows: Iterable[Any], now: datetime) -> None:
+    # rows of the acked messages, with queue_id and created_at
+    for row in rows:
+        queue_label = queue_label_values.get(row.queue_id)
+        messages_acked.labels(queue_id=queue_label).inc()
+        message_ack_latency_seconds.labels(queue_id=queue_label).observe(
+            (now - row.created_at).total_seconds()
+        )
+
+
+def record_nacked(queue_ids: Iterable[str]) -> None:
+    for queue_id, count in CounterDict(queue_ids).items():
+        messages_nacked.labels(queue_id=queue_label_values.get(queue_id)).inc(count)
+
+
+def record_dead_lettered(queue_id: str, count: int) -> None:
+    messages_dead_lettered.labels(queue_id=queue_label_values.get(queue_id)).inc(count)
+
+
+query_count_buckets = (1, 2, 3, 5, 10, 20, 50, 100, 200)
+request_queries = Histogram(
+    "fastqueue_db_request_queries",
+    "Database queries of each request.",
+    ["route"],
+    buckets=query_count_buckets,
+)
+request_query_seconds = Histogram(
+    "fastqueue_db_request_query_seconds", "Total time of the database queries of each request.", ["route"]
+)
+request_slowest_query_seconds = Histogram(
+    "fastqueue_db_request_slowest_query_seconds",
+    "Time of the slowest database query of each request.",
+    ["route"],
+)
+service_queries = Histogram(
+    "fastqueue_db_service_queries",
+    "Database queries of each service method call.",
+    ["method"],
+    buckets=query_count_buckets,
+)
+service_query_seconds = Histogram(
+    "fastqueue_db_service_query_seconds",
+    "Total time of the database queries of each service method call.",
+    ["method"],
+)
+service_slowest_query_seconds = Histogram(
+    "fastqueue_db_service_slowest_query_seconds",
+    "Time of the slowest database query of each service method call.",
+    ["method"],
+)
+explained_statements = ("select", "insert", "update", "delete", "with")
+
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.slowest_seconds = 0.0
+        self.slowest_statement: str | None = None
+
+    def add(self, statement: str, seconds: float) -> None:
+        self.count += 1
+        self.seconds += seconds
+        if seconds > self.slowest_seconds:
+            self.slowest_seconds = seconds
+            self.slowest_statement = statement
+
+
+# the stats of the request and of the service method that are running, every query is added to all of them
+active_query_stats: ContextVar[tuple[QueryStats, ...]] = ContextVar("active_query_stats", default=())
+
+
+@contextmanager
+def track_queries() -> Iterator[QueryStats]:
+    stats = QueryStats()
+    token = active_query_stats.set(active_query_stats.get() + (stats,))
+    try:
+        yield stats
+    finally:
+        active_query_stats.reset(token)
+
+
+@contextmanager
+def track_request_queries(get_route: Any) -> Iterator[QueryStats]:
+    # the route is only known after the request is routed
+    with track_queries() as stats:
+        try:
+            yield stats
+        finally:
+            route = get_route()
+            request_queries.labels(route=route).observe(stats.count)
+            request_query_seconds.labels(route=route).observe(stats.seconds)
+            request_slowest_query_seconds.labels(route=route).observe(stats.slowest_seconds)
+
+
+@contextmanager
+def track_service_queries(method: str) -> Iterator[QueryStats]:
+    with track_queries() as stats:
+        try:
+            yield stats
+        finally:
+            service_queries.labels(method=method).observe(stats.count)
+            service_query_seconds.labels(method=method).observe(stats.seconds)
+            service_slowest_query_seconds.labels(method=method).observe(stats.slowest_seconds)
+
+
+def explain_query(connection: Any, statement: str, parameters: Any) -> str | None:
+    # runs on the dbapi connection inside a savepoint, so the events are not fired again and a failure
+    # doesn't abort the transaction of the query
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute("SAVEPOINT fastqueue_explain")
+        try:
+            cursor.execute(f"EXPLAIN {statement}", parameters)
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+        except Exception:
+            cursor.execute("ROLLBACK TO SAVEPOINT fastqueue_explain")
+            plan = None
+        cursor.execute("RELEASE SAVEPOINT fastqueue_explain")
+        return plan
+    except Exception:
+        return None
+    finally:
+        cursor.close()
+
+
+def log_slow_query(
+    connection: Any, statement: str, parameters: Any, executemany: bool, seconds: float
+) -> None:
+    plan = None
+    if not executemany and statement.lstrip().lower().startswith(explained_statements):
+        plan = explain_query(connection, statement, parameters)
+    logger.warning("slow query", extra=dict(seconds=round(seconds, 6), statement=statement, plan=plan))
+
+
+def instrument_engine_queries(engine: Engine) -> None:
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        context._fastqueue_query_start = perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        seconds = perf_counter() - context._fastqueue_query_start
+        for stats in active_query_stats.get():
+            stats.add(statement, seconds)
+        if 0 < settings.database_slow_query_seconds <= seconds:
+            log_slow_query(connection, statement, parameters, executemany, seconds)
+
+
+def get_instrumented_pool_class(pool_class: type[Pool], name: str) -> type[Pool]:
+    class InstrumentedPool(pool_class):  # type: ignore[valid-type, misc]
+        def connect(self) -> Any:
+            start = perf_counter()
+            try:
+                return super().connect()
+            finally:
+                pool_checkout_seconds.labels(engine=name).observe(perf_counter() - start)
+
+    InstrumentedPool.__name__ = f"Instrumented{pool_class.__name__}"
+    return InstrumentedPool
+
+
+def instrument_engine_pool(engine: Engine, name: str) -> None:
+    # the engine creates a new pool on dispose(), so always read the current one
+    pool_size.labels(engine=name).set_function(lambda: engine.pool.size())
+    pool_checked_out.labels(engine=name).set_function(lambda: engine.pool.checkedout())
+    pool_overflow.labels(engine=name).set_function(lambda: max(engine.pool.overflow(), 0))
@@ -32,6 +32,12 @@ class Queue(Base):
     message_filters = sqlalchemy.Column(postgresql.JSONB, nullable=True)
     message_max_deliveries = sqlalchemy.Column(sqlalchemy.Integer, nullable=True)
     delivery_delay_seconds = sqlalchemy.Column(sqlalchemy.Integer, nullable=True)
+    retry_policy = sqlalchemy.Column(sqlalchemy.String(length=16), nullable=True)
+    retry_min_backoff_seconds = sqlalchemy.Column(sqlalchemy.Integer, nullable=True)
+    retry_max_backoff_seconds = sqlalchemy.Column(sqlalchemy.Integer, nullable=True)
+    retry_jitter = sqlalchemy.Column(
+        sqlalchemy.Boolean, nullable=False, default=False, server_default=sqlalchemy.false()
+    )
     created_at = sqlalchemy.Column(sqlalchemy.DateTime, nullable=False)
     updated_at = sqlalchemy.Column(sqlalchemy.DateTime, nullable=False)
 
@@ -47,14 +53,23 @@ class Message(Base):
         sqlalchemy.Index(
             "ix_messages_expired_at_scheduled_at", "expired_at", "scheduled_at", postgresql_using="brin"
         ),
+        sqlalchemy.Index("ix_messages_queue_id_scheduled_at", "queue_id", "scheduled_at"),
+        sqlalchemy.Index("ix_messages_queue_id_expired_at", "queue_id", "expired_at"),
+        sqlalchemy.Index(
+            "ix_messages_payload_id", "payload_id", postgresql_where=sqlalchemy.text("payload_id IS NOT NULL")
+        ),
     )
 
     id = sqlalchemy.Column(postgresql.UUID, primary_key=True, nullable=False)
     queue_id = sqlalchemy.Column(
         sqlalchemy.String(length=128), sqlalchemy.ForeignKey("queues.id", ondelete="CASCADE"), nullable=False
     )
-    data = sqlalchemy.Column(postgresql.JSONB, nullable=False)
-    attributes = sqlalchemy.Column(postgresql.JSONB, nullable=True)
+    # the data and attributes of messages published to many queues are stored once in message_payloads
+    data = sqlalchemy.Column(postgresql.JSONB(none_as_null=True), nullable=True)
+    attributes = sqlalchemy.Column(postgresql.JSONB(none_as_null=True), nullable=True)
+    payload_id = sqlalchemy.Column(
+        postgresql.UUID, sqlalchemy.ForeignKey("message_payloads.id"), nullable=True
+    )
     delivery_attempts = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
     expired_at = sqlalchemy.Column(sqlalchemy.DateTime, nullable=False)
     scheduled_at = sqlalchemy.Column(sqlalchemy.DateTime, nullable=False)
@@ -63,3 +78,37 @@ class Message(Base):
 
     def __repr__(self):
         return f"Message(id={self.id}, queue_id={self.queue_id})"
+
+
+class MessagePayload(Base):
+    __tablename__ = "message_payloads"
+
+    id = sqlalchemy.Column(postgresql.UUID, primary_key=True, nullable=False)
+    # large data is stored compressed when enable_message_compression is set
+    data = sqlalchemy.Column(postgresql.JSONB(none_as_null=True), nullable=True)
+    compressed_data = sqlalchemy.Column(sqlalchemy.LargeBinary, nullable=True)
+    attributes = sqlalchemy.Column(postgresql.JSONB, nullable=True)
+    created_at = sqlalchemy.Column(sqlalchemy.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"MessagePayload(id={self.id})"
+
+
+class QueueCounter(Base):
+    __tablename__ = "queue_counters"
+
+    queue_id = sqlalchemy.Column(
+        sqlalchemy.String(length=128),
+        sqlalchemy.ForeignKey("queues.id", ondelete="CASCADE"),
+        primary_key=True,
+        nullable=False,
+    )
+    num_ready = sqlalchemy.Column(sqlalchemy.BigInteger, nullable=False, default=0)
+    num_in_flight = sqlalchemy.Column(sqlalchemy.BigInteger, nullable=False, default=0)
+    num_delayed = sqlalchemy.Column(sqlalchemy.BigInteger, nullable=False, default=0)
+    oldest_message_created_at = sqlalchemy.Column(sqlalchemy.DateTime, nullable=True)
+    reconciled_at = sqlalchemy.Column(sqlalchemy.DateTime, nullable=False)
+    updated_at = sqlalchemy.Column(sqlalchemy.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f"QueueCounter(queue_id={self.queue_id}, num_ready={self.num_ready})"
@@ -0,0 +1,141 @@
+import select
+import threading
+from collections import defaultdict
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from time import sleep
+from typing import Any
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from fastqueue.database import engine
+from fastqueue.logger import get_logger
+
+logger = get_logger(__name__)
+messages_channel = "fastqueue_messages"
+
+
+def notify(session: Session, channel: str, payloads: list[str]) -> None:
+    # notifications are only delivered when the session transaction commits
+    if not payloads:
+        return
+    session.execute(
+        text("SELECT pg_notify(:channel, payload) FROM unnest(CAST(:payloads AS text[])) AS payload"),
+        {"channel": channel, "payloads": payloads},
+    )
+
+
+class Listener:
+    # handlers are called from the listener thread with the notification payload, or with None after
+    # a (re)connection, when notifications may have been lost
+    def __init__(self, engine: Engine, poll_interval_seconds: float = 1.0):
+        self.engine = engine
+        self.poll_interval_seconds = poll_interval_seconds
+        self._handlers: dict[str, list[Callable[[str | None], None]]] = defaultdict(list)
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        self._listening = threading.Event()
+
+    def add_handler(self, channel: str, handler: Callable[[str | None], None]) -> None:
+        with self._lock:
+            self._handlers[channel].append(handler)
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="fastqueue-listener", daemon=True)
+            self._thread.start()
+        # the first caller waits a bit for the connection, so what it reads next is invalidated by the
+        # notifications and not by the handlers that run when the connection is made
+        self._listening.wait(self.poll_interval_seconds)
+
+    def dispatch(self, channel: str, payload: str | None) -> None:
+        with self._lock:
+            handlers = list(self._handlers[channel])
+        for handler in handlers:
+            try:
+                handler(payload)
+            except Exception:
+                logger.exception("notification handler failed", extra=dict(channel=channel))
+
+    def dispatch_all(self) -> None:
+        with self._lock:
+            channels = list(self._handlers)
+        for channel in channels:
+            self.dispatch(channel, None)
+
+    def _connect(self) -> Any:
+        cargs, cparams = self.engine.dialect.create_connect_args(self.engine.url)
+        connection = self.engine.dialect.connect(*cargs, **cparams)
+        connection.autocommit = True
+        return connection
+
+    def _listen(self, connection: Any, listening: set[str]) -> None:
+        with self._lock:
+            channels = set(self._handlers) - listening
+        for channel in channels:
+            with connection.cursor() as cursor:
+                cursor.execute(f'LISTEN "{channel}"')
+            listening.add(channel)
+
+    def _run(self) -> None:
+        while True:
+            connection = None
+            try:
+                connection = self._connect()
+                listening: set[str] = set()
+                self._listen(connection, listening)
+                self.dispatch_all()
+                self._listening.set()
+                while True:
+                    select.select([connection], [], [], self.poll_interval_seconds)
+                    connection.poll()
+                    while connection.notifies:
+                        notification = connection.notifies.pop(0)
+                        self.dispatch(notification.channel, notification.payload)
+                    self._listen(connection, listening)
+            except Exception:
+                logger.exception("notification listener failed, reconnecting")
+                if connection is not None:
+                    connection.close()
+                sleep(self.poll_interval_seconds)
+
+
+class MessageWaiters:
+    def __init__(self, listener: Listener, channel: str):
+        self.listener = listener
+        self._callbacks: dict[str, set[Callable[[], None]]] = defaultdict(set)
+        self._lock = threading.Lock()
+        listener.add_handler(channel, self.wake)
+
+    @contextmanager
+    def subscribe(self, queue_id: str, callback: Callable[[], None]) -> Iterator[None]:
+        self.listener.start()
+        with self._lock:
+            self._callbacks[queue_id].add(callback)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._callbacks[queue_id].discard(callback)
+                if not self._callbacks[queue_id]:
+                    del self._callbacks[queue_id]
+
+    def wake(self, queue_id: str | None) -> None:
+        with self._lock:
+            if queue_id is None:
+                callbacks = [callback for callbacks in self._callbacks.values() for callback in callbacks]
+            else:
+                callbacks = list(self._callbacks.get(queue_id, ()))
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                logger.exception("message waiter callback failed", extra=dict(queue_id=queue_id))
+
+
+listener = Listener(engine=engine)
+message_waiters = MessageWaiters(listener=listener, channel=messages_channel)
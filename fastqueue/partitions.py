@@ -0,0 +1,308 @@
+import re
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from fastqueue.config import settings
+from fastqueue.database import engine
+from fastqueue.logger import get_logger
+from fastqueue.models import Message
+
+logger = get_logger(__name__)
+
+table_name = Message.__tablename__
+legacy_partition_name = f"{table_name}_legacy"
+default_partition_name = f"{table_name}_default"
+partition_bound_regex = re.compile(r"^FOR VALUES FROM \((?P<start>.+)\) TO \((?P<end>.+)\)$")
+epoch = datetime(1970, 1, 1)
+
+
+def get_partition_start(value: datetime) -> datetime:
+    interval = settings.messages_partition_interval_seconds
+    seconds = int((value - epoch).total_seconds()) // interval * interval
+    return epoch + timedelta(seconds=seconds)
+
+
+def get_partition_name(start: datetime) -> str:
+    return f"{table_name}_p{start:%Y%m%d%H%M%S}"
+
+
+def parse_partition_bound(value: str) -> datetime | None:
+    if value == "MINVALUE":
+        return None
+    return datetime.fromisoformat(value.strip("'"))
+
+
+def get_hash_partition_name(name: str, remainder: int) -> str:
+    return f"{name}_h{remainder}"
+
+
+def get_partition_strategy(connection: Connection) -> str | None:
+    # "r" for range and "h" for hash, None when the table is not partitioned
+    return connection.execute(
+        text("SELECT partstrat FROM pg_partitioned_table WHERE partrelid = to_regclass(:table_name)"),
+        {"table_name": table_name},
+    ).scalar()
+
+
+def is_partitioned(connection: Connection) -> bool:
+    return get_partition_strategy(connection) is not None
+
+
+def is_range_partitioned(connection: Connection) -> bool:
+    return get_partition_strategy(connection) == "r"
+
+
+def list_partitions(connection: Connection) -> list[tuple[str, datetime | None, datetime]]:
+    # returns the range partitions as (name, start, end), the start of the legacy partition is None
+    rows = connection.execute(
+        text(
+            "SELECT child.relname, pg_get_expr(child.relpartbound, child.oid) FROM pg_inherits "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = to_regclass(:table_name)"
+        ),
+        {"table_name": table_name},
+    ).all()
+    partitions = []
+    for name, bound in rows:
+        match = partition_bound_regex.match(bound)
+        if match is None:
+            continue
+        partitions.append((name, parse_partition_bound(match["start"]), parse_partition_bound(match["end"])))
+    return sorted(partitions, key=lambda partition: partition[2])
+
+
+def get_hash_partitions(connection: Connection) -> int:
+    # the number of hash partitions of the table, or of its range partitions (the legacy one is not split)
+    strategy = get_partition_strategy(connection)
+    if strategy is None:
+        return 0
+    parent = table_name
+    if strategy == "r":
+        names = [name for name, start, _ in list_partitions(connection) if start is not None]
+        if not names:
+            return 0
+        parent = names[-1]
+    return connection.execute(
+        text("SELECT count(*) FROM pg_inherits WHERE inhparent = to_regclass(:name)"), {"name": parent}
+    ).scalar()
+
+
+def get_missing_partitions(
+    partitions: list[tuple[str, datetime | None, datetime]], now: datetime
+) -> list[tuple[datetime, datetime]]:
+    # the partitions must accept any expired_at that a message can get from now on
+    interval = timedelta(seconds=settings.messages_partition_interval_seconds)
+    end = now + timedelta(seconds=settings.max_message_retention_seconds) + interval
+    start = get_partition_start(now)
+    if partitions:
+        start = max(start, partitions[-1][2])
+    missing = []
+    while start < end:
+        missing.append((start, start + interval))
+        start += interval
+    return missing
+
+
+def get_expired_partitions(
+    partitions: list[tuple[str, datetime | None, datetime]], now: datetime
+) -> list[str]:
+    return [name for name, _, end in partitions if end <= now]
+
+
+def create_hash_partitions(connection: Connection, name: str) -> None:
+    modulus = settings.messages_hash_partitions
+    for remainder in range(modulus):
+        connection.execute(
+            text(
+                f"CREATE TABLE {get_hash_partition_name(name, remainder)} PARTITION OF {name} "
+                f"FOR VALUES WITH (MODULUS {modulus}, REMAINDER {remainder})"
+            )
+        )
+
+
+def create_partition(connection: Connection, start: datetime, end: datetime) -> None:
+    # the messages of the range that were stored in the default partition are moved to the new one before
+    # it is attached, otherwise the attach fails
+    name = get_partition_name(start)
+    bounds = {"start": start, "end": end}
+    if settings.messages_hash_partitions > 0:
+        connection.execute(
+            text(f"CREATE TABLE {name} (LIKE {table_name} INCLUDING DEFAULTS) PARTITION BY HASH (queue_id)")
+        )
+        create_hash_partitions(connection, name)
+    else:
+        connection.execute(text(f"CREATE TABLE {name} (LIKE {table_name} INCLUDING DEFAULTS)"))
+    connection.execute(
+        text(
+            f"WITH moved AS (DELETE FROM {default_partition_name} "
+            "WHERE expired_at >= :start AND expired_at < :end RETURNING *) "
+            f"INSERT INTO {name} SELECT * FROM moved"
+        ),
+        bounds,
+    )
+    connection.execute(
+        text(
+            f"ALTER TABLE {table_name} ATTACH PARTITION {name} "
+            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+        )
+    )
+
+
+def drop_partition(connection: Connection, name: str) -> list[str]:
+    # returns the queues that had messages in the partition, their counters must be reconciled
+    queue_ids = connection.execute(text(f"SELECT DISTINCT queue_id FROM {name}")).scalars().all()
+    connection.execute(text(f"DROP TABLE {name}"))
+    return list(queue_ids)
+
+
+def delete_expired_default_messages(connection: Connection, now: datetime) -> list[str]:
+    queue_ids = connection.execute(
+        text(f"DELETE FROM {default_partition_name} WHERE expired_at <= :now RETURNING queue_id"),
+        {"now": now},
+    ).scalars()
+    return sorted(set(queue_ids))
+
+
+def rename_messages_table(connection: Connection, suffix: str) -> tuple[list[str], list[str]]:
+    # renames the messages table and its indexes, the definitions of its indexes (except the primary key)
+    # and foreign keys are returned to create them on the new table, the migrations that change the table
+    # layout must not depend on the current model
+    rows = connection.execute(
+        text(
+            "SELECT indexrelid::regclass::text, pg_get_indexdef(indexrelid), indisprimary FROM pg_index "
+            "WHERE indrelid = to_regclass(:table_name)"
+        ),
+        {"table_name": table_name},
+    ).all()
+    indexes = [definition.replace(" ON ONLY ", " ON ") for _, definition, primary in rows if not primary]
+    foreign_keys = (
+        connection.execute(
+            text(
+                "SELECT pg_get_constraintdef(oid) FROM pg_constraint "
+                "WHERE conrelid = to_regclass(:table_name) AND contype = 'f'"
+            ),
+            {"table_name": table_name},
+        )
+        .scalars()
+        .all()
+    )
+    connection.execute(text(f"ALTER TABLE {table_name} RENAME TO {table_name}_{suffix}"))
+    for name, _, _ in rows:
+        connection.execute(text(f"ALTER INDEX {name} RENAME TO {name}_{suffix}"))
+    return indexes, foreign_keys
+
+
+def create_foreign_keys(connection: Connection, foreign_keys: list[str]) -> None:
+    for definition in foreign_keys:
+        connection.execute(text(f"ALTER TABLE {table_name} ADD {definition}"))
+
+
+def create_indexes(connection: Connection, indexes: list[str]) -> None:
+    for definition in indexes:
+        connection.execute(text(definition))
+
+
+def partition_messages(connection: Connection) -> None:
+    # the current table becomes the legacy partition, which holds every message that expires before the
+    # first new partition and is dropped once they are all expired, so the messages are not copied
+    now = datetime.utcnow()
+    max_expired_at = connection.execute(text(f"SELECT max(expired_at) FROM {table_name}")).scalar()
+    interval = timedelta(seconds=settings.messages_partition_interval_seconds)
+    legacy_end = get_partition_start(max(max_expired_at or now, now)) + interval
+
+    # the primary key of a partitioned table must include the partition keys of all levels
+    primary_key_columns = (
+        "id, expired_at, queue_id" if settings.messages_hash_partitions > 0 else "id, expired_at"
+    )
+
+    indexes, foreign_keys = rename_messages_table(connection, "legacy")
+    connection.execute(
+        text(
+            f"CREATE UNIQUE INDEX {legacy_partition_name}_primary_key "
+            f"ON {legacy_partition_name} ({primary_key_columns})"
+        )
+    )
+    connection.execute(text(f"ALTER TABLE {legacy_partition_name} DROP CONSTRAINT {table_name}_pkey_legacy"))
+    connection.execute(
+        text(f"CREATE TABLE {table_name} (LIKE {legacy_partition_name}) PARTITION BY RANGE (expired_at)")
+    )
+    connection.execute(text(f"ALTER TABLE {table_name} ADD PRIMARY KEY ({primary_key_columns})"))
+    create_foreign_keys(connection, foreign_keys)
+    connection.execute(
+        text(
+            f"ALTER TABLE {table_name} ATTACH PARTITION {legacy_partition_name} "
+            f"FOR VALUES FROM (MINVALUE) TO ('{legacy_end.isoformat()}')"
+        )
+    )
+    # the indexes of the legacy partition are attached to the new ones
+    create_indexes(connection, indexes)
+    connection.execute(text(f"CREATE TABLE {default_partition_name} PARTITION OF {table_name} DEFAULT"))
+    for start, end in get_missing_partitions(list_partitions(connection), now):
+        create_partition(connection, start, end)
+
+
+def hash_partition_messages(connection: Connection) -> None:
+    # the messages are copied, the queues are spread over messages_hash_partitions tables so the consume
+    # queries of a queue only touch its own partition
+    unpartitioned_table_name = f"{table_name}_unpartitioned"
+    indexes, foreign_keys = rename_messages_table(connection, "unpartitioned")
+    connection.execute(
+        text(
+            f"CREATE TABLE {table_name} (LIKE {unpartitioned_table_name} INCLUDING DEFAULTS) "
+            "PARTITION BY HASH (queue_id)"
+        )
+    )
+    connection.execute(text(f"ALTER TABLE {table_name} ADD PRIMARY KEY (id, queue_id)"))
+    create_foreign_keys(connection, foreign_keys)
+    create_hash_partitions(connection, table_name)
+    create_indexes(connection, indexes)
+    connection.execute(text(f"INSERT INTO {table_name} SELECT * FROM {unpartitioned_table_name}"))
+    connection.execute(text(f"DROP TABLE {unpartitioned_table_name}"))
+
+
+def unpartition_messages(connection: Connection) -> None:
+    partitioned_table_name = f"{table_name}_partitioned"
+    indexes, foreign_keys = rename_messages_table(connection, "partitioned")
+    connection.execute(text(f"CREATE TABLE {table_name} (LIKE {partitioned_table_name} INCLUDING DEFAULTS)"))
+    connection.execute(text(f"ALTER TABLE {table_name} ADD PRIMARY KEY (id)"))
+    create_foreign_keys(connection, foreign_keys)
+    create_indexes(connection, indexes)
+    connection.execute(text(f"INSERT INTO {table_name} SELECT * FROM {partitioned_table_name}"))
+    connection.execute(text(f"DROP TABLE {partitioned_table_name}"))
+
+
+def get_configured_layout() -> tuple[str | None, int]:
+    # the partition strategy and the number of hash partitions that the settings ask for
+    hash_partitions = max(settings.messages_hash_partitions, 0)
+    if settings.enable_messages_partitioning:
+        return "r", hash_partitions
+    if hash_partitions > 0:
+        return "h", hash_partitions
+    return None, 0
+
+
+def apply_messages_partitioning(connection: Connection) -> bool:
+    # changes the layout of the messages table to the one of the settings, whatever the revision of the
+    # database, and does nothing when it already matches; returns whether the table was changed
+    configured_layout = get_configured_layout()
+    strategy = get_partition_strategy(connection)
+    if (strategy, get_hash_partitions(connection)) == configured_layout:
+        return False
+    if strategy is not None:
+        unpartition_messages(connection)
+    if configured_layout[0] == "r":
+        partition_messages(connection)
+    elif configured_layout[0] == "h":
+        hash_partition_messages(connection)
+    return True
+
+
+def run_partitioning() -> None:
+    strategy, hash_partitions = get_configured_layout()
+    logger.info("partitioning messages", extra=dict(strategy=strategy, hash_partitions=hash_partitions))
+    # one transaction, the messages table is locked until the messages are copied
+    with engine.begin() as connection:
+        changed = apply_messages_partitioning(connection)
+    logger.info("messages table changed" if changed else "messages table already matches the settings")
@@ -1,4 +1,5 @@
 from datetime import datetime
+from typing import Annotated, Literal
 from uuid import UUID
 
 from pydantic import BaseModel as Schema
@@ -27,6 +28,7 @@ class TopicSchema(Schema):
 
 class ListTopicSchema(Schema):
     data: list[TopicSchema]
+    next_cursor: str | None = None
 
 
 def message_max_deliveries_is_required_for_dead_queue_id(values):
@@ -41,6 +43,25 @@ def message_max_deliveries_is_required_for_dead_queue_id(values):
     return values
 
 
+def retry_min_backoff_seconds_is_required_for_retry_policy(values):
+    retry_policy = values.get("retry_policy", None)
+    retry_min_backoff_seconds = values.get("retry_min_backoff_seconds", None)
+    retry_max_backoff_seconds = values.get("retry_max_backoff_seconds", None)
+
+    if retry_policy is None:
+        if retry_min_backoff_seconds is not None or retry_max_backoff_seconds is not None:
+            raise ValueError("retry_policy is required for retry backoff")
+        return values
+    if retry_min_backoff_seconds is None:
+        raise ValueError("retry_min_backoff_seconds is required for retry policy")
+    if retry_max_backoff_seconds is None:
+        values["retry_max_backoff_seconds"] = settings.max_retry_backoff_seconds
+    elif retry_max_backoff_seconds < retry_min_backoff_seconds:
+        raise ValueError("retry_max_backoff_seconds must not be less than retry_min_backoff_seconds")
+
+    return values
+
+
 class CreateQueueSchema(Schema):
     id: str = Field(..., regex=regex_for_id, max_length=128)
     topic_id: str | None = Field(None, regex=regex_for_id, max_length=128)
@@ -58,11 +79,23 @@ class CreateQueueSchema(Schema):
     delivery_delay_seconds: int | None = Field(
         None, ge=settings.min_delivery_delay_seconds, le=settings.max_delivery_delay_seconds
     )
+    retry_policy: Literal["fixed", "linear", "exponential"] | None = None
+    retry_min_backoff_seconds: int | None = Field(
+        None, ge=settings.min_retry_backoff_seconds, le=settings.max_retry_backoff_seconds
+    )
+    retry_max_backoff_seconds: int | None = Field(
+        None, ge=settings.min_retry_backoff_seconds, le=settings.max_retry_backoff_seconds
+    )
+    retry_jitter: bool = False
 
     @root_validator()
     def message_max_deliveries_is_required_for_dead_queue_id(cls, values):
         return message_max_deliveries_is_required_for_dead_queue_id(values)
 
+    @root_validator()
+    def retry_min_backoff_seconds_is_required_for_retry_policy(cls, values):
+        return retry_min_backoff_seconds_is_required_for_retry_policy(values)
+
 
 class UpdateQueueSchema(Schema):
     topic_id: str | None = Field(None, regex=regex_for_id, max_length=128)
@@ -80,11 +113,23 @@ class UpdateQueueSchema(Schema):
     delivery_delay_seconds: int | None = Field(
         None, ge=settings.min_delivery_delay_seconds, le=settings.max_delivery_delay_seconds
     )
+    retry_policy: Literal["fixed", "linear", "exponential"] | None = None
+    retry_min_backoff_seconds: int | None = Field(
+        None, ge=settings.min_retry_backoff_seconds, le=settings.max_retry_backoff_seconds
+    )
+    retry_max_backoff_seconds: int | None = Field(
+        None, ge=settings.min_retry_backoff_seconds, le=settings.max_retry_backoff_seconds
+    )
+    retry_jitter: bool = False
 
     @root_validator()
     def message_max_deliveries_is_required_for_dead_queue_id(cls, values):
         return message_max_deliveries_is_required_for_dead_queue_id(values)
 
+    @root_validator()
+    def retry_min_backoff_seconds_is_required_for_retry_policy(cls, values):
+        return retry_min_backoff_seconds_is_required_for_retry_policy(values)
+
 
 class QueueSchema(Schema):
     id: str
@@ -95,6 +140,10 @@ class QueueSchema(Schema):
     message_filters: dict[str, list[str]] | None
     message_max_deliveries: int | None
     delivery_delay_seconds: int | None
+    retry_policy: str | None
+    retry_min_backoff_seconds: int | None
+    retry_max_backoff_seconds: int | None
+    retry_jitter: bool
     created_at: datetime
     updated_at: datetime
 
@@ -107,12 +156,21 @@ class QueueStatsSchema(Schema):
     oldest_unacked_message_age_seconds: int
 
 
+class QueueStatsItemSchema(QueueStatsSchema):
+    queue_id: str
+
+
+class ListQueueStatsSchema(Schema):
+    data: list[QueueStatsItemSchema]
+
+
 class RedriveQueueSchema(Schema):
     destination_queue_id: str
 
 
 class ListQueueSchema(Schema):
     data: list[QueueSchema]
+    next_cursor: str | None = None
 
 
 class CreateMessageSchema(Schema):
@@ -120,6 +178,10 @@ class CreateMessageSchema(Schema):
     attributes: dict[str, str] | None = None
 
 
+class CreateMessageBatchSchema(Schema):
+    data: list[CreateMessageSchema] = Field(..., min_items=1, max_items=settings.max_batch_size)
+
+
 class MessageSchema(Schema):
     id: UUID
     queue_id: str
@@ -139,5 +201,65 @@ class ListMessageSchema(Schema):
     data: list[MessageSchema]
 
 
+class ListMessageBatchSchema(Schema):
+    data: list[ListMessageSchema]
+
+
+class MessageIdsSchema(Schema):
+    ids: list[UUID] = Field(..., min_items=1, max_items=settings.max_batch_size)
+
+
+class NackMessageIdsSchema(MessageIdsSchema):
+    # overrides the retry policy of the queues, 0 makes the messages available right away
+    delay_seconds: int | None = Field(None, ge=0, le=settings.max_delivery_delay_seconds)
+
+
+class AckDeadlineSchema(Schema):
+    # counted from now, 0 makes the messages available again like a nack (after the retry backoff)
+    ack_deadline_seconds: int = Field(..., ge=0, le=settings.max_ack_deadline_seconds)
+
+
+class ModifyAckDeadlineSchema(MessageIdsSchema, AckDeadlineSchema):
+    pass
+
+
+class MessageIdsResultSchema(Schema):
+    not_found_ids: list[UUID]
+
+
+class IngestErrorSchema(Schema):
+    line: int
+    detail: str
+
+
+class IngestResultSchema(Schema):
+    num_lines: int
+    num_messages: int
+    num_errors: int
+    errors: list[IngestErrorSchema]
+    # set when a batch failed to be written, the messages of the batches before it are kept
+    error: str | None = None
+
+
+class StreamCreditsSchema(Schema):
+    type: Literal["credits"]
+    credits: int = Field(..., ge=1, le=settings.max_batch_size)
+
+
+class StreamMessageIdsSchema(MessageIdsSchema):
+    type: Literal["ack", "nack"]
+
+
+StreamRequestSchema = Annotated[StreamCreditsSchema | StreamMessageIdsSchema, Field(discriminator="type")]
+
+
+class StreamMessagesSchema(ListMessageSchema):
+    type: Literal["messages"] = "messages"
+
+
+class StreamMessageIdsResultSchema(MessageIdsResultSchema):
+    type: Literal["ack", "nack"]
+
+
 class HealthSchema(Schema):
     success: bool
@@ -1,29 +1,101 @@
+import asyncio
+import csv
+import io
+import json
+import threading
 import uuid
+from collections.abc import AsyncIterator, Awaitable, Callable, Sequence
 from datetime import datetime, timedelta
+from time import monotonic
 from typing import Any
 
-from sqlalchemy import text
+from pydantic import ValidationError
+from sqlalchemy import (
+    and_,
+    any_,
+    Boolean,
+    case,
+    cast,
+    delete,
+    exists,
+    func,
+    insert,
+    Integer,
+    literal,
+    select,
+    String,
+    Table,
+    text,
+    update,
+)
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
+from sqlalchemy.util import await_only
 
+from fastqueue.cache import cache_channel, queue_key, routing_cache, stats_cache, topic_key
+from fastqueue.compression import compress_data, decompress_data
+from fastqueue.config import settings
+from fastqueue.counters import (
+    count_messages_by_state,
+    create_queue_counter,
+    get_counted_state,
+    get_message_state,
+    get_ready_filter,
+    load_oldest_message_created_at,
+    load_reconciled_at,
+    QueueCounterDeltas,
+    reconcile_queue_counters,
+    reset_queue_counter,
+)
 from fastqueue.exceptions import AlreadyExistsError, NotFoundError
-from fastqueue.models import Message, Queue, Topic
+from fastqueue.filters import MessageFilterIndex
+from fastqueue.logger import get_logger
+from fastqueue.metrics import (
+    record_acked,
+    record_dead_lettered,
+    record_delivered,
+    record_nacked,
+    record_published,
+    track_service_queries,
+)
+from fastqueue.models import Message, MessagePayload, Queue, QueueCounter, Topic
+from fastqueue.notifications import listener, message_waiters, messages_channel, notify
+from fastqueue.partitions import is_range_partitioned
 from fastqueue.schemas import (
+    AckDeadlineSchema,
+    CreateMessageBatchSchema,
     CreateMessageSchema,
     CreateQueueSchema,
     CreateTopicSchema,
     HealthSchema,
+    IngestErrorSchema,
+    IngestResultSchema,
+    ListMessageBatchSchema,
     ListMessageSchema,
     ListQueueSchema,
+    ListQueueStatsSchema,
     ListTopicSchema,
+    MessageIdsResultSchema,
+    MessageIdsSchema,
     MessageSchema,
+    ModifyAckDeadlineSchema,
     QueueSchema,
+    QueueStatsItemSchema,
     QueueStatsSchema,
     RedriveQueueSchema,
+    StreamCreditsSchema,
+    StreamMessageIdsResultSchema,
+    StreamMessageIdsSchema,
+    StreamMessagesSchema,
     TopicSchema,
     UpdateQueueSchema,
 )
 
+logger = get_logger(__name__)
+max_bind_parameters = 32767
+
 
 def apply_basic_filters(
     query: Any, filters: dict | None, offset: int | None, limit: int | None, order_by: Any | None = None
@@ -39,6 +111,16 @@ def apply_basic_filters(
     return query
 
 
+def apply_id_filters(query: Any, model: Any, after: str | None, prefix: str | None) -> Any:
+    # keyset pagination, the next page starts after the last id of the previous one using the primary key
+    if prefix is not None:
+        # LIKE can't seek the primary key index with a non C collation, the lower bound does
+        query = query.filter(model.id >= prefix, model.id.startswith(prefix, autoescape=True))
+    if after is not None:
+        query = query.filter(model.id > after)
+    return query
+
+
 def list_model(
     model: Any,
     filters: dict | None,
@@ -46,12 +128,41 @@ def list_model(
     limit: int | None,
     order_by: Any | None,
     session: Session,
+    after: str | None = None,
+    prefix: str | None = None,
 ) -> Any:
     query = session.query(model)
+    query = apply_id_filters(query=query, model=model, after=after, prefix=prefix)
     query = apply_basic_filters(query=query, filters=filters, offset=offset, limit=limit, order_by=order_by)
     return query.all()
 
 
+def list_page(
+    model: Any,
+    filters: dict | None,
+    offset: int | None,
+    limit: int | None,
+    after: str | None,
+    prefix: str | None,
+    session: Session,
+) -> tuple[list, str | None]:
+    # returns the instances ordered by id and the cursor of the next page, one more row is read to know if
+    # there is a next page
+    instances = list_model(
+        model=model,
+        filters=filters,
+        offset=offset,
+        limit=None if limit is None else limit + 1,
+        order_by=model.id,
+        session=session,
+        after=after,
+        prefix=prefix,
+    )
+    if limit is None or len(instances) <= limit:
+        return instances, None
+    return instances[:limit], instances[limit - 1].id
+
+
 def get_model(model: Any, filters: dict | None, session: Session) -> Any:
     query = session.query(model)
     query = apply_basic_filters(query=query, filters=filters, offset=None, limit=None)
@@ -61,13 +172,227 @@ def get_model(model: Any, filters: dict | None, session: Session) -> Any:
     return instance
 
 
-def get_filters_for_consume(queue: Any, now: datetime) -> list:
-    filters = [Message.queue_id == queue.id, Message.expired_at >= now, Message.scheduled_at <= now]
+def get_queue(queue_id: str, session: Session) -> QueueSchema:
+    key = queue_key(queue_id)
+    queue = routing_cache.get(key)
+    if queue is None:
+        # the invalidations that arrive while the queue is read are not missed
+        listener.start()
+        generation = routing_cache.generation(key)
+        queue = QueueSchema.from_orm(get_model(model=Queue, filters={"id": queue_id}, session=session))
+        routing_cache.set(key, queue, generation=generation)
+    return queue
+
+
+def get_topic_filter_index(topic_id: str, session: Session) -> MessageFilterIndex:
+    key = topic_key(topic_id)
+    filter_index = routing_cache.get(key)
+    if filter_index is None:
+        listener.start()
+        generation = routing_cache.generation(key)
+        topic = get_model(model=Topic, filters={"id": topic_id}, session=session)
+        queues = list_model(
+            model=Queue,
+            filters={"topic_id": topic.id},
+            offset=None,
+            limit=None,
+            order_by=Queue.id,
+            session=session,
+        )
+        filter_index = MessageFilterIndex([QueueSchema.from_orm(queue) for queue in queues])
+        routing_cache.set(key, filter_index, generation=generation)
+    return filter_index
+
+
+def commit_routing_changes(session: Session, keys: list[str]) -> None:
+    # the other processes drop their cached routing when the transaction commits
+    notify(session, cache_channel, keys)
+    session.commit()
+    routing_cache.delete_many(keys)
+
+
+def filter_by_message_ids(ids: list) -> Any:
+    # a single array parameter keeps the statement text the same for any number of ids
+    return Message.id == any_(cast(literal([str(id) for id in ids]), postgresql.ARRAY(postgresql.UUID)))
+
+
+def get_filters_for_delivery(queue: Any, now: datetime) -> list:
+    filters = [Message.queue_id == queue.id, Message.expired_at >= now]
     if queue.dead_queue_id is not None and queue.message_max_deliveries is not None:
         filters.append(Message.delivery_attempts < queue.message_max_deliveries)
     return filters
 
 
+def get_filters_for_consume(queue: Any, now: datetime) -> list:
+    return get_filters_for_delivery(queue, now) + [Message.scheduled_at <= now]
+
+
+def move_messages(queue_id: str, filters: list, values: dict, limit: int | None = None) -> Any:
+    # returns the moved messages as they were before the update, for the queue counters; limited moves
+    # skip the messages locked by consumers
+    previous = select(
+        Message.id, Message.scheduled_at, Message.delivery_attempts, Message.created_at, Message.updated_at
+    ).where(*filters)
+    if limit is not None:
+        previous = previous.limit(limit).with_for_update(skip_locked=True)
+    else:
+        previous = previous.with_for_update()
+    previous = previous.cte("previous").prefix_with("MATERIALIZED")
+    return (
+        update(Message.__table__)
+        .where(Message.id == previous.c.id, Message.queue_id == queue_id)
+        .values(**values)
+        .returning(
+            previous.c.scheduled_at,
+            previous.c.delivery_attempts,
+            previous.c.created_at,
+            previous.c.updated_at,
+        )
+        .cte("moved")
+    )
+
+
+def select_message_payloads(messages: Any) -> Any:
+    # messages is a cte of message rows, the payload of the ones published to many queues is read from
+    # message_payloads
+    return select(
+        *[column for column in messages.c if column.name not in ("data", "attributes")],
+        func.coalesce(messages.c.data, MessagePayload.data).label("data"),
+        func.coalesce(messages.c.attributes, MessagePayload.attributes).label("attributes"),
+        MessagePayload.compressed_data,
+    ).outerjoin(MessagePayload, MessagePayload.id == messages.c.payload_id)
+
+
+def get_message_schema(row: Any) -> MessageSchema:
+    # the rows come from the database, so they are not validated again; compressed data is only
+    # decompressed when the message is served
+    values = {name: getattr(row, name) for name in MessageSchema.__fields__}
+    if row.compressed_data is not None:
+        values["data"] = decompress_data(row.compressed_data)
+    return MessageSchema.construct(**values)
+
+
+def insert_rows(session: Session, table: Table, rows: list[dict]) -> None:
+    # multi-row INSERT ... VALUES statements, executemany would run one INSERT per row with asyncpg (it
+    # doesn't use the insertmanyvalues mode of sqlalchemy without RETURNING); the chunks keep the
+    # statements under the bind parameters limit of the postgres protocol
+    chunk_size = max(max_bind_parameters // len(rows[0]), 1)
+    for start in range(0, len(rows), chunk_size):
+        session.execute(insert(table).values(rows[start : start + chunk_size]))
+
+
+def copy_rows(session: Session, table: Table, rows: list[dict]) -> None:
+    # COPY runs in the transaction of the session, with asyncpg it must have executed a statement already
+    columns = list(rows[0])
+    json_columns = {column for column in columns if isinstance(table.c[column].type, postgresql.JSONB)}
+    records = [
+        tuple(
+            json.dumps(row[column]) if column in json_columns and row[column] is not None else row[column]
+            for column in columns
+        )
+        for row in rows
+    ]
+    connection = session.connection()
+    driver_connection = connection.connection.driver_connection
+    if connection.dialect.driver == "asyncpg":
+        await_only(driver_connection.copy_records_to_table(table.name, records=records, columns=columns))
+        return
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for record in records:
+        writer.writerow("\\x" + value.hex() if isinstance(value, bytes) else value for value in record)
+    buffer.seek(0)
+    with driver_connection.cursor() as cursor:
+        cursor.copy_expert(f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+async def split_lines(chunks: AsyncIterator[bytes], max_line_bytes: int) -> AsyncIterator[bytes | None]:
+    # yields the lines as they arrive, without buffering more than one line; the lines longer than
+    # max_line_bytes are skipped and yielded as None
+    line = bytearray()
+    too_long = False
+    async for chunk in chunks:
+        start = 0
+        while True:
+            end = chunk.find(b"\n", start)
+            if not too_long:
+                line += chunk[start:] if end == -1 else chunk[start:end]
+                too_long = len(line) > max_line_bytes
+                if too_long:
+                    line.clear()
+            if end == -1:
+                break
+            yield None if too_long else bytes(line)
+            line.clear()
+            too_long = False
+            start = end + 1
+    if line or too_long:
+        yield None if too_long else bytes(line)
+
+
+def get_validation_error_detail(exc: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(str(loc) for loc in error['loc'])}: {error['msg']}" for error in exc.errors()
+    )
+
+
+def get_oldest_message_age_seconds(
+    num_messages: int, oldest_created_at: datetime | None, now: datetime
+) -> float:
+    if not num_messages or oldest_created_at is None:
+        return 0
+    return max((now - oldest_created_at).total_seconds(), 0)
+
+
+def get_delivery_scheduled_at(queue: Any, now: datetime) -> datetime:
+    if queue.delivery_delay_seconds is not None:
+        return now + timedelta(seconds=queue.delivery_delay_seconds)
+    return now
+
+
+def get_retry_delay_seconds(
+    policy: Any, min_seconds: Any, max_seconds: Any, jitter: Any, delivery_attempts: Any
+) -> Any:
+    # the backoff before a message delivered delivery_attempts times is delivered again, the policy is given
+    # as columns of the queues or as literals of one queue
+    attempts = func.greatest(delivery_attempts, 1)
+    delay = case(
+        (policy == "fixed", min_seconds),
+        (policy == "linear", min_seconds * attempts),
+        (policy == "exponential", min_seconds * func.power(2, func.least(attempts - 1, 30))),
+        else_=0,
+    )
+    delay = func.least(delay, max_seconds)
+    # with jitter the messages that failed together are spread between half and all of the delay
+    return case((jitter, delay * (func.random() + 1) / 2), else_=delay)
+
+
+def get_queue_retry_delay_seconds(queue: Any, delivery_attempts: Any) -> Any:
+    return get_retry_delay_seconds(
+        literal(queue.retry_policy, String),
+        literal(queue.retry_min_backoff_seconds, Integer),
+        literal(queue.retry_max_backoff_seconds, Integer),
+        literal(queue.retry_jitter, Boolean),
+        delivery_attempts,
+    )
+
+
+def get_message_retry_delay_seconds() -> Any:
+    # with the policy of the queue of each message, the statement must join the queues
+    return get_retry_delay_seconds(
+        Queue.retry_policy,
+        Queue.retry_min_backoff_seconds,
+        Queue.retry_max_backoff_seconds,
+        Queue.retry_jitter,
+        Message.delivery_attempts,
+    )
+
+
+def add_seconds(timestamp: Any, seconds: Any) -> Any:
+    return timestamp + func.make_interval(0, 0, 0, 0, 0, 0, seconds)
+
+
 class Service:
     def __init__(self, session: Session):
         self.session = session
@@ -87,16 +412,34 @@ class TopicService(Service):
         topic = get_model(model=Topic, filters={"id": id}, session=self.session)
         return TopicSchema.from_orm(topic)
 
-    def list(self, filters: dict | None, offset: int | None, limit: int | None) -> ListTopicSchema:
-        topics = list_model(
-            model=Topic, filters=filters, offset=offset, limit=limit, order_by=Topic.id, session=self.session
+    def list(
+        self,
+        filters: dict | None,
+        offset: int | None,
+        limit: int | None,
+        after: str | None = None,
+        prefix: str | None = None,
+    ) -> ListTopicSchema:
+        topics, next_cursor = list_page(
+            model=Topic,
+            filters=filters,
+            offset=offset,
+            limit=limit,
+            after=after,
+            prefix=prefix,
+            session=self.session,
+        )
+        return ListTopicSchema(
+            data=[TopicSchema.from_orm(topic) for topic in topics], next_cursor=next_cursor
         )
-        return ListTopicSchema(data=[TopicSchema.from_orm(topic) for topic in topics])
 
     def delete(self, id: str) -> None:
         topic = get_model(model=Topic, filters={"id": id}, session=self.session)
+        queue_ids = [result[0] for result in self.session.query(Queue.id).filter_by(topic_id=topic.id)]
         self.session.query(Topic).filter_by(id=topic.id).delete()
-        self.session.commit()
+        commit_routing_changes(
+            self.session, [topic_key(topic.id)] + [queue_key(queue_id) for queue_id in queue_ids]
+        )
 
 
 class QueueService(Service):
@@ -117,12 +460,20 @@ class QueueService(Service):
             message_filters=data.message_filters,
             message_max_deliveries=data.message_max_deliveries,
             delivery_delay_seconds=data.delivery_delay_seconds,
+            retry_policy=data.retry_policy,
+            retry_min_backoff_seconds=data.retry_min_backoff_seconds,
+            retry_max_backoff_seconds=data.retry_max_backoff_seconds,
+            retry_jitter=data.retry_jitter,
             created_at=now,
             updated_at=now,
         )
         self.session.add(queue)
+        create_queue_counter(self.session, queue_id=queue.id, now=now)
+        keys = [queue_key(queue.id)]
+        if queue.topic_id is not None:
+            keys.append(topic_key(queue.topic_id))
         try:
-            self.session.commit()
+            commit_routing_changes(self.session, keys)
         except IntegrityError:
             raise AlreadyExistsError("This queue already exists")
         return QueueSchema.from_orm(queue)
@@ -136,6 +487,10 @@ class QueueService(Service):
         if data.dead_queue_id is not None:
             get_model(model=Queue, filters={"id": data.dead_queue_id}, session=self.session)
 
+        keys = [queue_key(queue.id)]
+        for topic_id in {queue.topic_id, data.topic_id} - {None}:
+            keys.append(topic_key(topic_id))
+
         queue.topic_id = data.topic_id
         queue.dead_queue_id = data.dead_queue_id
         queue.ack_deadline_seconds = data.ack_deadline_seconds
@@ -143,30 +498,63 @@ class QueueService(Service):
         queue.message_filters = data.message_filters
         queue.message_max_deliveries = data.message_max_deliveries
         queue.delivery_delay_seconds = data.delivery_delay_seconds
+        queue.retry_policy = data.retry_policy
+        queue.retry_min_backoff_seconds = data.retry_min_backoff_seconds
+        queue.retry_max_backoff_seconds = data.retry_max_backoff_seconds
+        queue.retry_jitter = data.retry_jitter
         queue.created_at = queue.created_at
         queue.updated_at = datetime.utcnow()
-        self.session.commit()
+        if settings.enable_queue_counters:
+            # the dead queue settings change which messages are ready
+            self.session.flush()
+            reconcile_queue_counters(self.session, queue_ids=[queue.id])
+        commit_routing_changes(self.session, keys)
         return QueueSchema.from_orm(queue)
 
     def get(self, id: str) -> QueueSchema:
         queue = get_model(model=Queue, filters={"id": id}, session=self.session)
         return QueueSchema.from_orm(queue)
 
-    def list(self, filters: dict | None, offset: int | None, limit: int | None) -> ListQueueSchema:
-        queues = list_model(
-            model=Queue, filters=filters, offset=offset, limit=limit, order_by=Queue.id, session=self.session
+    def list(
+        self,
+        filters: dict | None,
+        offset: int | None,
+        limit: int | None,
+        after: str | None = None,
+        prefix: str | None = None,
+    ) -> ListQueueSchema:
+        queues, next_cursor = list_page(
+            model=Queue,
+            filters=filters,
+            offset=offset,
+            limit=limit,
+            after=after,
+            prefix=prefix,
+            session=self.session,
+        )
+        return ListQueueSchema(
+            data=[QueueSchema.from_orm(queue) for queue in queues], next_cursor=next_cursor
         )
-        return ListQueueSchema(data=[QueueSchema.from_orm(queue) for queue in queues])
 
     def delete(self, id: str) -> None:
         queue = get_model(model=Queue, filters={"id": id}, session=self.session)
+        # the queues using this one as dead queue have dead_queue_id set to null
+        keys = [
+            queue_key(result[0]) for result in self.session.query(Queue.id).filter_by(dead_queue_id=queue.id)
+        ]
+        keys.append(queue_key(queue.id))
+        if queue.topic_id is not None:
+            keys.append(topic_key(queue.topic_id))
         self.session.query(Queue).filter_by(id=queue.id).delete()
-        self.session.commit()
+        commit_routing_changes(self.session, keys)
 
     def stats(self, id: str) -> QueueStatsSchema:
-        queue = get_model(model=Queue, filters={"id": id}, session=self.session)
+        queue = get_queue(queue_id=id, session=self.session)
 
         now = datetime.utcnow()
+        if settings.enable_queue_counters:
+            return self._stats_from_counters(queue=queue, now=now)
+
         filters = get_filters_for_consume(queue, now)
         num_undelivered_messages = self.session.query(Message).filter(*filters).count()
         oldest_unacked_message_age_seconds = 0
@@ -181,31 +569,145 @@ class QueueService(Service):
             oldest_unacked_message_age_seconds=oldest_unacked_message_age_seconds,
         )
 
+    def _stats_from_counters(self, queue: QueueSchema, now: datetime) -> QueueStatsSchema:
+        statement = select(QueueCounter.__table__).where(QueueCounter.queue_id == queue.id)
+        counter = self.session.execute(statement).first()
+        if counter is None:
+            reconcile_queue_counters(self.session, queue_ids=[queue.id])
+            counter = self.session.execute(statement).one()
+
+        num_undelivered_messages = max(counter.num_ready, 0)
+        oldest_message_created_at = counter.oldest_message_created_at
+        if num_undelivered_messages and oldest_message_created_at is None:
+            oldest_message_created_at = load_oldest_message_created_at(self.session, queue=queue, now=now)
+        self.session.commit()
+
+        return QueueStatsSchema(
+            num_undelivered_messages=num_undelivered_messages,
+            oldest_unacked_message_age_seconds=get_oldest_message_age_seconds(
+                num_undelivered_messages, oldest_message_created_at, now
+            ),
+        )
+
+    def _list_stats_from_messages(self, filters: list, now: datetime) -> list:
+        statement = (
+            select(
+                Queue.id,
+                func.count(Message.id).label("num_messages"),
+                func.min(Message.created_at).label("oldest_created_at"),
+            )
+            .select_from(Queue)
+            .outerjoin(
+                Message,
+                and_(Message.queue_id == Queue.id, Message.expired_at >= now, get_ready_filter(now)),
+            )
+            .where(*filters)
+            .group_by(Queue.id)
+            .order_by(Queue.id)
+        )
+        return self.session.execute(statement).all()
+
+    def _list_stats_from_counters(self, filters: list) -> list:
+        statement = (
+            select(
+                Queue.id,
+                QueueCounter.num_ready.label("num_messages"),
+                QueueCounter.oldest_message_created_at.label("oldest_created_at"),
+            )
+            .select_from(Queue)
+            .outerjoin(QueueCounter, QueueCounter.queue_id == Queue.id)
+            .where(*filters)
+            .order_by(Queue.id)
+        )
+        rows = self.session.execute(statement).all()
+        # missing counters and unknown oldest messages are recounted with one statement
+        queue_ids = [
+            row.id
+            for row in rows
+            if row.num_messages is None or (row.num_messages > 0 and row.oldest_created_at is None)
+        ]
+        if queue_ids:
+            reconcile_queue_counters(self.session, queue_ids=queue_ids)
+            rows = self.session.execute(statement).all()
+        return rows
+
+    def list_stats(
+        self, queue_ids: Sequence[str] | None = None, topic_id: str | None = None
+    ) -> ListQueueStatsSchema:
+        key = ("stats", topic_id, tuple(sorted(queue_ids)) if queue_ids is not None else None)
+        result = stats_cache.get(key)
+        if result is not None:
+            return result
+
+        filters = []
+        if queue_ids is not None:
+            filters.append(Queue.id.in_(queue_ids))
+        if topic_id is not None:
+            filters.append(Queue.topic_id == topic_id)
+
+        now = datetime.utcnow()
+        if settings.enable_queue_counters:
+            rows = self._list_stats_from_counters(filters=filters)
+        else:
+            rows = self._list_stats_from_messages(filters=filters, now=now)
+        self.session.commit()
+
+        data = []
+        for row in rows:
+            num_undelivered_messages = max(row.num_messages or 0, 0)
+            data.append(
+                QueueStatsItemSchema(
+                    queue_id=row.id,
+                    num_undelivered_messages=num_undelivered_messages,
+                    oldest_unacked_message_age_seconds=get_oldest_message_age_seconds(
+                        num_undelivered_messages, row.oldest_created_at, now
+                    ),
+                )
+            )
+        result = ListQueueStatsSchema(data=data)
+        stats_cache.set(key, result)
+        return result
+
     def purge(self, id: str) -> None:
         queue = get_model(model=Queue, filters={"id": id}, session=self.session)
         self.session.query(Message).filter_by(queue_id=queue.id).delete()
+        reset_queue_counter(self.session, queue_id=queue.id, now=datetime.utcnow())
         self.session.commit()
 
-    def _cleanup_expired_messages(self, queue: QueueSchema) -> None:
+    def _cleanup_expired_messages(self, queue: QueueSchema) -> int:
         now = datetime.utcnow()
 
         expired_at_filter = [Message.queue_id == queue.id, Message.expired_at <= now]
-        self.session.query(Message).filter(*expired_at_filter).delete()
-
-    def _cleanup_move_messages_to_dead_queue(self, queue: QueueSchema) -> None:
-        if queue.message_max_deliveries is None or queue.dead_queue_id is None:
-            return
-
-        dead_queue = get_model(model=Queue, filters={"id": queue.dead_queue_id}, session=self.session)
+        expired = (
+            select(Message.id)
+            .where(*expired_at_filter)
+            .limit(settings.queue_cleanup_chunk_size)
+            .with_for_update(skip_locked=True)
+            .cte("expired")
+            .prefix_with("MATERIALIZED")
+        )
+        deleted = (
+            delete(Message.__table__)
+            .where(Message.id == expired.c.id, Message.queue_id == queue.id)
+            .returning(
+                Message.scheduled_at, Message.delivery_attempts, Message.created_at, Message.updated_at
+            )
+            .cte("deleted")
+        )
+        counts = count_messages_by_state(self.session, messages=deleted, queue=queue)
+        deltas = QueueCounterDeltas()
+        deltas.remove(queue.id, counts)
+        deltas.apply(self.session, now=now)
+        self.session.commit()
+        return counts.count
 
+    def _cleanup_move_messages_to_dead_queue(self, queue: QueueSchema, dead_queue: QueueSchema) -> int:
         delivery_attempts_filter = [
             Message.queue_id == queue.id,
             Message.delivery_attempts >= queue.message_max_deliveries,
         ]
         now = datetime.utcnow()
-        scheduled_at = now
-        if dead_queue.delivery_delay_seconds is not None:
-            scheduled_at = now + timedelta(seconds=dead_queue.delivery_delay_seconds)
+        scheduled_at = get_delivery_scheduled_at(dead_queue, now)
         update_data = {
             "queue_id": queue.dead_queue_id,
             "delivery_attempts": 0,
@@ -213,17 +715,50 @@ class QueueService(Service):
             "scheduled_at": scheduled_at,
             "updated_at": now,
         }
-        self.session.query(Message).filter(*delivery_attempts_filter).update(
-            update_data, synchronize_session=False
+        moved = move_messages(
+            queue_id=queue.id,
+            filters=delivery_attempts_filter,
+            values=update_data,
+            limit=settings.queue_cleanup_chunk_size,
         )
+        counts = count_messages_by_state(self.session, messages=moved, queue=queue)
+        if counts.count:
+            deltas = QueueCounterDeltas()
+            deltas.remove(queue.id, counts)
+            deltas.add(
+                dead_queue.id, get_message_state(scheduled_at, 0, now), counts.count, counts.min_created_at
+            )
+            deltas.apply(self.session, now=now)
+            notify(self.session, messages_channel, [dead_queue.id])
+        self.session.commit()
+        if counts.count:
+            record_dead_lettered(queue.id, counts.count)
+        return counts.count
 
     def cleanup(self, id: str) -> None:
-        queue = get_model(model=Queue, filters={"id": id}, session=self.session)
+        queue = QueueSchema.from_orm(get_model(model=Queue, filters={"id": id}, session=self.session))
 
-        self._cleanup_expired_messages(queue=queue)
-        self._cleanup_move_messages_to_dead_queue(queue=queue)
+        # the messages are changed in chunks with a short transaction each, a chunk that is not full means
+        # that the remaining messages are done or locked by consumers and are left for the next cleanup
+        # with range partitioning the expired messages are removed by dropping their partitions
+        range_partitioned = is_range_partitioned(self.session.connection())
+        while (
+            not range_partitioned
+            and self._cleanup_expired_messages(queue=queue) >= settings.queue_cleanup_chunk_size
+        ):
+            pass
 
-        self.session.commit()
+        if queue.message_max_deliveries is None or queue.dead_queue_id is None:
+            return
+
+        dead_queue = QueueSchema.from_orm(
+            get_model(model=Queue, filters={"id": queue.dead_queue_id}, session=self.session)
+        )
+        while (
+            self._cleanup_move_messages_to_dead_queue(queue=queue, dead_queue=dead_queue)
+            >= settings.queue_cleanup_chunk_size
+        ):
+            pass
 
     def redrive(self, id: str, data: RedriveQueueSchema) -> None:
         queue = get_model(model=Queue, filters={"id": id}, session=self.session)
@@ -231,9 +766,7 @@ class QueueService(Service):
             model=Queue, filters={"id": data.destination_queue_id}, session=self.session
         )
         now = datetime.utcnow()
-        scheduled_at = now
-        if destination_queue.delivery_delay_seconds is not None:
-            scheduled_at = now + timedelta(seconds=destination_queue.delivery_delay_seconds)
+        scheduled_at = get_delivery_scheduled_at(destination_queue, now)
         filters = get_filters_for_consume(queue, now)
         update_data = {
             "queue_id": destination_queue.id,
@@ -242,98 +775,364 @@ class QueueService(Service):
             "scheduled_at": scheduled_at,
             "updated_at": now,
         }
-        self.session.query(Message).filter(*filters).update(update_data, synchronize_session=False)
+        moved = move_messages(queue_id=queue.id, filters=filters, values=update_data)
+        counts = count_messages_by_state(self.session, messages=moved, queue=queue)
+        if counts.count:
+            deltas = QueueCounterDeltas()
+            deltas.remove(queue.id, counts)
+            deltas.add(
+                destination_queue.id,
+                get_message_state(scheduled_at, 0, now),
+                counts.count,
+                counts.min_created_at,
+            )
+            deltas.apply(self.session, now=now)
+            notify(self.session, messages_channel, [destination_queue.id])
         self.session.commit()
 
 
 class MessageService(Service):
-    def _should_message_be_created_on_queue(
-        self, queue_filters: dict[str, list[Any]] | None, message_attributes: dict | None
-    ) -> bool:
-        if queue_filters is not None:
-            if message_attributes is None:
-                return False
+    def _build_message(
+        self, queue: Any, data: CreateMessageSchema, now: datetime, payload_id: uuid.UUID | None = None
+    ) -> dict:
+        scheduled_at = get_delivery_scheduled_at(queue, now)
+        return {
+            "id": uuid.uuid4(),
+            "queue_id": queue.id,
+            "data": None if payload_id else data.data,
+            "attributes": None if payload_id else data.attributes,
+            "payload_id": payload_id,
+            "delivery_attempts": 0,
+            "expired_at": now + timedelta(seconds=queue.message_retention_seconds),
+            "scheduled_at": scheduled_at,
+            "created_at": now,
+            "updated_at": now,
+        }
 
-            keys = set(queue_filters.keys()).intersection(set(message_attributes.keys()))
-            if len(keys) != len(queue_filters.keys()):
-                return False
+    def _prepare_messages(
+        self, filter_index: MessageFilterIndex, items: list[CreateMessageSchema], now: datetime
+    ) -> tuple[list[dict], list[list[dict]], QueueCounterDeltas]:
+        # returns the payloads, the message rows of each item and the counter deltas
+        payloads = []
+        item_rows: list[list[dict]] = [[] for _ in items]
+        deltas = QueueCounterDeltas()
+        for item, rows in zip(items, item_rows):
+            queues = filter_index.match(item.attributes)
+            if not queues:
+                continue
+            # a message published to many queues stores its payload once, each queue only gets a reference,
+            # and compressed data is always stored as a payload
+            payload_id = None
+            compressed_data = compress_data(item.data)
+            if len(queues) > 1 or compressed_data is not None:
+                payload_id = uuid.uuid4()
+                payloads.append(
+                    {
+                        "id": payload_id,
+                        "data": None if compressed_data is not None else item.data,
+                        "compressed_data": compressed_data,
+                        "attributes": item.attributes,
+                        "created_at": now,
+                    }
+                )
+            for queue in queues:
+                row = self._build_message(queue=queue, data=item, now=now, payload_id=payload_id)
+                rows.append(row)
+                deltas.add(queue.id, get_message_state(row["scheduled_at"], 0, now), created_at=now)
+        return payloads, item_rows, deltas
+
+    def _write_messages(
+        self,
+        topic_id: str,
+        payloads: list[dict],
+        rows: list[dict],
+        deltas: QueueCounterDeltas,
+        now: datetime,
+        copy: bool = False,
+    ) -> None:
+        # the notification is only delivered on commit, sending it first also begins the transaction
+        notify(self.session, messages_channel, sorted({row["queue_id"] for row in rows}))
+        if copy:
+            if payloads:
+                copy_rows(self.session, MessagePayload.__table__, payloads)
+            copy_rows(self.session, Message.__table__, rows)
+        else:
+            if payloads:
+                insert_rows(self.session, MessagePayload.__table__, payloads)
+            insert_rows(self.session, Message.__table__, rows)
+        deltas.apply(self.session, now=now)
+        self.session.commit()
+        record_published(topic_id, (row["queue_id"] for row in rows))
 
-            for key in keys:
-                if message_attributes[key] not in queue_filters[key]:
-                    return False
+    def _create_messages(self, topic_id: str, items: list[CreateMessageSchema]) -> list[ListMessageSchema]:
+        filter_index = get_topic_filter_index(topic_id=topic_id, session=self.session)
+        if not filter_index.queues:
+            return [ListMessageSchema(data=[]) for _ in items]
+
+        now = datetime.utcnow()
+        payloads, item_rows, deltas = self._prepare_messages(filter_index, items, now)
+        rows = [row for rows in item_rows for row in rows]
+        if rows:
+            self._write_messages(topic_id, payloads, rows, deltas, now)
+        # the items are already validated, the messages are built from them without validating them again
+        fields = [name for name in MessageSchema.__fields__ if name not in ("data", "attributes")]
+        return [
+            ListMessageSchema.construct(
+                data=[
+                    MessageSchema.construct(
+                        **{name: row[name] for name in fields}, data=item.data, attributes=item.attributes
+                    )
+                    for row in rows
+                ]
+            )
+            for item, rows in zip(items, item_rows)
+        ]
 
-        return True
+    def _ingest_messages(self, topic_id: str, items: list[CreateMessageSchema]) -> int:
+        # like create_batch, but written with COPY and without building the response
+        filter_index = get_topic_filter_index(topic_id=topic_id, session=self.session)
+        now = datetime.utcnow()
+        payloads, item_rows, deltas = self._prepare_messages(filter_index, items, now)
+        rows = [row for rows in item_rows for row in rows]
+        if rows:
+            self._write_messages(topic_id, payloads, rows, deltas, now, copy=True)
+        return len(rows)
 
     def create(self, topic_id: str, data: CreateMessageSchema) -> ListMessageSchema:
-        result = ListMessageSchema(data=[])
-        topic = get_model(model=Topic, filters={"id": topic_id}, session=self.session)
-        queues = list_model(
-            model=Queue,
-            filters={"topic_id": topic.id},
-            offset=None,
-            limit=None,
-            order_by=Queue.id,
-            session=self.session,
-        )
-        if not queues:
-            return result
+        return self._create_messages(topic_id=topic_id, items=[data])[0]
 
-        for queue in queues:
-            if self._should_message_be_created_on_queue(queue.message_filters, data.attributes) is False:
-                continue
+    def create_batch(self, topic_id: str, data: CreateMessageBatchSchema) -> ListMessageBatchSchema:
+        return ListMessageBatchSchema.construct(
+            data=self._create_messages(topic_id=topic_id, items=data.data)
+        )
 
-            now = datetime.utcnow()
-            scheduled_at = now
-            if queue.delivery_delay_seconds is not None:
-                scheduled_at = now + timedelta(seconds=queue.delivery_delay_seconds)
-            message = Message(
-                id=uuid.uuid4().hex,
-                queue_id=queue.id,
-                data=data.data,
-                attributes=data.attributes,
-                delivery_attempts=0,
-                expired_at=now + timedelta(seconds=queue.message_retention_seconds),
+    def _consume(self, queue: QueueSchema, limit: int) -> ListMessageSchema:
+        now = datetime.utcnow()
+        filters = get_filters_for_consume(queue, now)
+        # the cte is materialized, so the locked rows are selected only once and limit is respected, it also
+        # keeps the previous state of the messages for the queue counters
+        consumed = (
+            select(Message.id, Message.scheduled_at, Message.updated_at)
+            .where(*filters)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+            .cte("consumed")
+            .prefix_with("MATERIALIZED")
+        )
+        # a message whose ack deadline ends is delivered again after the backoff of the retry policy, which
+        # is added to the deadline here
+        scheduled_at = now + timedelta(seconds=queue.ack_deadline_seconds)
+        if queue.retry_policy is not None:
+            scheduled_at = add_seconds(
+                scheduled_at, get_queue_retry_delay_seconds(queue, Message.delivery_attempts + 1)
+            )
+        # the queue_id of the update lets postgres prune the hash partitions of the other queues
+        updated = (
+            update(Message.__table__)
+            .where(Message.id == consumed.c.id, Message.queue_id == queue.id)
+            .values(
+                delivery_attempts=Message.delivery_attempts + 1,
                 scheduled_at=scheduled_at,
-                created_at=now,
                 updated_at=now,
             )
-            self.session.add(message)
-            result.data.append(MessageSchema.from_orm(message))
+            .returning(
+                Message.__table__,
+                consumed.c.scheduled_at.label("previous_scheduled_at"),
+                consumed.c.updated_at.label("previous_updated_at"),
+            )
+            .cte("updated")
+        )
+        rows = self.session.execute(select_message_payloads(updated)).all()
+        reconciled_at = load_reconciled_at(self.session, [queue.id]).get(queue.id) if rows else None
+        deltas = QueueCounterDeltas()
+        for row in rows:
+            # redelivered messages whose ack deadline ended are still counted in flight until reconciled
+            state = get_counted_state(
+                row.previous_scheduled_at,
+                row.delivery_attempts - 1,
+                row.previous_updated_at,
+                reconciled_at,
+            )
+            deltas.move(queue.id, state, "num_in_flight", created_at=row.created_at)
+        deltas.apply(self.session, now=now)
+        self.session.commit()
+        record_delivered(rows)
+        return ListMessageSchema.construct(data=[get_message_schema(row) for row in rows])
 
+    def _wait_timeout(self, queue: QueueSchema, timeout: float) -> float:
+        # messages that become visible by time (delayed or with an expired ack deadline) are not
+        # notified, so wait until the next one is scheduled at most
+        now = datetime.utcnow()
+        filters = get_filters_for_delivery(queue, now) + [Message.scheduled_at > now]
+        scheduled_at = self.session.execute(select(func.min(Message.scheduled_at)).where(*filters)).scalar()
+        # release the connection while waiting
         self.session.commit()
-        return result
+        if scheduled_at is not None:
+            timeout = min(timeout, (scheduled_at - datetime.utcnow()).total_seconds())
+        return max(timeout, 0)
 
-    def list_for_consume(self, queue_id: str, limit: int) -> ListMessageSchema:
-        queue = get_model(model=Queue, filters={"id": queue_id}, session=self.session)
+    def _get_queue(self, queue_id: str) -> QueueSchema:
+        return get_queue(queue_id=queue_id, session=self.session)
+
+    def _get_topic_filter_index(self, topic_id: str) -> MessageFilterIndex:
+        return get_topic_filter_index(topic_id=topic_id, session=self.session)
+
+    def list_for_consume(self, queue_id: str, limit: int, wait_seconds: int = 0) -> ListMessageSchema:
+        queue = self._get_queue(queue_id)
+        if wait_seconds <= 0:
+            return self._consume(queue, limit)
+
+        deadline = monotonic() + wait_seconds
+        event = threading.Event()
+        with message_waiters.subscribe(queue.id, event.set):
+            while True:
+                event.clear()
+                result = self._consume(queue, limit)
+                timeout = deadline - monotonic()
+                if result.data or timeout <= 0:
+                    return result
+
+                event.wait(self._wait_timeout(queue, timeout))
+
+    def _delete_messages(self, filter: Any) -> list:
         now = datetime.utcnow()
-        filters = get_filters_for_consume(queue, now)
-        data = []
-        messages = (
-            self.session.query(Message).filter(*filters).with_for_update(skip_locked=True).limit(limit).all()
+        statement = (
+            delete(Message)
+            .where(filter)
+            .returning(
+                Message.id,
+                Message.queue_id,
+                Message.scheduled_at,
+                Message.delivery_attempts,
+                Message.created_at,
+                Message.updated_at,
+            )
         )
-        for message in messages:
-            message.delivery_attempts += 1
-            message.scheduled_at = now + timedelta(seconds=queue.ack_deadline_seconds)
-            message.updated_at = now
-            data.append(MessageSchema.from_orm(message))
-
+        rows = self.session.execute(statement).all()
+        reconciled_at = load_reconciled_at(self.session, {row.queue_id for row in rows})
+        deltas = QueueCounterDeltas()
+        for row in rows:
+            state = get_counted_state(
+                row.scheduled_at, row.delivery_attempts, row.updated_at, reconciled_at.get(row.queue_id)
+            )
+            deltas.add(row.queue_id, state, -1, created_at=row.created_at)
+        deltas.apply(self.session, now=now)
         self.session.commit()
-        return ListMessageSchema(data=data)
+        record_acked(rows, now)
+        return [row.id for row in rows]
 
     def ack(self, id: str) -> None:
-        self.session.query(Message).filter_by(id=id).delete()
+        self._delete_messages(Message.id == id)
+
+    def _schedule_messages(self, filters: list, scheduled_at: Any, now: datetime) -> list:
+        # changes when the messages are delivered again, scheduled_at can be an expression of their columns
+        # and of the columns of their queues
+        previous = (
+            select(Message.id, Message.scheduled_at, Message.updated_at)
+            .where(*filters)
+            .with_for_update()
+            .cte("previous")
+            .prefix_with("MATERIALIZED")
+        )
+        statement = (
+            update(Message.__table__)
+            .where(Message.id == previous.c.id, Queue.id == Message.queue_id)
+            .values(scheduled_at=scheduled_at, updated_at=now)
+            .returning(
+                Message.id,
+                Message.queue_id,
+                Message.scheduled_at,
+                Message.delivery_attempts,
+                Message.created_at,
+                previous.c.scheduled_at.label("previous_scheduled_at"),
+                previous.c.updated_at.label("previous_updated_at"),
+            )
+        )
+        rows = self.session.execute(statement).all()
+        reconciled_at = load_reconciled_at(self.session, {row.queue_id for row in rows})
+        deltas = QueueCounterDeltas()
+        ready_queue_ids = set()
+        for row in rows:
+            previous_state = get_counted_state(
+                row.previous_scheduled_at,
+                row.delivery_attempts,
+                row.previous_updated_at,
+                reconciled_at.get(row.queue_id),
+            )
+            state = get_message_state(row.scheduled_at, row.delivery_attempts, now)
+            if state != previous_state:
+                deltas.move(row.queue_id, previous_state, state, created_at=row.created_at)
+            if state == "num_ready":
+                ready_queue_ids.add(row.queue_id)
+        deltas.apply(self.session, now=now)
+        if ready_queue_ids:
+            notify(self.session, messages_channel, sorted(ready_queue_ids))
         self.session.commit()
+        return rows
 
-    def nack(self, id: str) -> None:
-        try:
-            message = get_model(model=Message, filters={"id": id}, session=self.session)
-        except NotFoundError:
-            return
+    def _nack_messages(self, filter: Any, delay_seconds: int | None = None) -> list:
+        now = datetime.utcnow()
+        if delay_seconds is not None:
+            scheduled_at = now + timedelta(seconds=delay_seconds)
+        else:
+            scheduled_at = add_seconds(now, get_message_retry_delay_seconds())
+        rows = self._schedule_messages([filter], scheduled_at=scheduled_at, now=now)
+        record_nacked(row.queue_id for row in rows)
+        return [row.id for row in rows]
 
+    def _modify_ack_deadline(self, filter: Any, ack_deadline_seconds: int) -> list:
+        # only the messages in flight, whose ack deadline has not ended, have a lease to change; like on
+        # consume, the backoff of the retry policy is added to the new deadline, so it still applies when the
+        # deadline ends and a deadline of 0 waits for it like a nack
         now = datetime.utcnow()
-        message.scheduled_at = now
-        message.updated_at = now
+        filters = [filter, Message.delivery_attempts > 0, Message.scheduled_at > now]
+        scheduled_at = add_seconds(
+            now + timedelta(seconds=ack_deadline_seconds), get_message_retry_delay_seconds()
+        )
+        rows = self._schedule_messages(filters, scheduled_at=scheduled_at, now=now)
+        return [row.id for row in rows]
+
+    def nack(self, id: str, delay_seconds: int | None = None) -> None:
+        self._nack_messages(Message.id == id, delay_seconds=delay_seconds)
+
+    def modify_ack_deadline(self, id: str, data: AckDeadlineSchema) -> None:
+        self._modify_ack_deadline(Message.id == id, data.ack_deadline_seconds)
+
+    def _cleanup_payloads(self) -> int:
+        # a payload without messages is never referenced again, its messages were acked, expired or purged
+        orphans = (
+            select(MessagePayload.id)
+            .where(~exists().where(Message.payload_id == MessagePayload.id))
+            .limit(settings.queue_cleanup_chunk_size)
+            .with_for_update(skip_locked=True)
+            .cte("orphans")
+            .prefix_with("MATERIALIZED")
+        )
+        result = self.session.execute(
+            delete(MessagePayload.__table__).where(MessagePayload.id == orphans.c.id)
+        )
         self.session.commit()
+        return result.rowcount
+
+    def cleanup_payloads(self) -> None:
+        while self._cleanup_payloads() >= settings.queue_cleanup_chunk_size:
+            pass
+
+    def _not_found_ids(self, ids: list, found_ids: list) -> MessageIdsResultSchema:
+        found_ids = {str(id) for id in found_ids}
+        return MessageIdsResultSchema(not_found_ids=[id for id in ids if str(id) not in found_ids])
+
+    def ack_batch(self, data: MessageIdsSchema) -> MessageIdsResultSchema:
+        found_ids = self._delete_messages(filter_by_message_ids(data.ids))
+        return self._not_found_ids(data.ids, found_ids)
+
+    def nack_batch(self, data: MessageIdsSchema, delay_seconds: int | None = None) -> MessageIdsResultSchema:
+        found_ids = self._nack_messages(filter_by_message_ids(data.ids), delay_seconds=delay_seconds)
+        return self._not_found_ids(data.ids, found_ids)
+
+    def modify_ack_deadline_batch(self, data: ModifyAckDeadlineSchema) -> MessageIdsResultSchema:
+        found_ids = self._modify_ack_deadline(filter_by_message_ids(data.ids), data.ack_deadline_seconds)
+        return self._not_found_ids(data.ids, found_ids)
 
 
 class HealthService(Service):
@@ -345,3 +1144,246 @@ class HealthService(Service):
             success = False
 
         return HealthSchema(success=success)
+
+
+class AsyncService:
+    # the sync services run inside AsyncSession.run_sync, where every database call is awaited on the
+    # asyncio driver instead of blocking a thread
+    service_class: type[Service]
+
+    def __init__(self, session: AsyncSession):
+        self.session = session
+
+    async def run(self, method: str, **kwargs: Any) -> Any:
+        def call(session: Session) -> Any:
+            with track_service_queries(f"{self.service_class.__name__}.{method}"):
+                return getattr(self.service_class(session=session), method)(**kwargs)
+
+        return await self.session.run_sync(call)
+
+
+class AsyncTopicService(AsyncService):
+    service_class = TopicService
+
+    async def create(self, data: CreateTopicSchema) -> TopicSchema:
+        return await self.run("create", data=data)
+
+    async def get(self, id: str) -> TopicSchema:
+        return await self.run("get", id=id)
+
+    async def list(
+        self,
+        filters: dict | None,
+        offset: int | None,
+        limit: int | None,
+        after: str | None = None,
+        prefix: str | None = None,
+    ) -> ListTopicSchema:
+        return await self.run("list", filters=filters, offset=offset, limit=limit, after=after, prefix=prefix)
+
+    async def delete(self, id: str) -> None:
+        return await self.run("delete", id=id)
+
+
+class AsyncQueueService(AsyncService):
+    service_class = QueueService
+
+    async def create(self, data: CreateQueueSchema) -> QueueSchema:
+        return await self.run("create", data=data)
+
+    async def update(self, id: str, data: UpdateQueueSchema) -> QueueSchema:
+        return await self.run("update", id=id, data=data)
+
+    async def get(self, id: str) -> QueueSchema:
+        return await self.run("get", id=id)
+
+    async def list(
+        self,
+        filters: dict | None,
+        offset: int | None,
+        limit: int | None,
+        after: str | None = None,
+        prefix: str | None = None,
+    ) -> ListQueueSchema:
+        return await self.run("list", filters=filters, offset=offset, limit=limit, after=after, prefix=prefix)
+
+    async def delete(self, id: str) -> None:
+        return await self.run("delete", id=id)
+
+    async def stats(self, id: str) -> QueueStatsSchema:
+        return await self.run("stats", id=id)
+
+    async def list_stats(
+        self, queue_ids: Sequence[str] | None = None, topic_id: str | None = None
+    ) -> ListQueueStatsSchema:
+        return await self.run("list_stats", queue_ids=queue_ids, topic_id=topic_id)
+
+    async def purge(self, id: str) -> None:
+        return await self.run("purge", id=id)
+
+    async def cleanup(self, id: str) -> None:
+        return await self.run("cleanup", id=id)
+
+    async def redrive(self, id: str, data: RedriveQueueSchema) -> None:
+        return await self.run("redrive", id=id, data=data)
+
+
+class AsyncMessageService(AsyncService):
+    service_class = MessageService
+
+    async def create(self, topic_id: str, data: CreateMessageSchema) -> ListMessageSchema:
+        return await self.run("create", topic_id=topic_id, data=data)
+
+    async def create_batch(self, topic_id: str, data: CreateMessageBatchSchema) -> ListMessageBatchSchema:
+        return await self.run("create_batch", topic_id=topic_id, data=data)
+
+    async def list_for_consume(self, queue_id: str, limit: int, wait_seconds: int = 0) -> ListMessageSchema:
+        queue = await self.run("_get_queue", queue_id=queue_id)
+        if wait_seconds <= 0:
+            return await self.run("_consume", queue=queue, limit=limit)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait_seconds
+        event = asyncio.Event()
+        with message_waiters.subscribe(queue.id, lambda: loop.call_soon_threadsafe(event.set)):
+            while True:
+                event.clear()
+                result = await self.run("_consume", queue=queue, limit=limit)
+                timeout = deadline - loop.time()
+                if result.data or timeout <= 0:
+                    return result
+
+                timeout = await self.run("_wait_timeout", queue=queue, timeout=timeout)
+                try:
+                    await asyncio.wait_for(event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def ingest(self, topic_id: str, chunks: AsyncIterator[bytes]) -> IngestResultSchema:
+        # the body is read one batch of lines at a time, the batches are committed as they are written; a
+        # batch that fails to be written stops the ingest, the result has the counts of the batches before it
+        await self.run("_get_topic_filter_index", topic_id=topic_id)
+        result = IngestResultSchema(num_lines=0, num_messages=0, num_errors=0, errors=[])
+        items: list[CreateMessageSchema] = []
+        # the errors point to the physical line, blank lines included
+        line_number = 0
+        first_line_number = 0
+
+        def add_error(detail: str) -> None:
+            result.num_errors += 1
+            if len(result.errors) < settings.max_ingest_errors:
+                result.errors.append(IngestErrorSchema(line=line_number, detail=detail))
+
+        async def write() -> bool:
+            try:
+                result.num_messages += await self.run("_ingest_messages", topic_id=topic_id, items=items)
+            except Exception:
+                logger.exception("ingest batch failed", extra=dict(topic_id=topic_id))
+                await self.session.rollback()
+                result.error = f"failed to write the messages of lines {first_line_number} to {line_number}"
+                return False
+            return True
+
+        async for line in split_lines(chunks, settings.max_ingest_line_bytes):
+            line_number += 1
+            if line is not None and not line.strip():
+                continue
+            result.num_lines += 1
+            if line is None:
+                add_error(f"line is longer than {settings.max_ingest_line_bytes} bytes")
+                continue
+            try:
+                item = CreateMessageSchema.parse_raw(line)
+            except ValidationError as exc:
+                add_error(get_validation_error_detail(exc))
+                continue
+            if not items:
+                first_line_number = line_number
+            items.append(item)
+            if len(items) >= settings.ingest_batch_size:
+                if not await write():
+                    return result
+                items = []
+        if items:
+            await write()
+        return result
+
+    async def stream(
+        self,
+        queue_id: str,
+        receive: Callable[[], Awaitable[StreamCreditsSchema | StreamMessageIdsSchema]],
+        send: Callable[[StreamMessagesSchema | StreamMessageIdsResultSchema], Awaitable[None]],
+    ) -> None:
+        # pushes up to the credits granted by the client, one consume per batch, and handles the acks and
+        # nacks received in between; it returns when receive raises (the client disconnected)
+        queue = await self.run("_get_queue", queue_id=queue_id)
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        credits = 0
+        with message_waiters.subscribe(queue.id, lambda: loop.call_soon_threadsafe(event.set)):
+            receiving = asyncio.ensure_future(receive())
+            try:
+                while True:
+                    if credits > 0:
+                        event.clear()
+                        limit = min(credits, settings.max_batch_size)
+                        result = await self.run("_consume", queue=queue, limit=limit)
+                        if result.data:
+                            credits -= len(result.data)
+                            await send(StreamMessagesSchema.construct(data=result.data))
+                            if not receiving.done():
+                                continue
+                        else:
+                            timeout = await self.run(
+                                "_wait_timeout", queue=queue, timeout=settings.max_wait_seconds
+                            )
+                            waiting = asyncio.ensure_future(event.wait())
+                            await asyncio.wait(
+                                {receiving, waiting}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                            )
+                            waiting.cancel()
+                    else:
+                        await asyncio.wait({receiving})
+
+                    if not receiving.done():
+                        continue
+                    request = receiving.result()
+                    receiving = asyncio.ensure_future(receive())
+                    if isinstance(request, StreamCreditsSchema):
+                        credits += request.credits
+                        continue
+                    data = MessageIdsSchema(ids=request.ids)
+                    method = "ack_batch" if request.type == "ack" else "nack_batch"
+                    result = await self.run(method, data=data)
+                    await send(
+                        StreamMessageIdsResultSchema(type=request.type, not_found_ids=result.not_found_ids)
+                    )
+            finally:
+                receiving.cancel()
+
+    async def ack(self, id: str) -> None:
+        return await self.run("ack", id=id)
+
+    async def nack(self, id: str, delay_seconds: int | None = None) -> None:
+        return await self.run("nack", id=id, delay_seconds=delay_seconds)
+
+    async def ack_batch(self, data: MessageIdsSchema) -> MessageIdsResultSchema:
+        return await self.run("ack_batch", data=data)
+
+    async def nack_batch(
+        self, data: MessageIdsSchema, delay_seconds: int | None = None
+    ) -> MessageIdsResultSchema:
+        return await self.run("nack_batch", data=data, delay_seconds=delay_seconds)
+
+    async def modify_ack_deadline(self, id: str, data: AckDeadlineSchema) -> None:
+        return await self.run("modify_ack_deadline", id=id, data=data)
+
+    async def modify_ack_deadline_batch(self, data: ModifyAckDeadlineSchema) -> MessageIdsResultSchema:
+        return await self.run("modify_ack_deadline_batch", data=data)
+
+
+class AsyncHealthService(AsyncService):
+    service_class = HealthService
+
+    async def check(self) -> HealthSchema:
+        return await self.run("check")
@@ -1,14 +1,40 @@
+from concurrent.futures import as_completed, ThreadPoolExecutor
+from datetime import datetime
+
+from prometheus_client import start_http_server
 from rocketry import Rocketry
 from rocketry.conds import every
+from sqlalchemy import text
 
 from fastqueue.config import settings
-from fastqueue.database import SessionLocal
+from fastqueue.counters import reconcile_queue_counters
+from fastqueue.database import engine, SessionLocal
+from fastqueue.exceptions import NotFoundError
 from fastqueue.logger import get_logger
 from fastqueue.models import Queue
-from fastqueue.services import QueueService
+from fastqueue.partitions import (
+    create_partition,
+    delete_expired_default_messages,
+    drop_partition,
+    get_expired_partitions,
+    get_missing_partitions,
+    is_range_partitioned,
+    list_partitions,
+)
+from fastqueue.services import MessageService, QueueService
 
 logger = get_logger(__name__)
 worker = Rocketry(execution="main")
+partitions_lock_timeout = "5s"
+
+
+def cleanup_queue(queue_id: str) -> None:
+    with SessionLocal() as session:
+        try:
+            QueueService(session=session).cleanup(id=queue_id)
+        except NotFoundError:
+            # the queue was removed after the task started
+            pass
 
 
 @worker.task(every(f"{settings.queue_cleanup_interval_seconds} seconds"))
@@ -16,12 +42,82 @@ def queue_cleanup_task():
     logger.info("starting queue_cleanup task")
 
     with SessionLocal() as session:
-        for result in session.query(Queue.id):
-            queue_id = result[0]
-            QueueService(session=session).cleanup(id=queue_id)
+        queue_ids = [result[0] for result in session.query(Queue.id).order_by(Queue.id)]
+
+    # each thread uses its own session, so up to queue_cleanup_concurrency connections of the pool
+    with ThreadPoolExecutor(max_workers=settings.queue_cleanup_concurrency) as executor:
+        futures = {executor.submit(cleanup_queue, queue_id): queue_id for queue_id in queue_ids}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception:
+                logger.exception("queue cleanup failed", extra=dict(queue_id=futures[future]))
+
+    # the payloads of the messages removed by the cleanup
+    with SessionLocal() as session:
+        MessageService(session=session).cleanup_payloads()
 
     logger.info("finishing queue_cleanup task")
 
 
+@worker.task(every(f"{settings.queue_counters_reconcile_interval_seconds} seconds"))
+def queue_counters_reconcile_task():
+    if not settings.enable_queue_counters:
+        return
+
+    logger.info("starting queue_counters_reconcile task")
+
+    with SessionLocal() as session:
+        reconcile_queue_counters(session)
+        session.commit()
+
+    logger.info("finishing queue_counters_reconcile task")
+
+
+@worker.task(every(f"{settings.queue_cleanup_interval_seconds} seconds"))
+def messages_partitions_task():
+    # the table decides, the setting only changes it through the db-partition command
+    with engine.connect() as connection:
+        range_partitioned = is_range_partitioned(connection)
+        partitions = list_partitions(connection) if range_partitioned else []
+        connection.commit()
+    if not range_partitioned:
+        if settings.enable_messages_partitioning:
+            logger.error("messages table is not partitioned, run the db-partition command to partition it")
+        return
+
+    logger.info("starting messages_partitions task")
+
+    now = datetime.utcnow()
+
+    # each partition is changed in its own short transaction, a lock that is not granted in time is retried
+    # on the next run instead of queueing the queries on the messages table behind it
+    operations = [
+        (create_partition, dict(start=start, end=end))
+        for start, end in get_missing_partitions(partitions, now)
+    ]
+    operations += [(drop_partition, dict(name=name)) for name in get_expired_partitions(partitions, now)]
+    operations.append((delete_expired_default_messages, dict(now=now)))
+    removed_queue_ids = set()
+    for operation, kwargs in operations:
+        try:
+            with engine.begin() as connection:
+                connection.execute(text(f"SET LOCAL lock_timeout = '{partitions_lock_timeout}'"))
+                removed_queue_ids.update(operation(connection, **kwargs) or [])
+        except Exception:
+            logger.exception("messages partition operation failed", extra=dict(operation=operation.__name__))
+
+    # the dropped and deleted messages do not update the queue counters, so they are counted again
+    if settings.enable_queue_counters and removed_queue_ids:
+        with SessionLocal() as session:
+            reconcile_queue_counters(session, queue_ids=sorted(removed_queue_ids))
+            session.commit()
+
+    logger.info("finishing messages_partitions task")
+
+
 def run_worker():
+    # the dead-lettered messages and the database queries are recorded in the worker process
+    if settings.enable_prometheus_metrics:
+        start_http_server(settings.worker_metrics_port)
     return worker.run(debug=settings.debug)
@@ -2,14 +2,19 @@ import pytest
 from fastapi.testclient import TestClient
 
 from fastqueue.api import app
-from fastqueue.database import Base, engine, SessionLocal
-from fastqueue.models import Message, Queue, Topic
+from fastqueue.cache import routing_cache, stats_cache
+from fastqueue.config import settings
+from fastqueue.database import async_engine, AsyncSessionLocal, Base, engine, SessionLocal
+from fastqueue.models import Message, MessagePayload, Queue, Topic
 from tests.factories import MessageFactory, QueueFactory, TopicFactory
 
 
 @pytest.fixture
 def client():
-    return TestClient(app)
+    # the context manager runs the shutdown event, which closes the async connections bound to the
+    # event loop of this client
+    with TestClient(app) as client:
+        yield client
 
 
 @pytest.fixture(scope="session")
@@ -26,10 +31,30 @@ def session(connection):
     session = SessionLocal(bind=connection)
     yield session
     session.query(Message).delete()
+    session.query(MessagePayload).delete()
     session.query(Queue).delete()
     session.query(Topic).delete()
     session.commit()
     session.close()
+    routing_cache.clear()
+    stats_cache.clear()
+
+
+@pytest.fixture
+def queue_counters(monkeypatch):
+    monkeypatch.setattr(settings, "enable_queue_counters", True)
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def async_session(session):
+    async with AsyncSessionLocal() as async_session:
+        yield async_session
+    await async_engine.dispose()
 
 
 @pytest.fixture
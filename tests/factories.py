@@ -30,6 +30,10 @@ class QueueFactory(factory.Factory):
     message_retention_seconds = default_message_retention_seconds
     message_max_deliveries = None
     delivery_delay_seconds = None
+    retry_policy = None
+    retry_min_backoff_seconds = None
+    retry_max_backoff_seconds = None
+    retry_jitter = False
     created_at = factory.LazyFunction(datetime.utcnow)
     updated_at = factory.LazyFunction(datetime.utcnow)
 
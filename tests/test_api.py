@@ -1,7 +1,17 @@
+import asyncio
+import uuid
 from datetime import datetime, timedelta
 
-from fastapi import status
+import pytest
+from fastapi import status, WebSocketDisconnect
+from fastapi.encoders import jsonable_encoder
+from fastapi.testclient import TestClient
+from sqlalchemy import text
 
+from fastqueue.api import app
+from fastqueue.notifications import listener
+from fastqueue.schemas import MessageSchema
+from fastqueue.services import MessageService
 from tests.factories import MessageFactory, QueueFactory, TopicFactory
 
 
@@ -60,6 +70,31 @@ def test_list_topics(session, client):
     assert len(response_data["data"]) == 5
 
 
+def test_list_topics_with_cursor(session, client):
+    topics = TopicFactory.build_batch(5)
+    session.add_all(topics)
+    session.commit()
+
+    ids = []
+    params = {"limit": 2}
+    while True:
+        response_data = client.get("/topics", params=params).json()
+        ids.extend(topic["id"] for topic in response_data["data"])
+        if response_data["next_cursor"] is None:
+            break
+        params["after"] = response_data["next_cursor"]
+
+    assert ids == sorted(topic.id for topic in topics)
+
+
+@pytest.mark.parametrize("url", ["/topics", "/queues"])
+@pytest.mark.parametrize("params", [{"limit": 0}, {"limit": -1}, {"offset": -1}])
+def test_list_invalid_pagination(session, client, url, params):
+    response = client.get(url, params=params)
+
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
 def test_create_queue(session, topic, client):
     data = {
         "id": "my-queue",
@@ -75,6 +110,25 @@ def test_create_queue(session, topic, client):
     assert response_data["id"] == data["id"]
 
 
+def test_create_queue_with_retry_policy(session, topic, client):
+    data = {
+        "id": "my-queue",
+        "topic_id": topic.id,
+        "ack_deadline_seconds": 60,
+        "message_retention_seconds": 3600,
+        "retry_policy": "exponential",
+        "retry_min_backoff_seconds": 5,
+        "retry_max_backoff_seconds": 300,
+        "retry_jitter": True,
+    }
+
+    response = client.post("/queues", json=data)
+    response_data = response.json()
+
+    assert response.status_code == status.HTTP_201_CREATED
+    assert {name: response_data[name] for name in data} == data
+
+
 def test_create_queue_already_exists(session, queue, client):
     data = {
         "id": queue.id,
@@ -177,6 +231,36 @@ def test_get_queue_stats_not_found(session, client):
     assert response_data == {"detail": "Queue not found"}
 
 
+def test_list_queue_stats(session, queue, client):
+    other_queue = QueueFactory()
+    session.add(other_queue)
+    session.commit()
+    created_at = datetime.utcnow() - timedelta(seconds=10)
+    session.add_all(MessageFactory.build_batch(5, queue_id=queue.id, created_at=created_at))
+    session.commit()
+
+    response = client.get("/queues/stats")
+    response_data = response.json()
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response_data == {
+        "data": [
+            {"queue_id": queue.id, "num_undelivered_messages": 5, "oldest_unacked_message_age_seconds": 10},
+            {
+                "queue_id": other_queue.id,
+                "num_undelivered_messages": 0,
+                "oldest_unacked_message_age_seconds": 0,
+            },
+        ]
+    }
+
+    response = client.get("/queues/stats", params={"queue_id": [other_queue.id]})
+    assert [item["queue_id"] for item in response.json()["data"]] == [other_queue.id]
+
+    response = client.get("/queues/stats", params={"topic_id": queue.topic_id})
+    assert [item["queue_id"] for item in response.json()["data"]] == [queue.id]
+
+
 def test_purge_queue_messages(session, queue, client):
     created_at = datetime.utcnow() - timedelta(seconds=10)
     messages = MessageFactory.build_batch(5, queue_id=queue.id, created_at=created_at)
@@ -272,6 +356,85 @@ def test_create_message(session, queue, client):
         assert message["attributes"] == data["attributes"]
 
 
+def test_create_message_batch(session, queue, client):
+    data = {
+        "data": [
+            {"data": {"message": "Hello World 1"}, "attributes": {"attr1": "attr1"}},
+            {"data": {"message": "Hello World 2"}},
+        ]
+    }
+
+    response = client.post(f"/topics/{queue.topic_id}/messages/batch", json=data)
+    response_data = response.json()
+
+    assert response.status_code == status.HTTP_201_CREATED
+    assert len(response_data["data"]) == 2
+    for item, result in zip(data["data"], response_data["data"]):
+        assert len(result["data"]) == 1
+        assert result["data"][0]["queue_id"] == queue.id
+        assert result["data"][0]["data"] == item["data"]
+
+
+def test_create_message_batch_empty(session, queue, client):
+    response = client.post(f"/topics/{queue.topic_id}/messages/batch", json={"data": []})
+
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+def test_create_message_batch_not_found(session, client):
+    data = {"data": [{"data": {"message": "Hello World"}}]}
+
+    response = client.post("/topics/not-found-topic/messages/batch", json=data)
+    response_data = response.json()
+
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    assert response_data == {"detail": "Topic not found"}
+
+
+def test_ingest_messages(session, queue, client):
+    content = b'{"data": {"message": "Hello World"}}\n{"data": "Hello World"}\n'
+
+    response = client.post(
+        f"/topics/{queue.topic_id}/messages/ingest",
+        content=content,
+        headers={"content-type": "application/x-ndjson"},
+    )
+    response_data = response.json()
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response_data == {
+        "num_lines": 2,
+        "num_messages": 1,
+        "num_errors": 1,
+        "errors": [{"line": 2, "detail": "data: value is not a valid dict"}],
+        "error": None,
+    }
+
+
+def test_ingest_messages_write_error(session, queue, client, monkeypatch):
+    def failing_ingest_messages(self, topic_id, items):
+        self.session.execute(text("SELECT * FROM not_found"))
+
+    monkeypatch.setattr(MessageService, "_ingest_messages", failing_ingest_messages)
+
+    response = client.post(
+        f"/topics/{queue.topic_id}/messages/ingest", content=b'{"data": {"message": "Hi"}}'
+    )
+    response_data = response.json()
+
+    assert response.status_code == status.HTTP_500_INTERNAL_SERVER_ERROR
+    assert response_data["num_messages"] == 0
+    assert response_data["error"] == "failed to write the messages of lines 1 to 1"
+
+
+def test_ingest_messages_topic_not_found(session, client):
+    response = client.post("/topics/not-found-topic/messages/ingest", content=b"{}")
+    response_data = response.json()
+
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    assert response_data == {"detail": "Topic not found"}
+
+
 def test_list_messages_for_consume(session, message, client):
     response = client.get(f"/queues/{message.queue_id}/messages")
     response_data = response.json()
@@ -284,6 +447,61 @@ def test_list_messages_for_consume(session, message, client):
         assert m["attributes"] == message.attributes
 
 
+def test_list_messages_for_consume_response(session, message, client):
+    response = client.get(f"/queues/{message.queue_id}/messages")
+
+    # the fast response path renders the same json of the response_model
+    session.refresh(message)
+    assert response.headers["content-type"] == "application/json"
+    assert response.json() == {"data": [jsonable_encoder(MessageSchema.from_orm(message))]}
+
+
+def test_list_messages_for_consume_with_wait_seconds(session, message, client):
+    response = client.get(f"/queues/{message.queue_id}/messages", params={"wait_seconds": 1})
+    response_data = response.json()
+
+    assert response.status_code == status.HTTP_200_OK
+    assert len(response_data["data"]) == 1
+
+
+def test_list_messages_for_consume_with_invalid_wait_seconds(session, queue, client):
+    response = client.get(f"/queues/{queue.id}/messages", params={"wait_seconds": 3600})
+
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+def test_stream_messages_for_consume(session, message, client):
+    with client.websocket_connect(f"/queues/{message.queue_id}/messages/stream") as websocket:
+        # with one credit the stream only waits for requests after the push, so it is not running a
+        # query on the event loop of this client when it disconnects
+        websocket.send_json({"type": "credits", "credits": 1})
+        response_data = websocket.receive_json()
+        assert response_data["type"] == "messages"
+        assert [m["id"] for m in response_data["data"]] == [str(message.id)]
+
+        websocket.send_json({"type": "ack", "ids": [str(message.id)]})
+        response_data = websocket.receive_json()
+        assert response_data == {"type": "ack", "not_found_ids": []}
+
+
+def test_stream_messages_for_consume_with_invalid_request(session, queue, client):
+    with client.websocket_connect(f"/queues/{queue.id}/messages/stream") as websocket:
+        websocket.send_json({"type": "credits", "credits": 0})
+        with pytest.raises(WebSocketDisconnect) as excinfo:
+            websocket.receive_json()
+
+    assert excinfo.value.code == status.WS_1003_UNSUPPORTED_DATA
+
+
+def test_stream_messages_for_consume_queue_not_found(session, client):
+    with client.websocket_connect("/queues/not-found-queue/messages/stream") as websocket:
+        with pytest.raises(WebSocketDisconnect) as excinfo:
+            websocket.receive_json()
+
+    assert excinfo.value.code == status.WS_1008_POLICY_VIOLATION
+    assert excinfo.value.reason == "Queue not found"
+
+
 def test_ack_message(session, message, client):
     response = client.put(f"/messages/{message.id}/ack")
 
@@ -296,9 +514,106 @@ def test_nack_message(session, message, client):
     assert response.status_code == status.HTTP_204_NO_CONTENT
 
 
+def test_nack_message_with_delay_seconds(session, message, client):
+    response = client.put(f"/messages/{message.id}/nack", params={"delay_seconds": 30})
+
+    assert response.status_code == status.HTTP_204_NO_CONTENT
+    session.refresh(message)
+    assert message.scheduled_at - message.updated_at == timedelta(seconds=30)
+
+
+def test_ack_message_batch(session, message, client):
+    not_found_id = str(uuid.uuid4())
+
+    response = client.put("/messages/ack", json={"ids": [str(message.id), not_found_id]})
+    response_data = response.json()
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response_data == {"not_found_ids": [not_found_id]}
+
+
+def test_ack_message_batch_invalid_id(session, client):
+    response = client.put("/messages/ack", json={"ids": ["invalid-id"]})
+
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+def test_nack_message_batch(session, message, client):
+    not_found_id = str(uuid.uuid4())
+
+    response = client.put("/messages/nack", json={"ids": [str(message.id), not_found_id]})
+    response_data = response.json()
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response_data == {"not_found_ids": [not_found_id]}
+
+
+def test_modify_message_ack_deadline(session, message, client):
+    response = client.put(f"/messages/{message.id}/ack-deadline", json={"ack_deadline_seconds": 60})
+
+    assert response.status_code == status.HTTP_204_NO_CONTENT
+
+
+def test_modify_message_batch_ack_deadline(session, message, client):
+    not_found_id = str(uuid.uuid4())
+    message.delivery_attempts = 1
+    message.scheduled_at = datetime.utcnow() + timedelta(seconds=30)
+    session.commit()
+
+    response = client.put(
+        "/messages/ack-deadline",
+        json={"ids": [str(message.id), not_found_id], "ack_deadline_seconds": 60},
+    )
+    response_data = response.json()
+
+    assert response.status_code == status.HTTP_200_OK
+    assert response_data == {"not_found_ids": [not_found_id]}
+
+
+def test_modify_message_batch_ack_deadline_invalid_seconds(session, message, client):
+    response = client.put(
+        "/messages/ack-deadline", json={"ids": [str(message.id)], "ack_deadline_seconds": -1}
+    )
+
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+def test_nack_message_batch_with_delay_seconds(session, message, client):
+    response = client.put("/messages/nack", json={"ids": [str(message.id)], "delay_seconds": 30})
+
+    assert response.status_code == status.HTTP_200_OK
+    session.refresh(message)
+    assert message.scheduled_at - message.updated_at == timedelta(seconds=30)
+
+
+def test_nack_message_batch_invalid_delay_seconds(session, message, client):
+    response = client.put("/messages/nack", json={"ids": [str(message.id)], "delay_seconds": -1})
+
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
 def test_health(session, client):
     response = client.get("/health")
     response_data = response.json()
 
     assert response.status_code == status.HTTP_200_OK
     assert response_data == {"success": True}
+
+
+def test_startup_starts_listener_off_the_event_loop(monkeypatch):
+    calls = []
+
+    def start():
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            calls.append("thread")
+        else:
+            calls.append("event loop")
+
+    monkeypatch.setattr(listener, "start", start)
+
+    with TestClient(app):
+        pass
+
+    assert calls == ["thread"]
@@ -0,0 +1,98 @@
+from unittest import mock
+
+from fastqueue.cache import cache_channel, invalidate_routing_cache, routing_cache, TTLCache
+from fastqueue.notifications import listener
+
+
+def test_ttl_cache():
+    cache = TTLCache(ttl_seconds=60, max_size=2)
+
+    cache.set("key1", "value1")
+    cache.set("key2", "value2")
+    assert cache.get("key1") == "value1"
+    cache.set("key3", "value3")
+
+    assert len(cache) == 2
+    assert cache.get("key2") is None
+    assert cache.get("key1") == "value1"
+    assert cache.get("key3") == "value3"
+
+    cache.delete("key1")
+    assert cache.get("key1", "default") == "default"
+    cache.delete_many(["key3", "key4"])
+    assert len(cache) == 0
+
+    cache.set("key1", "value1")
+    cache.clear()
+    assert len(cache) == 0
+
+
+@mock.patch("fastqueue.cache.monotonic")
+def test_ttl_cache_expiration(mock_monotonic):
+    cache = TTLCache(ttl_seconds=60, max_size=2)
+    mock_monotonic.return_value = 100
+    cache.set("key1", "value1")
+
+    mock_monotonic.return_value = 159
+    assert cache.get("key1") == "value1"
+
+    mock_monotonic.return_value = 160
+    assert cache.get("key1") is None
+    assert len(cache) == 0
+
+
+def test_ttl_cache_generation():
+    cache = TTLCache(ttl_seconds=60, max_size=2)
+
+    generation = cache.generation("key1")
+    cache.delete("key1")
+    cache.set("key1", "value1", generation=generation)
+    assert cache.get("key1") is None
+
+    generation = cache.generation("key1")
+    cache.clear()
+    cache.set("key1", "value1", generation=generation)
+    assert cache.get("key1") is None
+
+    generation = cache.generation("key1")
+    cache.delete("key2")
+    cache.set("key1", "value1", generation=generation)
+    assert cache.get("key1") == "value1"
+
+
+def test_ttl_cache_key_generations_are_bounded():
+    cache = TTLCache(ttl_seconds=60, max_size=2)
+
+    generation = cache.generation("key1")
+    cache.delete_many(["key2", "key3"])
+    assert len(cache._key_generations) == 2
+    cache.set("key1", "value1", generation=generation)
+    assert cache.get("key1") == "value1"
+
+    generation = cache.generation("key5")
+    cache.delete("key4")
+    assert len(cache._key_generations) == 0
+    cache.set("key5", "value5", generation=generation)
+    assert cache.get("key5") is None
+
+
+def test_ttl_cache_disabled():
+    cache = TTLCache(ttl_seconds=0, max_size=2)
+
+    cache.set("key1", "value1")
+
+    assert cache.enabled is False
+    assert cache.get("key1") is None
+
+
+def test_invalidate_routing_cache():
+    routing_cache.set("topic:topic_1", [])
+    routing_cache.set("queue:queue_1", None)
+    routing_cache.set("queue:queue_2", None)
+
+    listener.dispatch(cache_channel, "queue:queue_1")
+    assert routing_cache.get("queue:queue_1", "missing") == "missing"
+    assert routing_cache.get("topic:topic_1") == []
+
+    invalidate_routing_cache(None)
+    assert len(routing_cache) == 0
@@ -0,0 +1,34 @@
+from prometheus_client import REGISTRY
+
+from fastqueue.compression import compress_data, decompress_data
+from fastqueue.config import settings
+
+
+def get_sample_value(name, labels=None):
+    return REGISTRY.get_sample_value(name, labels or {}) or 0
+
+
+def test_compress_data(monkeypatch):
+    monkeypatch.setattr(settings, "enable_message_compression", True)
+    monkeypatch.setattr(settings, "message_compression_min_size_bytes", 100)
+    data = {"items": [{"name": "item", "value": 1}] * 100}
+    count = get_sample_value("fastqueue_message_compression_ratio_count")
+    raw_bytes = get_sample_value("fastqueue_message_data_bytes_total", {"state": "raw"})
+
+    compressed = compress_data(data)
+
+    assert compressed is not None
+    assert decompress_data(compressed) == data
+    assert get_sample_value("fastqueue_message_compression_ratio_count") == count + 1
+    assert get_sample_value("fastqueue_message_data_bytes_total", {"state": "raw"}) > raw_bytes
+
+
+def test_compress_data_below_threshold(monkeypatch):
+    monkeypatch.setattr(settings, "enable_message_compression", True)
+    monkeypatch.setattr(settings, "message_compression_min_size_bytes", 100)
+
+    assert compress_data({"message": "Hello"}) is None
+
+
+def test_compress_data_disabled():
+    assert compress_data({"items": [{"name": "item", "value": 1}] * 1000}) is None
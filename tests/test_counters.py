@@ -0,0 +1,192 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from fastqueue.counters import (
+    create_queue_counter,
+    get_counted_state,
+    get_message_state,
+    load_oldest_message_created_at,
+    QueueCounterDeltas,
+    reconcile_queue_counters,
+    reset_queue_counter,
+)
+from fastqueue.models import QueueCounter
+from tests.factories import MessageFactory, QueueFactory
+
+
+def get_counter(session, queue_id):
+    session.expire_all()
+    return session.get(QueueCounter, queue_id)
+
+
+@pytest.mark.parametrize(
+    "scheduled_at_seconds,delivery_attempts,expected",
+    [
+        (0, 0, "num_ready"),
+        (-10, 3, "num_ready"),
+        (10, 1, "num_in_flight"),
+        (10, 0, "num_delayed"),
+    ],
+)
+def test_get_message_state(scheduled_at_seconds, delivery_attempts, expected):
+    now = datetime.utcnow()
+    scheduled_at = now + timedelta(seconds=scheduled_at_seconds)
+    assert get_message_state(scheduled_at, delivery_attempts, now) == expected
+
+
+def test_get_counted_state():
+    now = datetime.utcnow()
+    scheduled_at = now - timedelta(seconds=10)
+    updated_at = now - timedelta(seconds=40)
+
+    assert get_counted_state(scheduled_at, 1, updated_at, None) == "num_in_flight"
+    assert get_counted_state(scheduled_at, 1, updated_at, now - timedelta(seconds=60)) == "num_in_flight"
+    assert get_counted_state(scheduled_at, 1, updated_at, now) == "num_ready"
+
+
+def test_create_and_reset_queue_counter(session, queue, queue_counters):
+    now = datetime.utcnow()
+    create_queue_counter(session, queue_id=queue.id, now=now)
+    session.commit()
+    deltas = QueueCounterDeltas()
+    deltas.add(queue.id, "num_ready", 2, created_at=now)
+    deltas.add(queue.id, "num_delayed", 1)
+    deltas.apply(session, now=now)
+    session.commit()
+
+    reset_queue_counter(session, queue_id=queue.id, now=now)
+    session.commit()
+
+    counter = get_counter(session, queue.id)
+    assert counter.num_ready == 0
+    assert counter.num_delayed == 0
+    assert counter.oldest_message_created_at is None
+
+
+def test_create_queue_counter_disabled(session, queue):
+    create_queue_counter(session, queue_id=queue.id, now=datetime.utcnow())
+    session.commit()
+
+    assert get_counter(session, queue.id) is None
+
+
+def test_queue_counter_deltas(session, queue, queue_counters):
+    now = datetime.utcnow()
+    created_at = now - timedelta(seconds=10)
+    create_queue_counter(session, queue_id=queue.id, now=now)
+    session.commit()
+
+    deltas = QueueCounterDeltas()
+    assert not deltas
+    deltas.add(queue.id, "num_ready", created_at=now)
+    deltas.add(queue.id, "num_ready", created_at=created_at)
+    deltas.add(queue.id, "num_delayed")
+    assert deltas
+    deltas.apply(session, now=now)
+    session.commit()
+    assert not deltas
+
+    counter = get_counter(session, queue.id)
+    assert counter.num_ready == 2
+    assert counter.num_in_flight == 0
+    assert counter.num_delayed == 1
+    assert counter.oldest_message_created_at == created_at
+
+    # moving a message newer than the oldest one keeps it
+    deltas.move(queue.id, "num_ready", "num_in_flight", created_at=now)
+    deltas.apply(session, now=now)
+    session.commit()
+
+    counter = get_counter(session, queue.id)
+    assert counter.num_ready == 1
+    assert counter.num_in_flight == 1
+    assert counter.oldest_message_created_at == created_at
+
+    # moving the oldest message makes it unknown
+    deltas.move(queue.id, "num_ready", "num_in_flight", created_at=created_at)
+    deltas.apply(session, now=now)
+    session.commit()
+
+    counter = get_counter(session, queue.id)
+    assert counter.num_ready == 0
+    assert counter.num_in_flight == 2
+    assert counter.oldest_message_created_at is None
+
+    # the first ready message sets it again
+    deltas.move(queue.id, "num_in_flight", "num_ready", created_at=created_at)
+    deltas.apply(session, now=now)
+    session.commit()
+
+    counter = get_counter(session, queue.id)
+    assert counter.num_ready == 1
+    assert counter.num_in_flight == 1
+    assert counter.oldest_message_created_at == created_at
+
+
+def test_queue_counter_deltas_disabled(session, queue):
+    now = datetime.utcnow()
+    deltas = QueueCounterDeltas()
+    deltas.add(queue.id, "num_ready")
+
+    assert deltas.apply(session, now=now) is None
+    assert deltas
+
+
+def test_reconcile_queue_counters(session, queue):
+    dead_queue = QueueFactory()
+    session.add(dead_queue)
+    session.commit()
+    queue.dead_queue_id = dead_queue.id
+    queue.message_max_deliveries = 2
+    now = datetime.utcnow()
+    created_at = now - timedelta(seconds=10)
+    session.add_all(
+        [
+            MessageFactory(queue_id=queue.id, created_at=created_at),
+            MessageFactory(queue_id=queue.id, delivery_attempts=1),
+            MessageFactory(queue_id=queue.id, delivery_attempts=1, scheduled_at=now + timedelta(seconds=30)),
+            MessageFactory(queue_id=queue.id, scheduled_at=now + timedelta(seconds=30)),
+            MessageFactory(queue_id=queue.id, delivery_attempts=2),
+            MessageFactory(queue_id=queue.id, expired_at=now - timedelta(seconds=1)),
+        ]
+    )
+    session.commit()
+
+    assert reconcile_queue_counters(session) is None
+    session.commit()
+
+    counter = get_counter(session, queue.id)
+    assert counter.num_ready == 3
+    assert counter.num_in_flight == 1
+    assert counter.num_delayed == 1
+    assert counter.oldest_message_created_at == created_at
+    counter = get_counter(session, dead_queue.id)
+    assert counter.num_ready == 0
+    assert counter.oldest_message_created_at is None
+
+    # the existing counters are replaced
+    session.add(MessageFactory(queue_id=dead_queue.id))
+    session.commit()
+    reconcile_queue_counters(session, queue_ids=[dead_queue.id])
+    session.commit()
+
+    assert get_counter(session, dead_queue.id).num_ready == 1
+
+
+def test_load_oldest_message_created_at(session, queue):
+    created_at = datetime.utcnow() - timedelta(seconds=10)
+    session.add_all(
+        [
+            MessageFactory(queue_id=queue.id, created_at=created_at),
+            MessageFactory(queue_id=queue.id, created_at=created_at + timedelta(seconds=5)),
+        ]
+    )
+    now = datetime.utcnow()
+    session.add(QueueCounter(queue_id=queue.id, num_ready=2, reconciled_at=now, updated_at=now))
+    session.commit()
+
+    assert load_oldest_message_created_at(session, queue=queue, now=now) == created_at
+    session.commit()
+
+    assert get_counter(session, queue.id).oldest_message_created_at == created_at
@@ -0,0 +1,57 @@
+from types import SimpleNamespace
+
+import pytest
+
+from fastqueue.filters import MessageFilterIndex
+
+
+def make_queue(id, message_filters):
+    return SimpleNamespace(id=id, message_filters=message_filters)
+
+
+@pytest.mark.parametrize(
+    "queue_filters,message_attributes,expected",
+    [
+        ({"attr1": [1]}, {"attr1": 1}, True),
+        ({"attr1": [1]}, {"attr1": "1"}, False),
+        ({"attr1": [1, 2]}, {"attr1": 1}, True),
+        ({"attr1": [1, 2]}, {"attr1": 2}, True),
+        ({"attr1": [1, 1]}, {"attr1": 1}, True),
+        ({"attr1": [1]}, {"attr2": 1}, False),
+        ({"attr1": [1], "attr2": [2]}, {"attr1": 1}, False),
+        ({"attr1": [1], "attr2": [2]}, {"attr1": 1, "attr2": 2}, True),
+        ({"attr1": [1], "attr2": [2]}, {"attr1": 1, "attr2": 2, "attr3": 3}, True),
+        ({"attr1": [1, 2], "attr2": [1, 2]}, {"attr1": 1, "attr2": 2, "attr3": 3}, True),
+        (None, {"attr1": 1}, True),
+        ({"attr1": [1]}, None, False),
+        (None, None, True),
+        ({}, None, False),
+        ({}, {"attr1": 1}, True),
+    ],
+)
+def test_message_filter_index_match(queue_filters, message_attributes, expected):
+    queue = make_queue("queue_1", queue_filters)
+    filter_index = MessageFilterIndex([queue])
+
+    assert (filter_index.match(message_attributes) == [queue]) is expected
+
+
+def test_message_filter_index_match_keeps_queue_order():
+    queues = [
+        make_queue("queue_1", {"attr1": ["a"]}),
+        make_queue("queue_2", None),
+        make_queue("queue_3", {"attr1": ["a", "b"], "attr2": ["c"]}),
+        make_queue("queue_4", {"attr1": ["b"]}),
+        make_queue("queue_5", None),
+    ]
+    filter_index = MessageFilterIndex(queues)
+
+    assert [queue.id for queue in filter_index.match({"attr1": "a"})] == ["queue_1", "queue_2", "queue_5"]
+    assert [queue.id for queue in filter_index.match({"attr1": "b", "attr2": "c"})] == [
+        "queue_2",
+        "queue_3",
+        "queue_4",
+        "queue_5",
+    ]
+    assert [queue.id for queue in filter_index.match(None)] == ["queue_2", "queue_5"]
+    assert MessageFilterIndex([]).match({"attr1": "a"}) == []
@@ -0,0 +1,184 @@
+from unittest import mock
+
+import pytest
+from prometheus_client import REGISTRY
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import QueuePool
+
+from fastqueue import metrics
+from fastqueue.config import settings
+from fastqueue.metrics import (
+    get_instrumented_pool_class,
+    instrument_engine_pool,
+    LabelValues,
+    track_service_queries,
+)
+from fastqueue.schemas import CreateMessageSchema
+from fastqueue.services import MessageService, QueueService
+from tests.factories import MessageFactory, QueueFactory
+
+
+def test_instrumented_engine_pool():
+    engine = create_engine(
+        settings.database_url, poolclass=get_instrumented_pool_class(QueuePool, "test"), pool_size=1
+    )
+    instrument_engine_pool(engine, "test")
+
+    with engine.connect():
+        assert REGISTRY.get_sample_value("fastqueue_db_pool_checked_out", {"engine": "test"}) == 1
+        assert REGISTRY.get_sample_value("fastqueue_db_pool_size", {"engine": "test"}) == 1
+        with engine.connect():
+            assert REGISTRY.get_sample_value("fastqueue_db_pool_overflow", {"engine": "test"}) == 1
+
+    assert REGISTRY.get_sample_value("fastqueue_db_pool_checked_out", {"engine": "test"}) == 0
+    assert REGISTRY.get_sample_value("fastqueue_db_pool_checkout_seconds_count", {"engine": "test"}) == 2
+    engine.dispose()
+
+
+def test_track_service_queries(session):
+    count = REGISTRY.get_sample_value("fastqueue_db_service_queries_count", {"method": "test"}) or 0
+
+    with track_service_queries("test") as stats:
+        session.execute(text("SELECT 1"))
+        session.execute(text("SELECT pg_sleep(0.01)"))
+    session.execute(text("SELECT 1"))
+
+    assert stats.count == 2
+    assert stats.slowest_statement == "SELECT pg_sleep(0.01)"
+    assert stats.seconds >= stats.slowest_seconds >= 0.01
+    assert REGISTRY.get_sample_value("fastqueue_db_service_queries_count", {"method": "test"}) == count + 1
+    assert REGISTRY.get_sample_value("fastqueue_db_service_queries_sum", {"method": "test"}) >= 2
+
+
+def test_track_request_queries(session, queue, client):
+    labels = {"route": "GET /queues/{queue_id}/messages"}
+    count = REGISTRY.get_sample_value("fastqueue_db_request_queries_count", labels) or 0
+    method_labels = {"method": "MessageService._consume"}
+    method_count = REGISTRY.get_sample_value("fastqueue_db_service_queries_count", method_labels) or 0
+
+    client.get(f"/queues/{queue.id}/messages")
+
+    assert REGISTRY.get_sample_value("fastqueue_db_request_queries_count", labels) == count + 1
+    assert REGISTRY.get_sample_value("fastqueue_db_service_queries_count", method_labels) == method_count + 1
+
+
+def test_slow_query_log(session, monkeypatch):
+    monkeypatch.setattr(settings, "database_slow_query_seconds", 0.01)
+
+    with mock.patch.object(metrics.logger, "warning") as warning:
+        session.execute(text("SELECT 1"))
+        session.execute(text("SELECT pg_sleep(:seconds)"), {"seconds": 0.02})
+        session.execute(text("SELECT 1"))
+        session.commit()
+
+    warning.assert_called_once()
+    extra = warning.call_args.kwargs["extra"]
+    assert extra["statement"] == "SELECT pg_sleep(%(seconds)s)"
+    assert extra["seconds"] >= 0.02
+    assert extra["plan"].startswith("Result")
+
+
+@pytest.mark.anyio
+async def test_slow_query_log_with_asyncpg(async_session, monkeypatch):
+    monkeypatch.setattr(settings, "database_slow_query_seconds", 0.01)
+
+    with mock.patch.object(metrics.logger, "warning") as warning:
+        await async_session.execute(text("SELECT pg_sleep(:seconds)"), {"seconds": 0.02})
+        await async_session.execute(text("SELECT 1"))
+        await async_session.commit()
+
+    warning.assert_called_once()
+    assert warning.call_args.kwargs["extra"]["plan"].startswith("Result")
+
+
+def test_slow_query_log_explain_failure(session):
+    # the savepoint keeps the transaction usable
+    connection = session.connection()
+
+    assert metrics.explain_query(connection, "SELECT * FROM not_found", {}) is None
+    assert session.execute(text("SELECT 1")).scalar() == 1
+
+
+def test_label_values():
+    label_values = LabelValues(max_values=2)
+
+    assert label_values.get("queue_1") == "queue_1"
+    assert label_values.get("queue_2") == "queue_2"
+    assert label_values.get("queue_3") == "other"
+    assert label_values.get("queue_1") == "queue_1"
+
+
+@pytest.fixture
+def label_values(monkeypatch):
+    monkeypatch.setattr(metrics, "topic_label_values", LabelValues(max_values=10))
+    monkeypatch.setattr(metrics, "queue_label_values", LabelValues(max_values=10))
+
+
+def get_queue_samples(queue_id):
+    names = ("delivered", "redelivered", "acked", "nacked", "dead_lettered", "ack_latency_seconds_count")
+    return {
+        name: REGISTRY.get_sample_value(
+            f"fastqueue_message_{name}" if name.startswith("ack_") else f"fastqueue_messages_{name}_total",
+            {"queue_id": queue_id},
+        )
+        or 0
+        for name in names
+    }
+
+
+def test_queue_message_metrics(session, topic, queue, label_values):
+    service = MessageService(session=session)
+
+    service.create(topic_id=topic.id, data=CreateMessageSchema(data={"message": "Hello"}))
+    message = service.list_for_consume(queue_id=queue.id, limit=10).data[0]
+    service.nack(id=message.id)
+    service.list_for_consume(queue_id=queue.id, limit=10)
+    service.ack(id=message.id)
+
+    assert (
+        REGISTRY.get_sample_value(
+            "fastqueue_messages_published_total", {"topic_id": topic.id, "queue_id": queue.id}
+        )
+        == 1
+    )
+    assert get_queue_samples(queue.id) == {
+        "delivered": 2,
+        "redelivered": 1,
+        "acked": 1,
+        "nacked": 1,
+        "dead_lettered": 0,
+        "ack_latency_seconds_count": 1,
+    }
+
+
+def test_queue_message_metrics_with_label_overflow(session, topic, queue, monkeypatch):
+    monkeypatch.setattr(metrics, "topic_label_values", LabelValues(max_values=0))
+    monkeypatch.setattr(metrics, "queue_label_values", LabelValues(max_values=0))
+    labels = {"topic_id": "other", "queue_id": "other"}
+    count = REGISTRY.get_sample_value("fastqueue_messages_published_total", labels) or 0
+
+    MessageService(session=session).create(
+        topic_id=topic.id, data=CreateMessageSchema(data={"message": "Hi"})
+    )
+
+    assert REGISTRY.get_sample_value("fastqueue_messages_published_total", labels) == count + 1
+    assert (
+        REGISTRY.get_sample_value(
+            "fastqueue_messages_published_total", {"topic_id": topic.id, "queue_id": queue.id}
+        )
+        is None
+    )
+
+
+def test_dead_lettered_metric(session, queue, label_values):
+    dead_queue = QueueFactory()
+    session.add(dead_queue)
+    session.commit()
+    queue.message_max_deliveries = 2
+    queue.dead_queue_id = dead_queue.id
+    session.add_all([MessageFactory(queue_id=queue.id, delivery_attempts=2) for _ in range(3)])
+    session.commit()
+
+    QueueService(session=session).cleanup(id=queue.id)
+
+    assert get_queue_samples(queue.id)["dead_lettered"] == 3
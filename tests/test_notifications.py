@@ -0,0 +1,74 @@
+import threading
+from unittest import mock
+
+from fastqueue.notifications import Listener, message_waiters, messages_channel, notify
+
+
+def test_notify(session):
+    notify(session, messages_channel, ["queue_1", "queue_2"])
+    session.commit()
+
+
+def test_notify_without_payloads():
+    session = mock.Mock()
+
+    notify(session, messages_channel, [])
+
+    session.execute.assert_not_called()
+
+
+def test_listener_dispatch():
+    listener = Listener(engine=mock.Mock())
+    handler = mock.Mock()
+    failing_handler = mock.Mock(side_effect=Exception("boom"))
+    listener.add_handler("channel", failing_handler)
+    listener.add_handler("channel", handler)
+
+    listener.dispatch("channel", "payload")
+    listener.dispatch_all()
+
+    handler.assert_has_calls([mock.call("payload"), mock.call(None)])
+
+
+def test_listener_receives_notifications(session):
+    event = threading.Event()
+    received = []
+
+    def handler(payload):
+        received.append(payload)
+        if payload is not None:
+            event.set()
+
+    listener = Listener(engine=session.get_bind().engine, poll_interval_seconds=0.1)
+    listener.add_handler("fastqueue_test", handler)
+    listener.start()
+    # start waits for the connection, the handlers were already called for it
+    assert received == [None]
+    listener.start()
+
+    for _ in range(50):
+        notify(session, "fastqueue_test", ["payload"])
+        session.commit()
+        if event.wait(0.1):
+            break
+
+    assert received[0] is None
+    assert "payload" in received
+
+
+def test_message_waiters():
+    callback1 = mock.Mock()
+    callback2 = mock.Mock()
+
+    with mock.patch.object(message_waiters, "listener"):
+        with message_waiters.subscribe("queue_1", callback1), message_waiters.subscribe("queue_2", callback2):
+            message_waiters.wake("queue_1")
+            callback1.assert_called_once_with()
+            callback2.assert_not_called()
+
+            message_waiters.wake(None)
+            assert callback1.call_count == 2
+            assert callback2.call_count == 1
+
+        message_waiters.wake(None)
+        assert callback1.call_count == 2
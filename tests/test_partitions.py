@@ -0,0 +1,314 @@
+import re
+from datetime import datetime, timedelta
+from unittest import mock
+
+import pytest
+from sqlalchemy import event, text
+
+from fastqueue import workers
+from fastqueue.config import settings
+from fastqueue.counters import reconcile_queue_counters
+from fastqueue.database import engine
+from fastqueue.models import Message, QueueCounter
+from fastqueue.partitions import (
+    apply_messages_partitioning,
+    create_partition,
+    default_partition_name,
+    drop_partition,
+    get_expired_partitions,
+    get_hash_partition_name,
+    get_hash_partitions,
+    get_missing_partitions,
+    get_partition_name,
+    get_partition_start,
+    get_partition_strategy,
+    hash_partition_messages,
+    is_partitioned,
+    legacy_partition_name,
+    list_partitions,
+    partition_messages,
+    table_name,
+    unpartition_messages,
+)
+from fastqueue.services import MessageService, QueueService
+from fastqueue.workers import messages_partitions_task
+from tests.factories import MessageFactory
+
+day = timedelta(days=1)
+
+
+def count_messages(connection, table_name):
+    return connection.execute(text(f"SELECT count(*) FROM {table_name}")).scalar()
+
+
+@pytest.fixture
+def partitioned_messages(session, monkeypatch):
+    monkeypatch.setattr(settings, "enable_messages_partitioning", True)
+    with engine.begin() as connection:
+        partition_messages(connection)
+    yield
+    session.commit()
+    with engine.begin() as connection:
+        unpartition_messages(connection)
+
+
+def test_get_partition_start():
+    assert get_partition_start(datetime(2026, 10, 18, 16, 41, 7)) == datetime(2026, 10, 18)
+    assert get_partition_name(datetime(2026, 10, 18)) == "messages_p20261018000000"
+
+
+def test_get_missing_partitions(monkeypatch):
+    monkeypatch.setattr(settings, "max_message_retention_seconds", 2 * 86400)
+    now = datetime(2026, 10, 18, 12)
+
+    assert get_missing_partitions([], now) == [
+        (datetime(2026, 10, 18), datetime(2026, 10, 19)),
+        (datetime(2026, 10, 19), datetime(2026, 10, 20)),
+        (datetime(2026, 10, 20), datetime(2026, 10, 21)),
+        (datetime(2026, 10, 21), datetime(2026, 10, 22)),
+    ]
+
+    partitions = [
+        ("messages_legacy", None, datetime(2026, 10, 19)),
+        ("messages_p20261019000000", datetime(2026, 10, 19), datetime(2026, 10, 20)),
+    ]
+    assert get_missing_partitions(partitions, now) == [
+        (datetime(2026, 10, 20), datetime(2026, 10, 21)),
+        (datetime(2026, 10, 21), datetime(2026, 10, 22)),
+    ]
+
+
+def test_get_expired_partitions():
+    partitions = [
+        ("messages_legacy", None, datetime(2026, 10, 18)),
+        ("messages_p20261018000000", datetime(2026, 10, 18), datetime(2026, 10, 19)),
+    ]
+
+    assert get_expired_partitions(partitions, datetime(2026, 10, 18, 12)) == ["messages_legacy"]
+
+
+def test_partition_messages(session, queue):
+    message = MessageFactory(queue_id=queue.id)
+    session.add(message)
+    session.commit()
+    message_expired_at = message.expired_at
+    session.commit()
+    now = datetime.utcnow()
+
+    with engine.begin() as connection:
+        assert not is_partitioned(connection)
+        partition_messages(connection)
+        assert is_partitioned(connection)
+
+        partitions = list_partitions(connection)
+        assert partitions[0] == (legacy_partition_name, None, get_partition_start(message_expired_at) + day)
+        assert partitions[-1][2] >= now + timedelta(seconds=settings.max_message_retention_seconds)
+        assert count_messages(connection, legacy_partition_name) == 1
+
+    # new messages are stored in the partition of their expiration
+    expired_at = now + 30 * day
+    session.add(MessageFactory(queue_id=queue.id, expired_at=expired_at))
+    session.commit()
+    with engine.begin() as connection:
+        assert count_messages(connection, default_partition_name) == 1
+        create_partition(connection, get_partition_start(expired_at), get_partition_start(expired_at) + day)
+        assert count_messages(connection, default_partition_name) == 0
+        assert count_messages(connection, get_partition_name(get_partition_start(expired_at))) == 1
+
+        drop_partition(connection, legacy_partition_name)
+    assert session.query(Message).count() == 1
+    session.commit()
+
+    with engine.begin() as connection:
+        unpartition_messages(connection)
+        assert not is_partitioned(connection)
+    assert session.query(Message).count() == 1
+
+
+def test_queue_service_cleanup_with_partitioned_messages(session, queue, partitioned_messages):
+    session.add(MessageFactory(queue_id=queue.id, expired_at=datetime.utcnow() - timedelta(seconds=1)))
+    session.commit()
+
+    assert QueueService(session=session).cleanup(id=queue.id) is None
+    assert session.query(Message).count() == 1
+
+
+def test_messages_partitions_task(session, queue, partitioned_messages):
+    with engine.begin() as connection:
+        partitions = list_partitions(connection)
+        for name in [partitions[0][0], partitions[-1][0]]:
+            connection.execute(text(f"ALTER TABLE messages DETACH PARTITION {name}"))
+            drop_partition(connection, name)
+    now = datetime.utcnow()
+    session.add(MessageFactory(queue_id=queue.id, expired_at=partitions[-1][1]))
+    session.add(MessageFactory(queue_id=queue.id, expired_at=now - day))
+    session.commit()
+
+    # the missing partition is created with the messages of its range, and the expired messages of the
+    # default partition are deleted
+    assert messages_partitions_task() is None
+
+    with engine.begin() as connection:
+        assert list_partitions(connection) == partitions[1:]
+        assert count_messages(connection, default_partition_name) == 0
+    assert session.query(Message).count() == 1
+
+
+def test_messages_partitions_task_disabled(session):
+    with mock.patch.object(workers.logger, "error") as error:
+        assert messages_partitions_task() is None
+    error.assert_not_called()
+
+
+def test_messages_partitions_task_with_unpartitioned_messages(session, monkeypatch):
+    # the setting was enabled after the migration, the table is not partitioned
+    monkeypatch.setattr(settings, "enable_messages_partitioning", True)
+
+    with mock.patch.object(workers.logger, "error") as error:
+        assert messages_partitions_task() is None
+    error.assert_called_once()
+
+
+def test_messages_partitions_task_with_setting_disabled(session, queue, partitioned_messages, monkeypatch):
+    # the table was partitioned, the partitions are still kept up with the setting disabled in the worker
+    monkeypatch.setattr(settings, "enable_messages_partitioning", False)
+    with engine.begin() as connection:
+        partitions = list_partitions(connection)
+        connection.execute(text(f"ALTER TABLE messages DETACH PARTITION {partitions[-1][0]}"))
+        drop_partition(connection, partitions[-1][0])
+
+    assert messages_partitions_task() is None
+
+    with engine.begin() as connection:
+        assert list_partitions(connection) == partitions
+
+
+def test_queue_service_cleanup_with_unpartitioned_messages(session, queue, monkeypatch):
+    monkeypatch.setattr(settings, "enable_messages_partitioning", True)
+    session.add(MessageFactory(queue_id=queue.id, expired_at=datetime.utcnow() - timedelta(seconds=1)))
+    session.commit()
+
+    assert QueueService(session=session).cleanup(id=queue.id) is None
+    assert session.query(Message).count() == 0
+
+
+def test_messages_partitions_task_reconciles_queue_counters(
+    session, queue, partitioned_messages, queue_counters
+):
+    with engine.begin() as connection:
+        name = list_partitions(connection)[0][0]
+        connection.execute(text(f"ALTER TABLE messages DETACH PARTITION {name}"))
+        drop_partition(connection, name)
+    session.add(MessageFactory(queue_id=queue.id, expired_at=datetime.utcnow() - day))
+    session.commit()
+    reconcile_queue_counters(session)
+    session.commit()
+    assert session.get(QueueCounter, queue.id).num_ready == 1
+
+    assert messages_partitions_task() is None
+
+    session.expire_all()
+    assert session.get(QueueCounter, queue.id).num_ready == 0
+
+
+@pytest.fixture
+def hash_partitioned_messages(session, monkeypatch):
+    monkeypatch.setattr(settings, "messages_hash_partitions", 4)
+    with engine.begin() as connection:
+        hash_partition_messages(connection)
+    yield
+    session.commit()
+    with engine.begin() as connection:
+        unpartition_messages(connection)
+
+
+def test_hash_partition_messages(session, queue, monkeypatch):
+    monkeypatch.setattr(settings, "messages_hash_partitions", 4)
+    session.add(MessageFactory(queue_id=queue.id))
+    session.commit()
+
+    with engine.begin() as connection:
+        hash_partition_messages(connection)
+        assert get_partition_strategy(connection) == "h"
+        counts = [count_messages(connection, get_hash_partition_name(table_name, i)) for i in range(4)]
+        assert sorted(counts) == [0, 0, 0, 1]
+
+    with engine.begin() as connection:
+        unpartition_messages(connection)
+        assert get_partition_strategy(connection) is None
+    assert session.query(Message).count() == 1
+
+
+def test_consume_with_hash_partitioned_messages(session, queue, hash_partitioned_messages):
+    session.add_all(MessageFactory.build_batch(2, queue_id=queue.id))
+    session.commit()
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("WITH consumed"):
+            statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        result = MessageService(session=session).list_for_consume(queue_id=queue.id, limit=1)
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    assert len(result.data) == 1
+    assert MessageService(session=session).ack(id=result.data[0].id) is None
+    assert session.query(Message).count() == 1
+
+    # only the partition of the queue is scanned and updated
+    statement, parameters = statements[0]
+    with engine.begin() as connection:
+        plan = connection.exec_driver_sql(f"EXPLAIN {statement}", parameters).scalars().all()
+    assert len({name for line in plan for name in re.findall(r"messages_h\d+", line)}) == 1
+
+
+def test_partition_messages_with_hash_partitions(session, queue, monkeypatch):
+    monkeypatch.setattr(settings, "messages_hash_partitions", 2)
+    monkeypatch.setattr(settings, "enable_messages_partitioning", True)
+
+    with engine.begin() as connection:
+        partition_messages(connection)
+        name = list_partitions(connection)[-1][0]
+        assert count_messages(connection, get_hash_partition_name(name, 1)) == 0
+    session.add(MessageFactory(queue_id=queue.id))
+    session.commit()
+    assert QueueService(session=session).stats(id=queue.id).num_undelivered_messages == 1
+    session.commit()
+
+    with engine.begin() as connection:
+        unpartition_messages(connection)
+    assert session.query(Message).count() == 1
+
+
+def test_apply_messages_partitioning(session, queue, monkeypatch):
+    session.add(MessageFactory(queue_id=queue.id))
+    session.commit()
+
+    with engine.begin() as connection:
+        assert apply_messages_partitioning(connection) is False
+
+        monkeypatch.setattr(settings, "enable_messages_partitioning", True)
+        assert apply_messages_partitioning(connection) is True
+        assert (get_partition_strategy(connection), get_hash_partitions(connection)) == ("r", 0)
+        assert apply_messages_partitioning(connection) is False
+
+        monkeypatch.setattr(settings, "messages_hash_partitions", 2)
+        assert apply_messages_partitioning(connection) is True
+        assert (get_partition_strategy(connection), get_hash_partitions(connection)) == ("r", 2)
+
+        monkeypatch.setattr(settings, "enable_messages_partitioning", False)
+        assert apply_messages_partitioning(connection) is True
+        assert (get_partition_strategy(connection), get_hash_partitions(connection)) == ("h", 2)
+
+        monkeypatch.setattr(settings, "messages_hash_partitions", 4)
+        assert apply_messages_partitioning(connection) is True
+        assert (get_partition_strategy(connection), get_hash_partitions(connection)) == ("h", 4)
+        assert apply_messages_partitioning(connection) is False
+
+        monkeypatch.setattr(settings, "messages_hash_partitions", 0)
+        assert apply_messages_partitioning(connection) is True
+        assert get_partition_strategy(connection) is None
+
+    assert session.query(Message).count() == 1
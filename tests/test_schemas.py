@@ -1,6 +1,7 @@
 import pytest
 from pydantic import ValidationError
 
+from fastqueue.config import settings
 from fastqueue.schemas import CreateQueueSchema, UpdateQueueSchema
 
 
@@ -85,3 +86,43 @@ def test_update_queue_schema(dead_queue_id, message_max_deliveries, expected):
         UpdateQueueSchema(**data)
 
     assert excinfo.value.errors() == expected
+
+
+@pytest.mark.parametrize(
+    "retry_policy,retry_min_backoff_seconds,retry_max_backoff_seconds,expected",
+    [
+        ("exponential", None, 60, "retry_min_backoff_seconds is required for retry policy"),
+        (None, 10, None, "retry_policy is required for retry backoff"),
+        (None, None, 60, "retry_policy is required for retry backoff"),
+        ("linear", 10, 5, "retry_max_backoff_seconds must not be less than retry_min_backoff_seconds"),
+    ],
+)
+def test_queue_schema_retry_policy(
+    retry_policy, retry_min_backoff_seconds, retry_max_backoff_seconds, expected
+):
+    data = {
+        "id": "my-queue-1",
+        "ack_deadline_seconds": 60,
+        "message_retention_seconds": 600,
+        "retry_policy": retry_policy,
+        "retry_min_backoff_seconds": retry_min_backoff_seconds,
+        "retry_max_backoff_seconds": retry_max_backoff_seconds,
+    }
+
+    for schema in (CreateQueueSchema, UpdateQueueSchema):
+        with pytest.raises(ValidationError) as excinfo:
+            schema(**data)
+
+        assert excinfo.value.errors() == [{"loc": ("__root__",), "msg": expected, "type": "value_error"}]
+
+
+def test_queue_schema_retry_policy_default_max_backoff():
+    data = CreateQueueSchema(
+        id="my-queue-1",
+        ack_deadline_seconds=60,
+        message_retention_seconds=600,
+        retry_policy="fixed",
+        retry_min_backoff_seconds=10,
+    )
+
+    assert data.retry_max_backoff_seconds == settings.max_retry_backoff_seconds
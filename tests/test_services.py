@@ -1,19 +1,43 @@
+import asyncio
 import uuid
 from datetime import datetime, timedelta
-from time import sleep
+from threading import Timer
+from time import monotonic, sleep
 
 import pytest
+from sqlalchemy import event, text
 
+from fastqueue import services
+from fastqueue.cache import queue_key, routing_cache, stats_cache, topic_key
+from fastqueue.config import settings
+from fastqueue.database import async_engine, SessionLocal
 from fastqueue.exceptions import NotFoundError
-from fastqueue.models import Message, Queue
+from fastqueue.models import Message, MessagePayload, Queue, QueueCounter, Topic
 from fastqueue.schemas import (
+    AckDeadlineSchema,
+    CreateMessageBatchSchema,
     CreateMessageSchema,
     CreateQueueSchema,
     CreateTopicSchema,
+    MessageIdsSchema,
+    ModifyAckDeadlineSchema,
     RedriveQueueSchema,
+    StreamCreditsSchema,
+    StreamMessageIdsSchema,
     UpdateQueueSchema,
 )
-from fastqueue.services import HealthService, MessageService, QueueService, TopicService
+from fastqueue.services import (
+    apply_id_filters,
+    AsyncHealthService,
+    AsyncMessageService,
+    AsyncQueueService,
+    AsyncTopicService,
+    HealthService,
+    MessageService,
+    QueueService,
+    split_lines,
+    TopicService,
+)
 from tests.factories import MessageFactory, QueueFactory, TopicFactory
 
 
@@ -53,6 +77,39 @@ def test_topic_service_list(session):
     assert len(result.data) == 0
 
 
+def test_topic_service_list_with_cursor(session):
+    ids = ["events-1", "events-2", "events-3", "events_4", "orders-1"]
+    session.add_all([TopicFactory(id=id) for id in ids])
+    session.commit()
+
+    result = TopicService(session=session).list(filters=None, offset=None, limit=2)
+    assert [topic.id for topic in result.data] == ids[:2]
+    assert result.next_cursor == ids[1]
+
+    result = TopicService(session=session).list(filters=None, offset=None, limit=2, after=result.next_cursor)
+    assert [topic.id for topic in result.data] == ids[2:4]
+
+    result = TopicService(session=session).list(filters=None, offset=None, limit=2, after=result.next_cursor)
+    assert [topic.id for topic in result.data] == ids[4:]
+    assert result.next_cursor is None
+
+    # the underscore of the prefix is not a wildcard
+    result = TopicService(session=session).list(filters=None, offset=None, limit=10, prefix="events_")
+    assert [topic.id for topic in result.data] == ["events_4"]
+
+
+def test_apply_id_filters_prefix_seeks_the_index(session):
+    query = apply_id_filters(session.query(Topic.id), Topic, after=None, prefix="events_").order_by(Topic.id)
+    statement = query.statement.compile(dialect=session.bind.dialect, compile_kwargs={"literal_binds": True})
+
+    session.execute(text("SET LOCAL enable_seqscan = off"))
+    plan = "\n".join(session.execute(text(f"EXPLAIN {statement}")).scalars())
+    session.rollback()
+
+    index_cond = [line for line in plan.splitlines() if "Index Cond" in line]
+    assert index_cond and ">= 'events_'" in index_cond[0]
+
+
 def test_topic_service_delete(session, topic):
     queues = QueueFactory.build_batch(5, topic_id=topic.id)
     session.add_all(queues)
@@ -145,6 +202,22 @@ def test_queue_service_list(session, topic):
     assert len(result.data) == 0
 
 
+def test_queue_service_list_with_cursor(session, topic):
+    queues = QueueFactory.build_batch(5, topic_id=topic.id)
+    session.add_all(queues)
+    session.commit()
+    ids = sorted(queue.id for queue in queues)
+
+    result = QueueService(session=session).list(filters=None, offset=None, limit=3, prefix="queue_")
+    assert [queue.id for queue in result.data] == ids[:3]
+
+    result = QueueService(session=session).list(
+        filters=None, offset=None, limit=3, after=result.next_cursor, prefix="queue_"
+    )
+    assert [queue.id for queue in result.data] == ids[3:]
+    assert result.next_cursor is None
+
+
 def test_queue_service_delete(session, queue):
     messages = MessageFactory.build_batch(5, queue_id=queue.id)
     session.add_all(messages)
@@ -189,6 +262,222 @@ def test_queue_service_stats(session, queue):
     assert result.oldest_unacked_message_age_seconds == 10
 
 
+def get_queue_counter(session, queue_id):
+    session.expire_all()
+    return session.get(QueueCounter, queue_id)
+
+
+def test_queue_service_stats_with_queue_counters(session, topic, queue_counters):
+    data = CreateQueueSchema(
+        id="my_queue", topic_id=topic.id, ack_deadline_seconds=30, message_retention_seconds=600
+    )
+    queue = QueueService(session=session).create(data=data)
+    counter = get_queue_counter(session, queue.id)
+    assert counter.num_ready == 0
+
+    message_data = CreateMessageBatchSchema(data=[{"data": {"message": "Hello"}}] * 3)
+    MessageService(session=session).create_batch(topic_id=topic.id, data=message_data)
+    result = QueueService(session=session).stats(id=queue.id)
+    assert result.num_undelivered_messages == 3
+    assert result.oldest_unacked_message_age_seconds >= 0
+
+    consumed = MessageService(session=session).list_for_consume(queue_id=queue.id, limit=2)
+    counter = get_queue_counter(session, queue.id)
+    assert counter.num_ready == 1
+    assert counter.num_in_flight == 2
+    assert QueueService(session=session).stats(id=queue.id).num_undelivered_messages == 1
+
+    MessageService(session=session).ack(id=consumed.data[0].id)
+    MessageService(session=session).nack(id=consumed.data[1].id)
+    counter = get_queue_counter(session, queue.id)
+    assert counter.num_ready == 2
+    assert counter.num_in_flight == 0
+
+    consumed = MessageService(session=session).list_for_consume(queue_id=queue.id, limit=2)
+    ids = [message.id for message in consumed.data]
+    MessageService(session=session).nack_batch(data=MessageIdsSchema(ids=ids))
+    MessageService(session=session).ack_batch(data=MessageIdsSchema(ids=ids[:1]))
+    counter = get_queue_counter(session, queue.id)
+    assert counter.num_ready == 1
+    assert counter.num_in_flight == 0
+    assert counter.num_delayed == 0
+
+    QueueService(session=session).purge(id=queue.id)
+    assert QueueService(session=session).stats(id=queue.id).num_undelivered_messages == 0
+
+
+def test_queue_service_stats_with_queue_counters_redelivery(session, topic, queue_counters):
+    data = CreateQueueSchema(
+        id="my_queue", topic_id=topic.id, ack_deadline_seconds=30, message_retention_seconds=600
+    )
+    queue = QueueService(session=session).create(data=data)
+    message_data = CreateMessageBatchSchema(data=[{"data": {"message": "Hello"}}] * 2)
+    MessageService(session=session).create_batch(topic_id=topic.id, data=message_data)
+    MessageService(session=session).list_for_consume(queue_id=queue.id, limit=2)
+
+    # the ack deadline ends without a reconciliation, so the messages are still counted in flight
+    now = datetime.utcnow()
+    session.query(QueueCounter).update({"reconciled_at": now - timedelta(seconds=60)})
+    session.query(Message).update(
+        {"scheduled_at": now - timedelta(seconds=1), "updated_at": now - timedelta(seconds=31)}
+    )
+    session.commit()
+    consumed = MessageService(session=session).list_for_consume(queue_id=queue.id, limit=2)
+    assert len(consumed.data) == 2
+    counter = get_queue_counter(session, queue.id)
+    assert (counter.num_ready, counter.num_in_flight, counter.num_delayed) == (0, 2, 0)
+
+    # after a reconciliation they are counted as ready
+    session.query(Message).update(
+        {"scheduled_at": now - timedelta(seconds=1), "updated_at": now - timedelta(seconds=31)}
+    )
+    session.commit()
+    QueueService(session=session).update(
+        id=queue.id,
+        data=UpdateQueueSchema(topic_id=topic.id, ack_deadline_seconds=30, message_retention_seconds=600),
+    )
+    counter = get_queue_counter(session, queue.id)
+    assert (counter.num_ready, counter.num_in_flight, counter.num_delayed) == (2, 0, 0)
+    MessageService(session=session).list_for_consume(queue_id=queue.id, limit=1)
+    counter = get_queue_counter(session, queue.id)
+    assert (counter.num_ready, counter.num_in_flight, counter.num_delayed) == (1, 1, 0)
+
+    ids = [message.id for message in consumed.data]
+    MessageService(session=session).nack_batch(data=MessageIdsSchema(ids=ids))
+    counter = get_queue_counter(session, queue.id)
+    assert (counter.num_ready, counter.num_in_flight, counter.num_delayed) == (2, 0, 0)
+
+
+def test_queue_service_stats_with_queue_counters_reconcile(session, queue, queue_counters):
+    created_at = datetime.utcnow() - timedelta(seconds=10)
+    messages = MessageFactory.build_batch(5, queue_id=queue.id, created_at=created_at)
+    session.add_all(messages)
+    session.commit()
+    assert get_queue_counter(session, queue.id) is None
+
+    result = QueueService(session=session).stats(id=queue.id)
+    assert result.num_undelivered_messages == 5
+    assert result.oldest_unacked_message_age_seconds == 10
+
+    # an unknown oldest message is loaded again
+    session.query(QueueCounter).update({"oldest_message_created_at": None})
+    session.commit()
+    result = QueueService(session=session).stats(id=queue.id)
+    assert result.oldest_unacked_message_age_seconds == 10
+    assert get_queue_counter(session, queue.id).oldest_message_created_at == created_at
+
+
+def test_queue_service_cleanup_with_queue_counters(session, queue, queue_counters):
+    dead_queue = QueueFactory(delivery_delay_seconds=30)
+    session.add(dead_queue)
+    session.commit()
+    queue.message_max_deliveries = 2
+    queue.dead_queue_id = dead_queue.id
+    now = datetime.utcnow()
+    session.add_all(
+        [
+            MessageFactory(queue_id=queue.id),
+            MessageFactory(queue_id=queue.id, expired_at=now - timedelta(seconds=1)),
+            MessageFactory(queue_id=queue.id, delivery_attempts=2, scheduled_at=now + timedelta(seconds=30)),
+        ]
+    )
+    session.commit()
+    QueueService(session=session).stats(id=queue.id)
+    QueueService(session=session).stats(id=dead_queue.id)
+    counter = get_queue_counter(session, queue.id)
+    assert (counter.num_ready, counter.num_in_flight) == (2, 1)
+
+    QueueService(session=session).cleanup(id=queue.id)
+
+    counter = get_queue_counter(session, queue.id)
+    assert (counter.num_ready, counter.num_in_flight, counter.num_delayed) == (1, 0, 0)
+    counter = get_queue_counter(session, dead_queue.id)
+    assert (counter.num_ready, counter.num_in_flight, counter.num_delayed) == (0, 0, 1)
+
+
+def test_queue_service_redrive_with_queue_counters(session, queue, queue_counters):
+    dead_queue = QueueFactory()
+    session.add(dead_queue)
+    session.commit()
+    created_at = datetime.utcnow() - timedelta(seconds=10)
+    session.add_all(MessageFactory.build_batch(3, queue_id=dead_queue.id, created_at=created_at))
+    session.commit()
+    QueueService(session=session).stats(id=queue.id)
+    QueueService(session=session).stats(id=dead_queue.id)
+
+    data = RedriveQueueSchema(destination_queue_id=queue.id, message_count=3)
+    QueueService(session=session).redrive(id=dead_queue.id, data=data)
+
+    assert QueueService(session=session).stats(id=dead_queue.id).num_undelivered_messages == 0
+    result = QueueService(session=session).stats(id=queue.id)
+    assert result.num_undelivered_messages == 3
+    assert result.oldest_unacked_message_age_seconds == 10
+
+
+def test_queue_service_list_stats(session, queue):
+    dead_queue = QueueFactory()
+    session.add(dead_queue)
+    session.commit()
+    queue.dead_queue_id = dead_queue.id
+    queue.message_max_deliveries = 2
+    created_at = datetime.utcnow() - timedelta(seconds=10)
+    session.add_all(
+        [
+            MessageFactory(queue_id=queue.id, created_at=created_at),
+            MessageFactory(queue_id=queue.id),
+            MessageFactory(queue_id=queue.id, delivery_attempts=2),
+            MessageFactory(queue_id=queue.id, scheduled_at=datetime.utcnow() + timedelta(seconds=30)),
+            MessageFactory(queue_id=queue.id, expired_at=datetime.utcnow() - timedelta(seconds=1)),
+        ]
+    )
+    session.commit()
+
+    result = QueueService(session=session).list_stats()
+    assert [item.queue_id for item in result.data] == sorted([queue.id, dead_queue.id])
+    stats = {item.queue_id: item for item in result.data}
+    assert stats[queue.id].num_undelivered_messages == 2
+    assert stats[queue.id].oldest_unacked_message_age_seconds == 10
+    assert stats[dead_queue.id].num_undelivered_messages == 0
+    assert stats[dead_queue.id].oldest_unacked_message_age_seconds == 0
+
+    result = QueueService(session=session).list_stats(queue_ids=[dead_queue.id])
+    assert [item.queue_id for item in result.data] == [dead_queue.id]
+    result = QueueService(session=session).list_stats(topic_id=queue.topic_id)
+    assert [item.queue_id for item in result.data] == [queue.id]
+    result = QueueService(session=session).list_stats(queue_ids=[])
+    assert result.data == []
+
+
+def test_queue_service_list_stats_cache(session, queue):
+    assert QueueService(session=session).list_stats().data[0].num_undelivered_messages == 0
+
+    session.add(MessageFactory(queue_id=queue.id))
+    session.commit()
+    assert QueueService(session=session).list_stats().data[0].num_undelivered_messages == 0
+
+    stats_cache.clear()
+    assert QueueService(session=session).list_stats().data[0].num_undelivered_messages == 1
+
+
+def test_queue_service_list_stats_with_queue_counters(session, queue, queue_counters):
+    created_at = datetime.utcnow() - timedelta(seconds=10)
+    session.add_all(MessageFactory.build_batch(5, queue_id=queue.id, created_at=created_at))
+    session.commit()
+
+    result = QueueService(session=session).list_stats()
+    assert result.data[0].num_undelivered_messages == 5
+    assert result.data[0].oldest_unacked_message_age_seconds == 10
+    assert get_queue_counter(session, queue.id).num_ready == 5
+
+    # an unknown oldest message is loaded again
+    session.query(QueueCounter).update({"num_ready": 6, "oldest_message_created_at": None})
+    session.commit()
+    stats_cache.clear()
+    result = QueueService(session=session).list_stats()
+    assert result.data[0].num_undelivered_messages == 5
+    assert result.data[0].oldest_unacked_message_age_seconds == 10
+
+
 def test_queue_service_purge(session, queue):
     created_at = datetime.utcnow() - timedelta(seconds=10)
     messages = MessageFactory.build_batch(5, queue_id=queue.id, created_at=created_at)
@@ -236,6 +525,37 @@ def test_queue_service_cleanup_move_to_dead_queue(session, queue):
     assert message3.delivery_attempts == 0
 
 
+def test_queue_service_cleanup_in_chunks(session, queue, monkeypatch):
+    monkeypatch.setattr(settings, "queue_cleanup_chunk_size", 2)
+    dead_queue = QueueFactory()
+    session.add(dead_queue)
+    session.commit()
+    queue.message_max_deliveries = 2
+    queue.dead_queue_id = dead_queue.id
+    expired_at = datetime.utcnow() - timedelta(seconds=1)
+    session.add_all(MessageFactory.build_batch(5, queue_id=queue.id, expired_at=expired_at))
+    session.add_all(MessageFactory.build_batch(5, queue_id=queue.id, delivery_attempts=2))
+    session.commit()
+
+    assert QueueService(session=session).cleanup(id=queue.id) is None
+    assert session.query(Message).filter_by(queue_id=queue.id).count() == 0
+    assert session.query(Message).filter_by(queue_id=dead_queue.id).count() == 5
+
+
+def test_queue_service_cleanup_skip_locked_messages(session, queue):
+    expired_at = datetime.utcnow() - timedelta(seconds=1)
+    message1 = MessageFactory(queue_id=queue.id, expired_at=expired_at)
+    message2 = MessageFactory(queue_id=queue.id, expired_at=expired_at)
+    session.add_all([message1, message2])
+    session.commit()
+
+    with SessionLocal() as other_session:
+        other_session.query(Message).filter_by(id=message1.id).with_for_update().one()
+        assert QueueService(session=session).cleanup(id=queue.id) is None
+
+    assert [message.id for message in session.query(Message).filter_by(queue_id=queue.id)] == [message1.id]
+
+
 def test_queue_service_redrive(session, queue):
     dead_queue = QueueFactory()
     session.add(dead_queue)
@@ -261,32 +581,6 @@ def test_queue_service_redrive(session, queue):
     assert message3.id in message_ids
 
 
-@pytest.mark.parametrize(
-    "queue_filters,message_attributes,expected",
-    [
-        ({"attr1": [1]}, {"attr1": 1}, True),
-        ({"attr1": [1]}, {"attr1": "1"}, False),
-        ({"attr1": [1, 2]}, {"attr1": 1}, True),
-        ({"attr1": [1, 2]}, {"attr1": 2}, True),
-        ({"attr1": [1]}, {"attr2": 1}, False),
-        ({"attr1": [1], "attr2": [2]}, {"attr1": 1}, False),
-        ({"attr1": [1], "attr2": [2]}, {"attr1": 1, "attr2": 2}, True),
-        ({"attr1": [1], "attr2": [2]}, {"attr1": 1, "attr2": 2, "attr3": 3}, True),
-        ({"attr1": [1, 2], "attr2": [1, 2]}, {"attr1": 1, "attr2": 2, "attr3": 3}, True),
-        (None, {"attr1": 1}, True),
-        ({"attr1": [1]}, None, False),
-        (None, None, True),
-    ],
-)
-def test_message_service_should_message_be_created_on_queue(
-    session, queue_filters, message_attributes, expected
-):
-    assert (
-        MessageService(session=session)._should_message_be_created_on_queue(queue_filters, message_attributes)
-        is expected
-    )
-
-
 def test_message_service_create(session, topic):
     queues = QueueFactory.build_batch(5, topic_id=topic.id)
     session.add_all(queues)
@@ -305,6 +599,211 @@ def test_message_service_create(session, topic):
         assert message.attributes == data.attributes
 
 
+def test_message_service_create_with_payload(session, topic):
+    queues = QueueFactory.build_batch(2, topic_id=topic.id)
+    session.add_all(queues)
+    session.commit()
+    data = CreateMessageSchema(data={"message": "Hello World"}, attributes={"attr1": "attr1"})
+
+    result = MessageService(session=session).create(topic_id=topic.id, data=data)
+
+    # the payload is stored once for all the queues
+    payload = session.query(MessagePayload).one()
+    assert (payload.data, payload.attributes) == (data.data, data.attributes)
+    assert (
+        session.query(Message).filter(Message.data.is_(None), Message.payload_id == payload.id).count() == 2
+    )
+
+    # the result follows the order of the queue ids
+    consumed = MessageService(session=session).list_for_consume(queue_id=result.data[0].queue_id, limit=10)
+    assert consumed.data[0].id == result.data[0].id
+    assert (consumed.data[0].data, consumed.data[0].attributes) == (data.data, data.attributes)
+
+    # the payload is removed with its last message
+    MessageService(session=session).ack(id=consumed.data[0].id)
+    MessageService(session=session).cleanup_payloads()
+    assert session.query(MessagePayload).count() == 1
+    QueueService(session=session).purge(id=result.data[1].queue_id)
+    MessageService(session=session).cleanup_payloads()
+    assert session.query(MessagePayload).count() == 0
+
+
+def test_message_service_ingest_messages(session, topic, queue_counters, monkeypatch):
+    monkeypatch.setattr(settings, "enable_message_compression", True)
+    monkeypatch.setattr(settings, "message_compression_min_size_bytes", 100)
+    queues = QueueFactory.build_batch(2, topic_id=topic.id, message_filters=None, delivery_delay_seconds=None)
+    session.add_all(queues)
+    session.commit()
+    items = [
+        CreateMessageSchema(data={"message": "Hello World"}, attributes={"attr1": "attr1"}),
+        CreateMessageSchema(data={"items": [{"name": "item", "value": 1}] * 100}),
+    ]
+
+    # the rows are written with COPY on the psycopg2 connection of the session
+    assert MessageService(session=session)._ingest_messages(topic_id=topic.id, items=items) == 4
+
+    assert session.query(MessagePayload).count() == 2
+    assert QueueService(session=session).stats(id=queues[0].id).num_undelivered_messages == 2
+    consumed = MessageService(session=session).list_for_consume(queue_id=queues[0].id, limit=10)
+    assert sorted([(m.data, m.attributes) for m in consumed.data], key=str) == sorted(
+        [(item.data, item.attributes) for item in items], key=str
+    )
+
+
+def test_message_service_create_with_compressed_data(session, queue, monkeypatch):
+    monkeypatch.setattr(settings, "enable_message_compression", True)
+    monkeypatch.setattr(settings, "message_compression_min_size_bytes", 100)
+    small_data = CreateMessageSchema(data={"message": "Hello World"})
+    large_data = CreateMessageSchema(data={"items": [{"name": "item", "value": 1}] * 100})
+
+    MessageService(session=session).create(topic_id=queue.topic_id, data=small_data)
+    MessageService(session=session).create(topic_id=queue.topic_id, data=large_data)
+
+    payload = session.query(MessagePayload).one()
+    assert payload.data is None
+    assert len(payload.compressed_data) < len(str(large_data.data))
+    assert session.query(Message).filter(Message.data.is_not(None)).count() == 1
+
+    consumed = MessageService(session=session).list_for_consume(queue_id=queue.id, limit=10)
+    assert sorted([message.data for message in consumed.data], key=len) == [small_data.data, large_data.data]
+
+
+def test_message_service_create_without_queues(session, topic):
+    data = CreateMessageSchema(data={"message": "Hello World"})
+
+    result = MessageService(session=session).create(topic_id=topic.id, data=data)
+
+    assert len(result.data) == 0
+    assert session.query(Message).count() == 0
+
+
+def test_message_service_create_batch(session, topic):
+    queue1 = QueueFactory(topic_id=topic.id)
+    queue2 = QueueFactory(topic_id=topic.id, message_filters={"attr1": ["attr1"]})
+    session.add_all([queue1, queue2])
+    session.commit()
+    data = CreateMessageBatchSchema(
+        data=[
+            CreateMessageSchema(data={"message": "Hello World 1"}, attributes={"attr1": "attr1"}),
+            CreateMessageSchema(data={"message": "Hello World 2"}, attributes={"attr1": "attr2"}),
+            CreateMessageSchema(data={"message": "Hello World 3"}),
+        ]
+    )
+
+    result = MessageService(session=session).create_batch(topic_id=topic.id, data=data)
+
+    assert len(result.data) == 3
+    assert [message.queue_id for message in result.data[0].data] == [queue1.id, queue2.id]
+    assert [message.queue_id for message in result.data[1].data] == [queue1.id]
+    assert [message.queue_id for message in result.data[2].data] == [queue1.id]
+    for item, messages in zip(data.data, result.data):
+        for message in messages.data:
+            assert message.data == item.data
+            assert message.attributes == item.attributes
+            assert message.delivery_attempts == 0
+    assert session.query(Message).filter_by(queue_id=queue1.id).count() == 3
+    assert session.query(Message).filter_by(queue_id=queue2.id).count() == 1
+
+
+def test_message_service_create_batch_topic_not_found(session):
+    data = CreateMessageBatchSchema(data=[CreateMessageSchema(data={"message": "Hello World"})])
+
+    with pytest.raises(NotFoundError):
+        MessageService(session=session).create_batch(topic_id="invalid-topic-name", data=data)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("max_bind_parameters,statements", [(32767, 1), (1, 5)])
+async def test_async_message_service_create_batch_multi_row_insert(
+    async_session, queue, monkeypatch, max_bind_parameters, statements
+):
+    monkeypatch.setattr(services, "max_bind_parameters", max_bind_parameters)
+    data = CreateMessageBatchSchema(
+        data=[CreateMessageSchema(data={"message": f"Hello World {i}"}) for i in range(5)]
+    )
+    executed = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("INSERT INTO messages "):
+            executed.append(executemany)
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        result = await AsyncMessageService(session=async_session).create_batch(
+            topic_id=queue.topic_id, data=data
+        )
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", before_cursor_execute)
+
+    assert len(result.data) == 5
+    assert executed == [False] * statements
+    assert await async_session.scalar(text("select count(*) from messages")) == 5
+
+
+def test_message_service_create_uses_routing_cache(session, queue):
+    data = CreateMessageSchema(data={"message": "Hello World"})
+    MessageService(session=session).create(topic_id=queue.topic_id, data=data)
+    assert [queue.id for queue in routing_cache.get(topic_key(queue.topic_id)).queues] == [queue.id]
+
+    # queues created out of the services are only seen after the cache is invalidated
+    other_queue = QueueFactory(topic_id=queue.topic_id)
+    session.add(other_queue)
+    session.commit()
+    result = MessageService(session=session).create(topic_id=queue.topic_id, data=data)
+    assert len(result.data) == 1
+
+    routing_cache.delete(topic_key(queue.topic_id))
+    result = MessageService(session=session).create(topic_id=queue.topic_id, data=data)
+    assert len(result.data) == 2
+
+
+def test_routing_cache_invalidation_during_read(session, queue, monkeypatch):
+    get_model = services.get_model
+
+    def get_model_and_invalidate(model, filters, session):
+        instance = get_model(model=model, filters=filters, session=session)
+        # an update committed by another process after the row was read
+        routing_cache.delete_many([queue_key(queue.id), topic_key(queue.topic_id)])
+        return instance
+
+    monkeypatch.setattr(services, "get_model", get_model_and_invalidate)
+    MessageService(session=session).list_for_consume(queue_id=queue.id, limit=10)
+    MessageService(session=session).create(topic_id=queue.topic_id, data=CreateMessageSchema(data={}))
+    assert routing_cache.get(queue_key(queue.id)) is None
+    assert routing_cache.get(topic_key(queue.topic_id)) is None
+
+
+def test_routing_cache_invalidation(session, queue):
+    data = CreateMessageSchema(data={"message": "Hello World"})
+    MessageService(session=session).create(topic_id=queue.topic_id, data=data)
+    MessageService(session=session).list_for_consume(queue_id=queue.id, limit=10)
+    assert routing_cache.get(topic_key(queue.topic_id)) is not None
+    assert routing_cache.get(queue_key(queue.id)) is not None
+
+    data = UpdateQueueSchema(topic_id=queue.topic_id, ack_deadline_seconds=60, message_retention_seconds=600)
+    QueueService(session=session).update(queue.id, data)
+    assert routing_cache.get(topic_key(queue.topic_id)) is None
+    assert routing_cache.get(queue_key(queue.id)) is None
+
+    create_data = CreateQueueSchema(
+        id="my-queue", topic_id=queue.topic_id, ack_deadline_seconds=30, message_retention_seconds=600
+    )
+    MessageService(session=session).list_for_consume(queue_id=queue.id, limit=10)
+    MessageService(session=session).create(topic_id=queue.topic_id, data=CreateMessageSchema(data={}))
+    QueueService(session=session).create(create_data)
+    assert routing_cache.get(topic_key(queue.topic_id)) is None
+    assert routing_cache.get(queue_key(queue.id)) is not None
+
+    MessageService(session=session).create(topic_id=queue.topic_id, data=CreateMessageSchema(data={}))
+    QueueService(session=session).delete(create_data.id)
+    assert routing_cache.get(topic_key(queue.topic_id)) is None
+
+    MessageService(session=session).create(topic_id=queue.topic_id, data=CreateMessageSchema(data={}))
+    TopicService(session=session).delete(queue.topic_id)
+    assert routing_cache.get(topic_key(queue.topic_id)) is None
+    assert routing_cache.get(queue_key(queue.id)) is None
+
+
 def test_message_service_list_for_consume(session, queue):
     queue.ack_deadline_seconds = 1
     queue.message_max_deliveries = None
@@ -399,6 +898,60 @@ def test_message_service_list_for_consume_with_delivery_delay_seconds(session, q
         assert message.expired_at > now
 
 
+def test_message_service_list_for_consume_with_limit(session, queue):
+    messages = MessageFactory.build_batch(5, queue_id=queue.id)
+    session.add_all(messages)
+    session.commit()
+
+    result1 = MessageService(session=session).list_for_consume(queue_id=queue.id, limit=2)
+    result2 = MessageService(session=session).list_for_consume(queue_id=queue.id, limit=10)
+
+    assert len(result1.data) == 2
+    assert len(result2.data) == 3
+    consumed_ids = {message.id for message in result1.data + result2.data}
+    assert consumed_ids == {uuid.UUID(str(message.id)) for message in messages}
+    assert session.query(Message).filter_by(queue_id=queue.id, delivery_attempts=1).count() == 5
+
+
+def test_message_service_list_for_consume_with_wait_seconds(session, queue):
+    data = CreateMessageSchema(data={"message": "Hello World"})
+
+    def publish():
+        with SessionLocal() as publisher_session:
+            MessageService(session=publisher_session).create(topic_id=queue.topic_id, data=data)
+
+    timer = Timer(0.5, publish)
+    start = monotonic()
+    timer.start()
+
+    result = MessageService(session=session).list_for_consume(queue_id=queue.id, limit=10, wait_seconds=5)
+
+    timer.join()
+    assert len(result.data) == 1
+    assert monotonic() - start < 5
+
+
+def test_message_service_list_for_consume_with_wait_seconds_and_scheduled_message(session, queue):
+    message = MessageFactory(queue_id=queue.id, scheduled_at=datetime.utcnow() + timedelta(seconds=0.5))
+    session.add(message)
+    session.commit()
+    start = monotonic()
+
+    result = MessageService(session=session).list_for_consume(queue_id=queue.id, limit=10, wait_seconds=5)
+
+    assert len(result.data) == 1
+    assert monotonic() - start < 5
+
+
+def test_message_service_list_for_consume_with_wait_seconds_timeout(session, queue):
+    start = monotonic()
+
+    result = MessageService(session=session).list_for_consume(queue_id=queue.id, limit=10, wait_seconds=1)
+
+    assert len(result.data) == 0
+    assert monotonic() - start >= 1
+
+
 def test_message_service_ack(session, message):
     assert session.query(Message).filter_by(id=message.id).count() == 1
     assert MessageService(session=session).ack(id=message.id) is None
@@ -430,6 +983,438 @@ def test_message_service_nack_with_removed_message(session):
     assert session.query(Message).filter_by(id=id).count() == 0
 
 
+@pytest.mark.parametrize(
+    "retry_policy,delivery_attempts,expected",
+    [
+        (None, 3, 0),
+        ("fixed", 3, 10),
+        ("linear", 3, 30),
+        ("exponential", 1, 10),
+        ("exponential", 3, 40),
+        ("exponential", 100, 100),
+    ],
+)
+def test_message_service_nack_with_retry_policy(session, queue, retry_policy, delivery_attempts, expected):
+    queue.retry_policy = retry_policy
+    queue.retry_min_backoff_seconds = 10
+    queue.retry_max_backoff_seconds = 100
+    message = MessageFactory(queue_id=queue.id, delivery_attempts=delivery_attempts)
+    session.add(message)
+    session.commit()
+
+    MessageService(session=session).nack(id=message.id)
+
+    session.refresh(message)
+    assert message.scheduled_at - message.updated_at == timedelta(seconds=expected)
+
+
+def test_message_service_nack_with_retry_jitter(session, queue):
+    queue.retry_policy = "fixed"
+    queue.retry_min_backoff_seconds = 100
+    queue.retry_max_backoff_seconds = 100
+    queue.retry_jitter = True
+    messages = MessageFactory.build_batch(10, queue_id=queue.id, delivery_attempts=1)
+    session.add_all(messages)
+    session.commit()
+
+    MessageService(session=session).nack_batch(
+        data=MessageIdsSchema(ids=[message.id for message in messages])
+    )
+
+    delays = []
+    for message in messages:
+        session.refresh(message)
+        delays.append((message.scheduled_at - message.updated_at).total_seconds())
+    assert all(50 <= delay <= 100 for delay in delays)
+    assert len(set(delays)) > 1
+
+
+def test_message_service_nack_with_delay_seconds(session, queue):
+    queue.retry_policy = "fixed"
+    queue.retry_min_backoff_seconds = 10
+    messages = MessageFactory.build_batch(2, queue_id=queue.id, delivery_attempts=1)
+    session.add_all(messages)
+    session.commit()
+
+    MessageService(session=session).nack(id=messages[0].id, delay_seconds=0)
+    MessageService(session=session).nack_batch(data=MessageIdsSchema(ids=[messages[1].id]), delay_seconds=30)
+
+    for message in messages:
+        session.refresh(message)
+    assert messages[0].scheduled_at == messages[0].updated_at
+    assert messages[1].scheduled_at - messages[1].updated_at == timedelta(seconds=30)
+
+
+def test_message_service_consume_with_retry_policy(session, topic, queue):
+    # the backoff is added to the ack deadline, so it applies when the deadline ends without an ack
+    queue.retry_policy = "exponential"
+    queue.retry_min_backoff_seconds = 10
+    queue.retry_max_backoff_seconds = 100
+    session.add(MessageFactory(queue_id=queue.id, delivery_attempts=2))
+    session.commit()
+
+    MessageService(session=session).list_for_consume(queue_id=queue.id, limit=10)
+
+    message = session.query(Message).filter_by(queue_id=queue.id).one()
+    assert message.delivery_attempts == 3
+    assert message.scheduled_at - message.updated_at == timedelta(seconds=queue.ack_deadline_seconds + 40)
+
+
+def test_message_service_ack_batch(session, queue):
+    messages = MessageFactory.build_batch(3, queue_id=queue.id)
+    session.add_all(messages)
+    session.commit()
+    not_found_id = uuid.uuid4()
+    data = MessageIdsSchema(ids=[messages[0].id, messages[1].id, not_found_id])
+
+    result = MessageService(session=session).ack_batch(data=data)
+
+    assert result.not_found_ids == [not_found_id]
+    assert session.query(Message).filter_by(queue_id=queue.id).count() == 1
+    assert session.query(Message).filter_by(queue_id=queue.id).first().id == messages[2].id
+
+
+def test_message_service_nack_batch(session, queue):
+    scheduled_at = datetime.utcnow() + timedelta(seconds=30)
+    messages = MessageFactory.build_batch(3, queue_id=queue.id, scheduled_at=scheduled_at)
+    session.add_all(messages)
+    session.commit()
+    not_found_id = uuid.uuid4()
+    data = MessageIdsSchema(ids=[messages[0].id, messages[1].id, not_found_id])
+
+    result = MessageService(session=session).nack_batch(data=data)
+
+    assert result.not_found_ids == [not_found_id]
+    for message in messages:
+        session.refresh(message)
+    assert messages[0].scheduled_at < scheduled_at
+    assert messages[1].scheduled_at < scheduled_at
+    assert messages[2].scheduled_at == scheduled_at
+
+
+def test_message_service_modify_ack_deadline(session, queue):
+    now = datetime.utcnow()
+    message = MessageFactory(queue_id=queue.id, delivery_attempts=1, scheduled_at=now + timedelta(seconds=5))
+    session.add(message)
+    session.commit()
+
+    MessageService(session=session).modify_ack_deadline(
+        id=message.id, data=AckDeadlineSchema(ack_deadline_seconds=60)
+    )
+
+    session.refresh(message)
+    assert message.scheduled_at >= now + timedelta(seconds=60)
+
+
+def test_message_service_modify_ack_deadline_batch(session, queue):
+    now = datetime.utcnow()
+    in_flight = MessageFactory.build_batch(
+        2, queue_id=queue.id, delivery_attempts=1, scheduled_at=now + timedelta(seconds=30)
+    )
+    # a message that was not delivered and one whose ack deadline already ended have no lease
+    delayed = MessageFactory(queue_id=queue.id, delivery_attempts=0, scheduled_at=now + timedelta(seconds=30))
+    expired = MessageFactory(queue_id=queue.id, delivery_attempts=1, scheduled_at=now - timedelta(seconds=1))
+    session.add_all(in_flight + [delayed, expired])
+    session.commit()
+    not_found_id = uuid.uuid4()
+    ids = [message.id for message in in_flight] + [delayed.id, expired.id, not_found_id]
+
+    result = MessageService(session=session).modify_ack_deadline_batch(
+        data=ModifyAckDeadlineSchema(ids=ids, ack_deadline_seconds=5)
+    )
+
+    assert result.not_found_ids == [delayed.id, expired.id, not_found_id]
+    for message in in_flight + [delayed]:
+        session.refresh(message)
+    assert all(message.scheduled_at < now + timedelta(seconds=30) for message in in_flight)
+    assert delayed.scheduled_at == now + timedelta(seconds=30)
+
+
+@pytest.mark.parametrize("ack_deadline_seconds", [0, 60])
+def test_message_service_modify_ack_deadline_with_retry_policy(session, queue, ack_deadline_seconds):
+    # the backoff still applies when the extended deadline ends, and a deadline of 0 waits for it like a nack
+    queue.retry_policy = "linear"
+    queue.retry_min_backoff_seconds = 10
+    queue.retry_max_backoff_seconds = 100
+    message = MessageFactory(
+        queue_id=queue.id, delivery_attempts=2, scheduled_at=datetime.utcnow() + timedelta(seconds=5)
+    )
+    session.add(message)
+    session.commit()
+
+    MessageService(session=session).modify_ack_deadline(
+        id=message.id, data=AckDeadlineSchema(ack_deadline_seconds=ack_deadline_seconds)
+    )
+
+    session.refresh(message)
+    assert message.scheduled_at - message.updated_at == timedelta(seconds=ack_deadline_seconds + 20)
+
+
+def test_message_service_modify_ack_deadline_with_queue_counters(session, topic, queue_counters):
+    data = CreateQueueSchema(
+        id="my_queue", topic_id=topic.id, ack_deadline_seconds=30, message_retention_seconds=600
+    )
+    queue = QueueService(session=session).create(data=data)
+    service = MessageService(session=session)
+    service.create_batch(
+        topic_id=topic.id, data=CreateMessageBatchSchema(data=[{"data": {"message": "Hi"}}] * 2)
+    )
+    consumed = service.list_for_consume(queue_id=queue.id, limit=2)
+    ids = [message.id for message in consumed.data]
+
+    service.modify_ack_deadline_batch(data=ModifyAckDeadlineSchema(ids=ids, ack_deadline_seconds=60))
+    counter = get_queue_counter(session, queue.id)
+    assert (counter.num_ready, counter.num_in_flight, counter.num_delayed) == (0, 2, 0)
+
+    # a deadline of 0 makes the messages available again
+    service.modify_ack_deadline_batch(data=ModifyAckDeadlineSchema(ids=ids[:1], ack_deadline_seconds=0))
+    counter = get_queue_counter(session, queue.id)
+    assert (counter.num_ready, counter.num_in_flight, counter.num_delayed) == (1, 1, 0)
+    assert [message.id for message in service.list_for_consume(queue_id=queue.id, limit=2).data] == ids[:1]
+
+
 def test_health_service(session):
     response = HealthService(session=session).check()
     assert response.success
+
+
+@pytest.mark.anyio
+async def test_async_topic_service(async_session):
+    data = CreateTopicSchema(id="my_topic")
+
+    result = await AsyncTopicService(session=async_session).create(data)
+
+    assert result.id == data.id
+    assert (await AsyncTopicService(session=async_session).get(data.id)).id == data.id
+    assert (
+        len((await AsyncTopicService(session=async_session).list(filters=None, offset=0, limit=10)).data) == 1
+    )
+    assert await AsyncTopicService(session=async_session).delete(data.id) is None
+    with pytest.raises(NotFoundError):
+        await AsyncTopicService(session=async_session).get(data.id)
+
+
+@pytest.mark.anyio
+async def test_async_queue_service_stats(async_session, message):
+    result = await AsyncQueueService(session=async_session).stats(message.queue_id)
+
+    assert result.num_undelivered_messages == 1
+
+
+@pytest.mark.anyio
+async def test_async_queue_service_list_stats(async_session, message):
+    result = await AsyncQueueService(session=async_session).list_stats(queue_ids=[message.queue_id])
+
+    assert result.data[0].num_undelivered_messages == 1
+
+
+@pytest.mark.anyio
+async def test_async_queue_service_stats_with_queue_counters(async_session, queue, queue_counters):
+    data = CreateMessageSchema(data={"message": "Hello World"})
+    await AsyncMessageService(session=async_session).create(topic_id=queue.topic_id, data=data)
+    result = await AsyncQueueService(session=async_session).stats(queue.id)
+    assert result.num_undelivered_messages == 1
+
+    result = await AsyncMessageService(session=async_session).list_for_consume(queue_id=queue.id, limit=10)
+    await AsyncMessageService(session=async_session).nack(id=result.data[0].id)
+    await AsyncMessageService(session=async_session).create(topic_id=queue.topic_id, data=data)
+    result = await AsyncQueueService(session=async_session).stats(queue.id)
+    assert result.num_undelivered_messages == 2
+
+
+@pytest.mark.anyio
+async def test_async_message_service_with_retry_policy(async_session, session, queue):
+    queue.retry_policy = "linear"
+    queue.retry_min_backoff_seconds = 10
+    queue.retry_jitter = True
+    queue.retry_max_backoff_seconds = 100
+    session.commit()
+    data = CreateMessageSchema(data={"message": "Hello World"})
+    await AsyncMessageService(session=async_session).create(topic_id=queue.topic_id, data=data)
+
+    result = await AsyncMessageService(session=async_session).list_for_consume(queue_id=queue.id, limit=10)
+    await AsyncMessageService(session=async_session).nack(id=result.data[0].id)
+
+    message = session.query(Message).filter_by(queue_id=queue.id).one()
+    assert timedelta(seconds=5) <= message.scheduled_at - message.updated_at <= timedelta(seconds=10)
+
+
+@pytest.mark.anyio
+async def test_async_message_service(async_session, queue):
+    data = CreateMessageSchema(data={"message": "Hello World"})
+
+    result = await AsyncMessageService(session=async_session).create(topic_id=queue.topic_id, data=data)
+    assert len(result.data) == 1
+
+    result = await AsyncMessageService(session=async_session).list_for_consume(queue_id=queue.id, limit=10)
+    assert len(result.data) == 1
+    assert result.data[0].delivery_attempts == 1
+
+    assert await AsyncMessageService(session=async_session).ack(id=result.data[0].id) is None
+    result = await AsyncMessageService(session=async_session).list_for_consume(queue_id=queue.id, limit=10)
+    assert len(result.data) == 0
+
+
+@pytest.mark.anyio
+async def test_async_message_service_list_for_consume_with_wait_seconds(async_session, queue):
+    data = CreateMessageSchema(data={"message": "Hello World"})
+
+    def publish():
+        with SessionLocal() as publisher_session:
+            MessageService(session=publisher_session).create(topic_id=queue.topic_id, data=data)
+
+    timer = Timer(0.5, publish)
+    start = monotonic()
+    timer.start()
+
+    result = await AsyncMessageService(session=async_session).list_for_consume(
+        queue_id=queue.id, limit=10, wait_seconds=5
+    )
+
+    timer.join()
+    assert len(result.data) == 1
+    assert monotonic() - start < 5
+
+
+@pytest.mark.anyio
+async def test_async_message_service_list_for_consume_with_wait_seconds_timeout(async_session, queue):
+    start = monotonic()
+
+    result = await AsyncMessageService(session=async_session).list_for_consume(
+        queue_id=queue.id, limit=10, wait_seconds=1
+    )
+
+    assert len(result.data) == 0
+    assert monotonic() - start >= 1
+
+
+@pytest.mark.anyio
+async def test_async_message_service_stream(session, async_session, queue):
+    data = CreateMessageSchema(data={"message": "Hello World"})
+    requests: asyncio.Queue = asyncio.Queue()
+    responses: asyncio.Queue = asyncio.Queue()
+
+    async def receive():
+        request = await requests.get()
+        if request is None:
+            raise EOFError
+        return request
+
+    def publish():
+        with SessionLocal() as publisher_session:
+            MessageService(session=publisher_session).create(topic_id=queue.topic_id, data=data)
+
+    publish()
+    requests.put_nowait(StreamCreditsSchema(type="credits", credits=2))
+    task = asyncio.create_task(
+        AsyncMessageService(session=async_session).stream(
+            queue_id=queue.id, receive=receive, send=responses.put
+        )
+    )
+
+    first = await asyncio.wait_for(responses.get(), 5)
+    assert first.type == "messages"
+    assert len(first.data) == 1
+
+    # the next message is pushed when it is published, the last credit is used
+    await asyncio.to_thread(publish)
+    second = await asyncio.wait_for(responses.get(), 5)
+    assert len(second.data) == 1
+
+    # without credits nothing else is pushed
+    await asyncio.to_thread(publish)
+    await asyncio.sleep(0.5)
+    assert responses.empty()
+
+    ids = [first.data[0].id, second.data[0].id, uuid.uuid4()]
+    requests.put_nowait(StreamMessageIdsSchema(type="ack", ids=ids))
+    result = await asyncio.wait_for(responses.get(), 5)
+    assert result.type == "ack"
+    assert result.not_found_ids == ids[2:]
+
+    requests.put_nowait(None)
+    with pytest.raises(EOFError):
+        await asyncio.wait_for(task, 5)
+    assert session.query(Message).filter_by(queue_id=queue.id).count() == 1
+
+
+@pytest.mark.anyio
+async def test_async_message_service_stream_with_queue_not_found(async_session):
+    async def receive():
+        raise AssertionError
+
+    async def send(data):
+        raise AssertionError
+
+    with pytest.raises(NotFoundError):
+        await AsyncMessageService(session=async_session).stream(
+            queue_id="not-found", receive=receive, send=send
+        )
+
+
+async def iter_chunks(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+@pytest.mark.anyio
+async def test_split_lines():
+    chunks = iter_chunks(b'{"a": 1}\n{"b"', b": 2}\n\n" + b"x" * 20, b"x" * 20 + b"\nlast")
+
+    lines = [line async for line in split_lines(chunks, max_line_bytes=30)]
+
+    assert lines == [b'{"a": 1}', b'{"b": 2}', b"", None, b"last"]
+
+
+@pytest.mark.anyio
+async def test_async_message_service_ingest(session, async_session, queue, monkeypatch):
+    monkeypatch.setattr(settings, "ingest_batch_size", 2)
+    monkeypatch.setattr(settings, "max_ingest_errors", 1)
+    lines = [b'{"data": {"message": "Hello World"}}'] * 3 + [b"", b"not json", b'{"attributes": {}}']
+    chunks = iter_chunks(b"\n".join(lines)[:50], b"\n".join(lines)[50:])
+
+    # the rows are written with COPY on the asyncpg connection of the session
+    result = await AsyncMessageService(session=async_session).ingest(topic_id=queue.topic_id, chunks=chunks)
+
+    assert (result.num_lines, result.num_messages, result.num_errors) == (5, 3, 2)
+    # the blank line 4 is not counted in num_lines, but the errors point to the physical line
+    assert result.errors[0].line == 5
+    assert result.errors[0].detail.startswith("__root__: Expecting value")
+    assert session.query(Message).filter_by(queue_id=queue.id).count() == 3
+
+
+@pytest.mark.anyio
+async def test_async_message_service_ingest_write_error(session, async_session, queue, monkeypatch):
+    monkeypatch.setattr(settings, "ingest_batch_size", 2)
+    ingest_messages = MessageService._ingest_messages
+    calls = []
+
+    def failing_ingest_messages(self, topic_id, items):
+        calls.append(len(items))
+        if len(calls) == 2:
+            self.session.execute(text("SELECT * FROM not_found"))
+        return ingest_messages(self, topic_id=topic_id, items=items)
+
+    monkeypatch.setattr(MessageService, "_ingest_messages", failing_ingest_messages)
+    lines = [b'{"data": {"message": "Hello World"}}'] * 6
+    chunks = iter_chunks(b"\n".join(lines))
+
+    result = await AsyncMessageService(session=async_session).ingest(topic_id=queue.topic_id, chunks=chunks)
+
+    # the ingest stops at the failed batch, the first one is kept
+    assert calls == [2, 2]
+    assert (result.num_lines, result.num_messages, result.num_errors) == (4, 2, 0)
+    assert result.error == "failed to write the messages of lines 3 to 4"
+    assert session.query(Message).filter_by(queue_id=queue.id).count() == 2
+
+
+@pytest.mark.anyio
+async def test_async_message_service_ingest_topic_not_found(async_session):
+    with pytest.raises(NotFoundError):
+        await AsyncMessageService(session=async_session).ingest(topic_id="not-found", chunks=iter_chunks())
+
+
+@pytest.mark.anyio
+async def test_async_health_service(async_session):
+    response = await AsyncHealthService(session=async_session).check()
+    assert response.success
@@ -1,8 +1,13 @@
+import uuid
 from datetime import datetime, timedelta
+from unittest import mock
 
-from fastqueue.models import Message
-from fastqueue.workers import queue_cleanup_task
-from tests.factories import MessageFactory
+from fastqueue import workers
+from fastqueue.config import settings
+from fastqueue.models import Message, MessagePayload, QueueCounter
+from fastqueue.services import QueueService
+from fastqueue.workers import cleanup_queue, queue_cleanup_task, queue_counters_reconcile_task
+from tests.factories import MessageFactory, QueueFactory
 
 
 def test_queue_cleanup(session, queue):
@@ -17,3 +22,75 @@ def test_queue_cleanup(session, queue):
     assert queue_cleanup_task() is None
 
     assert session.query(Message).filter_by(queue_id=queue.id).count() == 0
+
+
+def test_queue_cleanup_with_payloads(session, queue):
+    now = datetime.utcnow()
+    session.add(MessagePayload(id=uuid.uuid4().hex, data={"message": "Hello"}, created_at=now))
+    session.commit()
+    payload_id = session.query(MessagePayload.id).scalar()
+    session.add_all(
+        MessageFactory.build_batch(
+            2, queue_id=queue.id, data=None, payload_id=payload_id, expired_at=now - timedelta(seconds=1)
+        )
+    )
+    session.commit()
+
+    assert queue_cleanup_task() is None
+
+    assert session.query(Message).count() == 0
+    assert session.query(MessagePayload).count() == 0
+
+
+def test_queue_cleanup_with_many_queues(session, queue, monkeypatch):
+    queues = QueueFactory.build_batch(3)
+    session.add_all(queues)
+    session.commit()
+    expired_at = datetime.utcnow() - timedelta(seconds=1)
+    for item in [queue] + queues:
+        session.add_all(MessageFactory.build_batch(2, queue_id=item.id, expired_at=expired_at))
+    session.commit()
+    cleanup = QueueService.cleanup
+
+    def cleanup_or_fail(self, id):
+        if id == queue.id:
+            raise Exception("cleanup failed")
+        return cleanup(self, id=id)
+
+    monkeypatch.setattr(QueueService, "cleanup", cleanup_or_fail)
+
+    assert queue_cleanup_task() is None
+
+    assert session.query(Message).filter_by(queue_id=queue.id).count() == 2
+    assert session.query(Message).filter(Message.queue_id != queue.id).count() == 0
+
+
+def test_cleanup_queue_not_found(session):
+    assert cleanup_queue("not-found-queue") is None
+
+
+def test_queue_counters_reconcile(session, queue, queue_counters):
+    session.add_all(MessageFactory.build_batch(5, queue_id=queue.id))
+    session.commit()
+
+    assert queue_counters_reconcile_task() is None
+
+    assert session.get(QueueCounter, queue.id).num_ready == 5
+
+
+def test_queue_counters_reconcile_disabled(session, queue):
+    assert queue_counters_reconcile_task() is None
+
+    assert session.get(QueueCounter, queue.id) is None
+
+
+def test_run_worker_with_prometheus_metrics(monkeypatch):
+    monkeypatch.setattr(settings, "enable_prometheus_metrics", True)
+
+    with mock.patch.object(workers, "start_http_server") as start_http_server, mock.patch.object(
+        workers.worker, "run"
+    ) as run:
+        workers.run_worker()
+
+    start_http_server.assert_called_once_with(settings.worker_metrics_port)
+    run.assert_called_once()